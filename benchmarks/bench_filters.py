@@ -0,0 +1,123 @@
+"""
+Benchmark of evaluating MONITOR filters over a batch of actions: filter
+specs (see filters.py), compiled into index lookups over the whole batch,
+against the equivalent filter functions called for every action.
+
+    python benchmarks/bench_filters.py -a 10000 -f 50
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import time
+import random
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trello_hipchat import from_trello_date
+from trello_hipchat.filters import filter_mask
+
+ACTION_TYPES = ['commentCard', 'updateCard', 'createCard', 'addLabelToCard']
+MEMBERS = ['member%d' % number for number in range(200)]
+LABELS = ['label%d' % number for number in range(60)]
+
+
+def synthetic_actions(count):
+    actions = []
+    for number in range(count):
+        card = number % 500
+        actions.append({
+            'id': 'action%d' % number,
+            'type': random.choice(ACTION_TYPES),
+            'idMemberCreator': random.choice(MEMBERS),
+            'memberCreator': {'id': 'creator', 'fullName': 'Some One'},
+            'date': '2020-01-%02dT%02d:%02d:00.%03dZ'
+                    % (1 + number % 28, number % 24, number % 60,
+                       number % 1000),
+            'data': {'card': {'id': 'card%d' % card,
+                              'name': 'Card %d %s' % (card, random.choice(
+                                  ['bug', 'feature', 'chore'])),
+                              'idLabels': random.sample(LABELS, 3)}}})
+    return actions
+
+
+def synthetic_filters(count):
+    """
+    Return `count` filter specs, and filter functions that do the same.
+    """
+    specs = []
+    functions = []
+    since = from_trello_date('2020-01-01T00:00:00.000Z')
+    until = from_trello_date('2020-01-28T00:00:00.000Z')
+    for number in range(count):
+        kind = number % 5
+        if kind in (0, 1):
+            members = set(random.sample(MEMBERS, 3))
+            specs.append({'member': sorted(members), 'exclude': True})
+            functions.append(
+                lambda A, members=members:
+                A['idMemberCreator'] not in members)
+        elif kind == 2:
+            labels = set(random.sample(LABELS, 2))
+            specs.append({'label': sorted(labels), 'exclude': True})
+            functions.append(
+                lambda A, labels=labels:
+                not labels & set(A['data']['card']['idLabels']))
+        elif kind == 3:
+            pattern = '^Card %d ' % number
+            regex = re.compile(pattern)
+            specs.append({'card_name': pattern, 'exclude': True})
+            functions.append(
+                lambda A, regex=regex:
+                not regex.search(A['data']['card']['name']))
+        else:
+            specs.append({'since': since, 'until': until})
+            functions.append(
+                lambda A: since <= from_trello_date(A['date']) < until)
+    return specs, functions
+
+
+def best_of(runs, func):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-a', type=int, dest='actions', default=10000,
+                        help='Number of actions')
+    parser.add_argument('-f', type=int, dest='filters', default=50,
+                        help='Number of filters')
+    parser.add_argument('-r', type=int, dest='runs', default=3,
+                        help='Number of runs to take the best of')
+    args = parser.parse_args()
+
+    random.seed(3)
+    actions = synthetic_actions(args.actions)
+    specs, functions = synthetic_filters(args.filters)
+
+    each_time, each = best_of(args.runs, lambda: [
+        all(f(A) for f in functions) for A in actions])
+    functions_time, by_functions = best_of(
+        args.runs, lambda: filter_mask(actions, functions))
+    specs_time, by_specs = best_of(
+        args.runs, lambda: filter_mask(actions, specs))
+    if not each == by_functions == by_specs:
+        sys.exit('The filters disagree.')
+
+    print('%d actions x %d filters, %d pass'
+          % (len(actions), len(functions), sum(by_specs)))
+    print('functions, per action:     %8.3fs' % each_time)
+    print('functions, filter_mask():  %8.3fs' % functions_time)
+    print('specs, filter_mask():      %8.3fs' % specs_time)
+    print('speedup:                   %8.1fx' % (each_time / specs_time))
+
+
+if __name__ == '__main__':
+    main()
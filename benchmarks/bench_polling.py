@@ -0,0 +1,108 @@
+"""
+Benchmark of a polling round (fetching and reporting the new actions on
+every board) for different numbers of boards, fetching the boards one after
+another and through a pool of workers as run_forever's -w option does. It
+runs against the replay harness's fake Trello, which waits `--latency`
+seconds before each answer to stand in for the round trip to the real one,
+and a fake HipChat.
+
+    python benchmarks/bench_polling.py -b 10 50 150 -w 1 16
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import threading
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trello_hipchat
+from trello_hipchat import poll_board, lookup_cache, limit_trello_requests
+from trello_hipchat.pool import run_isolated
+from trello_hipchat.routing import Route
+from trello_hipchat.state import StateStore
+from trello_hipchat.replay import FakeTrello, FakeHipChat, ReplayConfig
+
+
+def comments(board_id, count, when):
+    return [{'id': '%s-%d' % (board_id, number), 'type': 'commentCard',
+             'date': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                   time.gmtime(when)),
+             'memberCreator': {'id': 'member', 'fullName': 'Some One'},
+             'data': {'board': {'id': board_id, 'name': board_id},
+                      'card': {'id': 'card%d' % number,
+                               'name': 'Card %d' % number},
+                      'list': {'id': 'list', 'name': 'Doing'},
+                      'text': 'Comment %d' % number}}
+            for number in range(count)]
+
+
+def polling_round(config, board_ids, workers):
+    """
+    Poll every board once with a fresh state, and return how long it took.
+    """
+    routes_by_board = dict((route.board_id, [route])
+                           for route in Route.from_config(config))
+    state = StateStore(':memory:')
+    start_time = time.time() - 60
+    lock = threading.Lock()
+
+    def poll(board_id):
+        for new_last_time, page in poll_board(
+                config, board_id, routes_by_board[board_id], start_time,
+                max_backlog=None, seen=state.is_delivered):
+            with lock:
+                state.record(board_id, new_last_time, page[0]['id'],
+                             [A['id'] for A in page])
+
+    lookup_cache.clear()
+    start = time.time()
+    _, errors = run_isolated(poll, board_ids, max_workers=workers)
+    elapsed = time.time() - start
+    state.close()
+    if errors:
+        raise RuntimeError('%d boards failed' % len(errors))
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-b', type=int, nargs='+', dest='boards',
+                        default=[10, 50, 150],
+                        help='Numbers of boards to poll')
+    parser.add_argument('-w', type=int, nargs='+', dest='workers',
+                        default=[1, 16],
+                        help='Numbers of workers to poll them with')
+    parser.add_argument('-a', type=int, dest='actions', default=5,
+                        help='Number of new actions on each board')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds the fake Trello takes to answer')
+    args = parser.parse_args()
+
+    trello_server = FakeTrello(latency=args.latency)
+    hipchat_server = FakeHipChat()
+    for server in (trello_server.server, hipchat_server.server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    trello_hipchat.TRELLO_API_URL = trello_server.url
+    trello_hipchat.HIPCHAT_API_URL = hipchat_server.url
+    limit_trello_requests(None)
+
+    now = time.time()
+    print('%8s' % 'boards' +
+          ''.join('%12s' % ('%d workers' % w) for w in args.workers))
+    for count in args.boards:
+        board_ids = ['board%d' % number for number in range(count)]
+        for board_id in board_ids:
+            trello_server.publish(board_id,
+                                  comments(board_id, args.actions, now))
+        config = ReplayConfig(board_ids)
+        times = [polling_round(config, board_ids, workers)
+                 for workers in args.workers]
+        print('%8d' % count + ''.join('%11.2fs' % t for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Microbenchmark of routing actions to rooms: the compiled routes (one
+regular expression per MONITOR entry's list names, and sets of the action
+types it includes) against checking every action with a linear scan of
+include_actions and fnmatch over every list name pattern, as notify() used
+to. It uses a synthetic corpus of actions and MONITOR entries.
+
+    python benchmarks/bench_routing.py -a 5000 -e 200
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import fnmatch
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trello_hipchat import enrich_actions, route_records
+from trello_hipchat.routing import Route
+
+ACTION_TYPES = ['commentCard', 'createCard', 'updateCard', 'updateList',
+                'addMemberToCard', 'addAttachmentToCard', 'moveCardToBoard',
+                'deleteCard', 'createList', 'addLabelToCard']
+SUBTYPES = ['updateCard-move', 'updateCard-rename', 'updateCard-archive',
+            'updateCard-description', 'updateList-rename',
+            'updateList-archive']
+LIST_NAMES = ['Todo', 'Doing', 'Done', 'Backlog', 'Review', 'Blocked'] + \
+             ['Sprint %d' % number for number in range(20)]
+
+
+class BenchmarkConfig(object):
+    TRELLO_API_KEY = 'key'
+    TRELLO_TOKEN = 'token'
+
+
+def synthetic_actions(count):
+    """
+    Return `count` actions on one board, newest first, as Trello would.
+    """
+    actions = []
+    for number in range(count):
+        action_type = random.choice(ACTION_TYPES)
+        data = {'board': {'id': 'board', 'name': 'Board'},
+                'card': {'id': 'card%d' % (number % 50),
+                         'name': 'Card %d' % (number % 50)},
+                'list': {'id': 'list', 'name': random.choice(LIST_NAMES)}}
+        if action_type in ('updateCard', 'updateList'):
+            field = random.choice(['name', 'closed', 'pos'])
+            data['old'] = {field: False if field == 'closed' else 'old'}
+            if action_type == 'updateCard' and random.random() < 0.3:
+                del data['list']
+                data['old'] = {'idList': 'old'}
+                data['listBefore'] = {'name': random.choice(LIST_NAMES)}
+                data['listAfter'] = {'name': random.choice(LIST_NAMES)}
+        if action_type == 'commentCard':
+            data['text'] = 'Comment %d' % number
+        if action_type == 'addAttachmentToCard':
+            data['attachment'] = {'name': 'file.png', 'url': 'http://file'}
+        if action_type == 'moveCardToBoard':
+            data['boardSource'] = {'id': 'other', 'name': 'Other'}
+        actions.append({
+            'id': 'action%06d' % number, 'type': action_type,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                  time.gmtime(1500000000 + number)),
+            'memberCreator': {'id': 'member', 'fullName': 'Some One'},
+            'data': data})
+    return actions[::-1]
+
+
+def synthetic_monitor(count):
+    """
+    Return `count` MONITOR entries for the board, with a mix of list name
+    patterns and include_actions.
+    """
+    entries = []
+    for number in range(count):
+        list_names = random.sample(LIST_NAMES, 3) + ['Sprint %d*' % number]
+        if number % 4 == 0:
+            list_names.append('*')
+        include_actions = ['all'] if number % 3 == 0 else \
+            random.sample(ACTION_TYPES + SUBTYPES, 5)
+        entries.append({'board_id': 'board', 'room_id': 'room%d' % number,
+                        'list_names': list_names,
+                        'include_actions': include_actions})
+    return entries
+
+
+def linear_scan(records, entry):
+    """
+    Route records the way notify() used to, checking every action against
+    every include_actions entry and list name pattern.
+    """
+    include_actions = entry['include_actions']
+    selected = []
+    for record in records:
+        action_type = record.action['type']
+        if not any(action_type == atype or atype.startswith(action_type + '-')
+                   or atype == 'all' for atype in include_actions):
+            continue
+        if record.action_type != 'default' and not any(
+                atype in ('all', action_type, record.action_type)
+                for atype in include_actions):
+            continue
+        if record.list_names and not any(
+                fnmatch.fnmatch(name, pattern)
+                for name in record.list_names
+                for pattern in entry['list_names']):
+            continue
+        selected.append(record)
+    return selected
+
+
+def best_of(runs, func):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-a', type=int, dest='actions', default=5000,
+                        help='Number of actions')
+    parser.add_argument('-e', type=int, dest='entries', default=200,
+                        help='Number of MONITOR entries')
+    parser.add_argument('-r', type=int, dest='runs', default=3,
+                        help='Number of runs to take the best of')
+    args = parser.parse_args()
+
+    random.seed(1)
+    config = BenchmarkConfig()
+    config.MONITOR = synthetic_monitor(args.entries)
+    actions = synthetic_actions(args.actions)
+
+    compile_time, routes = best_of(args.runs,
+                                   lambda: Route.from_config(config))
+    records = enrich_actions(config, actions, 'board', routes)
+    routed_time, routed = best_of(args.runs, lambda: [
+        route_records(records, route) for route in routes])
+    scanned_time, scanned = best_of(args.runs, lambda: [
+        linear_scan(records, entry) for entry in config.MONITOR])
+    if routed != scanned:
+        sys.exit('The two ways of routing disagree.')
+
+    decisions = len(records) * len(routes)
+    print('%d actions x %d entries, %d routed to rooms'
+          % (len(records), len(routes), sum(len(r) for r in routed)))
+    print('compiling routes:   %8.3fs' % compile_time)
+    print('compiled routes:    %8.3fs  (%.2f us per decision)'
+          % (routed_time, 1e6 * routed_time / decisions))
+    print('linear scan:        %8.3fs  (%.2f us per decision)'
+          % (scanned_time, 1e6 * scanned_time / decisions))
+    print('speedup:            %8.1fx' % (scanned_time / routed_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,10 +9,12 @@ setup(
     platforms = ["any"],
     description = ("Integration between Trello and HipChat: send Trello "
                    "activity notifications to HipChat rooms"),
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     entry_points={
         'console_scripts': [
             'trello-hipchat = trello_hipchat.cli:run_forever',
+            'trello-hipchat-webhook = trello_hipchat.webhook:run_webhook_server',
+            'trello-hipchat-replay = trello_hipchat.replay:main',
         ]
     },
 )
@@ -0,0 +1,96 @@
+"""
+Helpers shared by the tests: running the fake servers from replay.py, and
+making Trello actions for them to serve.
+"""
+import time
+import threading
+
+import trello_hipchat
+from trello_hipchat.replay import FakeTrello, FakeHipChat
+
+
+def start(fake):
+    """
+    Serve a fake (or any server with serve_forever()) from a daemon thread,
+    and return it.
+    """
+    server = getattr(fake, 'server', fake)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return fake
+
+
+def stop(fake):
+    server = getattr(fake, 'server', fake)
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(predicate, timeout=10, interval=0.02):
+    """
+    Wait until predicate() is true, and return whether it became true
+    before the timeout.
+    """
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def trello_date(timestamp):
+    """
+    Format a timestamp the way Trello formats action dates, with
+    milliseconds.
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def comment(number, board_id='board', when=None, list_name='Doing'):
+    """
+    Return a commentCard action, numbered so that each one is different.
+    """
+    if when is None:
+        when = 1500000000 + number
+    return {
+        'id': '%s-action%06d' % (board_id, number),
+        'type': 'commentCard',
+        'date': trello_date(when),
+        'memberCreator': {'id': 'member', 'fullName': 'Some One'},
+        'data': {'board': {'id': board_id, 'name': 'Board'},
+                 'card': {'id': 'card%d' % number,
+                          'name': 'Card %d' % number},
+                 'list': {'id': 'list', 'name': list_name},
+                 'text': 'Comment %d' % number},
+    }
+
+
+class FakeServersMixin(object):
+    """
+    A TestCase mixin that starts a fake Trello (as self.trello) and a fake
+    HipChat (as self.hipchat), and points the API URLs at them. The fake
+    HipChat is made with the class's hipchat_options.
+    """
+    hipchat_options = {}
+
+    def setUp(self):
+        super(FakeServersMixin, self).setUp()
+        self.trello = start(FakeTrello({}))
+        self.hipchat = start(FakeHipChat(**self.hipchat_options))
+        saved = (trello_hipchat.TRELLO_API_URL,
+                 trello_hipchat.HIPCHAT_API_URL)
+        trello_hipchat.TRELLO_API_URL = self.trello.url
+        trello_hipchat.HIPCHAT_API_URL = self.hipchat.url
+        trello_hipchat.lookup_cache.clear()
+
+        def restore():
+            (trello_hipchat.TRELLO_API_URL,
+             trello_hipchat.HIPCHAT_API_URL) = saved
+            stop(self.trello)
+            stop(self.hipchat)
+        self.addCleanup(restore)
+
+    def hipchat_rooms(self):
+        return [room_id for _, room_id, _ in self.hipchat.messages]
@@ -0,0 +1,78 @@
+"""
+Tests of stopping run_forever, run as a separate process against a fake
+Trello and a fake HipChat.
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+import unittest
+
+from .support import FakeServersMixin, wait_for, comment
+from .test_sharding import WORKER
+
+CONFIG = '''
+TRELLO_API_KEY = 'key'
+TRELLO_TOKEN = 'token'
+HIPCHAT_API_KEY = 'hipchat'
+HIPCHAT_COLOR = 'purple'
+MONITOR = [
+    {'board_id': 'board', 'room_id': 'room', 'list_names': ['*']},
+    {'board_id': 'board', 'room_id': 'digest', 'list_names': ['*'],
+     'digest_window': 600},
+]
+DELIVERY_WORKERS = 1
+HIPCHAT_ROOM_RATE = 2
+HIPCHAT_ROOM_BURST = 1
+BOARD_MIRROR = True
+'''
+
+
+class ShutdownTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        super(ShutdownTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        config_file = os.path.join(self.directory, 'config.py')
+        with open(config_file, 'w') as f:
+            f.write(CONFIG)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment = dict(os.environ, PYTHONPATH=root)
+        with open(os.devnull, 'w') as devnull:
+            self.worker = subprocess.Popen(
+                [sys.executable, '-c', WORKER, self.trello.url,
+                 self.hipchat.url, config_file, '-d', self.directory,
+                 '-i', '1'],
+                cwd=self.directory, env=environment, stdout=devnull,
+                stderr=devnull)
+        self.addCleanup(self.kill_worker)
+
+    def kill_worker(self):
+        if self.worker.poll() is None:
+            self.worker.kill()
+            self.worker.wait()
+
+    def messages_to(self, room_id):
+        return [message for _, room, message in self.hipchat.messages
+                if room == room_id]
+
+    def test_sends_and_saves_everything_on_sigterm(self):
+        now = time.time()
+        self.trello.publish('board', [comment(number, when=now)
+                                      for number in range(4)])
+        self.assertTrue(wait_for(lambda: self.messages_to('room')))
+        self.worker.send_signal(signal.SIGTERM)
+        self.assertEqual(self.worker.wait(), 0)
+
+        # The queued messages, and the digest whose window is still open.
+        self.assertEqual(len(self.messages_to('room')), 4)
+        self.assertEqual(len(self.messages_to('digest')), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    'boards.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests of the DeliveryQueue against a fake HipChat that throttles it: 429s
+with and without Retry-After, backoff after errors, and what each overflow
+policy does when the queue is full.
+"""
+import time
+import unittest
+
+from trello_hipchat import send_hipchat_message
+from trello_hipchat.delivery import DeliveryQueue
+
+from .support import FakeServersMixin, wait_for
+
+
+class ThrottledHipChatTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        super(ThrottledHipChatTest, self).setUp()
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        time.sleep(seconds)
+
+    def queue(self, **kwargs):
+        kwargs.setdefault('workers', 1)
+        kwargs.setdefault('room_rate', 100)
+        kwargs.setdefault('backoff_base', 0.05)
+        queue = DeliveryQueue(send=send_hipchat_message, sleep=self.sleep,
+                              **kwargs)
+        self.addCleanup(queue.close, 5)
+        return queue
+
+    def messages(self):
+        return [message for _, _, message in self.hipchat.messages]
+
+    def test_waits_as_long_as_retry_after_says(self):
+        queue = self.queue().start()
+        self.hipchat.fail(429, headers={'Retry-After': '1'})
+        queue.put('room', 'throttled', 'key')
+        queue.put('room', 'next', 'key')
+        queue.join()
+        self.assertEqual(self.messages(), ['throttled', 'next'])
+        waited = self.hipchat.messages[0][0] - self.hipchat.rejected[0][0]
+        self.assertGreaterEqual(waited, 0.9)
+        self.assertEqual(queue.stats()['sent'], 2)
+
+    def test_throttling_pauses_only_that_room(self):
+        queue = self.queue(workers=2).start()
+        # Rooms are spread over the workers by hash, so pick one that another
+        # worker handles.
+        fast = next(room_id for room_id in ('fast%d' % n for n in range(100))
+                    if hash(room_id) % 2 != hash('slow') % 2)
+        self.hipchat.fail(429, headers={'Retry-After': '2'})
+        queue.put('slow', 'throttled', 'key')
+        self.assertTrue(wait_for(lambda: self.hipchat.rejected))
+        queue.put(fast, 'not throttled', 'key')
+        self.assertTrue(wait_for(lambda: self.messages(), timeout=1))
+        self.assertEqual(self.messages(), ['not throttled'])
+        queue.join()
+        self.assertEqual(self.messages(), ['not throttled', 'throttled'])
+
+    def test_backs_off_without_retry_after(self):
+        queue = self.queue().start()
+        self.hipchat.fail(429)
+        self.hipchat.fail(503)
+        queue.put('room', 'message', 'key')
+        queue.join()
+        self.assertEqual(self.messages(), ['message'])
+        self.assertEqual(len(self.hipchat.rejected), 2)
+        # Each wait is at most backoff_base * 2 ** attempt.
+        self.assertTrue(self.sleeps)
+        self.assertTrue(all(0 <= seconds <= 0.1 for seconds in self.sleeps))
+
+    def test_gives_up_after_max_retries(self):
+        queue = self.queue(max_retries=2).start()
+        self.hipchat.fail(503, count=3)
+        queue.put('room', 'lost', 'key')
+        queue.put('room', 'sent', 'key')
+        queue.join()
+        self.assertEqual(self.messages(), ['sent'])
+        self.assertEqual(queue.stats()['failed'], 1)
+
+    def fill(self, queue):
+        """
+        Put five messages to one room in a queue whose worker is stuck behind
+        a Retry-After, returning how long putting them took.
+        """
+        self.hipchat.fail(429, headers={'Retry-After': '1'})
+        queue.start()
+        queue.put('room', 'message 0', 'key')
+        self.assertTrue(wait_for(lambda: self.hipchat.rejected))
+        start = time.time()
+        for number in range(1, 5):
+            queue.put('room', 'message %d' % number, 'key')
+        return time.time() - start
+
+    def test_block_waits_for_room_in_the_queue(self):
+        queue = self.queue(max_size=2, overflow='block')
+        self.assertGreaterEqual(self.fill(queue), 0.5)
+        queue.join()
+        self.assertEqual(self.messages(),
+                         ['message %d' % number for number in range(5)])
+        self.assertEqual(queue.stats()['dropped'], 0)
+
+    def test_drop_new_keeps_the_queued_messages(self):
+        queue = self.queue(max_size=2, overflow='drop-new')
+        self.assertLess(self.fill(queue), 0.5)
+        queue.join()
+        self.assertEqual(self.messages(),
+                         ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(queue.stats()['dropped'], 2)
+
+    def test_drop_oldest_keeps_the_newest_messages(self):
+        queue = self.queue(max_size=2, overflow='drop-oldest')
+        self.assertLess(self.fill(queue), 0.5)
+        queue.join()
+        self.assertEqual(self.messages(),
+                         ['message 0', 'message 3', 'message 4'])
+        self.assertEqual(queue.stats()['dropped'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+"""
+Tests of the digest messages that merge a burst of actions in a room.
+"""
+import unittest
+
+from trello_hipchat import ActionRecord, coalesce_groups
+from trello_hipchat.templates import RENDERERS
+
+from .support import trello_date
+
+
+def move(number, card_id):
+    record = ActionRecord({
+        'id': 'action%d' % number,
+        'type': 'updateCard',
+        'date': trello_date(1500000000 + number),
+        'memberCreator': {'id': 'member', 'fullName': 'Some One'},
+        'data': {},
+    }, 'board')
+    record.action_type = 'updateCard-move'
+    record.card = {'url': 'https://trello.com/c/%s/' % card_id,
+                   'name': 'Card %s' % card_id}
+    return record
+
+
+def digests(records):
+    return [message for message, _ in
+            coalesce_groups(records, 60, renderer=RENDERERS['text'])]
+
+
+class DigestTest(unittest.TestCase):
+    def test_counts_cards_not_actions(self):
+        self.assertEqual(
+            digests([move(0, 'a'), move(1, 'b'), move(2, 'a')]),
+            ['Some One moved 2 cards: Card a (https://trello.com/c/a/), '
+             'Card b (https://trello.com/c/b/).'])
+
+    def test_actions_on_one_card(self):
+        self.assertEqual(
+            digests([move(0, 'a'), move(1, 'a')]),
+            ['Some One made 2 changes to Card a (https://trello.com/c/a/).'])
+
+
+if __name__ == '__main__':
+    unittest.main()
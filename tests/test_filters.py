@@ -0,0 +1,189 @@
+"""
+Tests of filter specs: that each kind of condition (evaluated through the
+batch's indexes) picks the same actions as the equivalent filter function,
+and that dates, which Trello gives with milliseconds, compare correctly.
+"""
+import re
+import unittest
+
+from trello_hipchat.filters import filter_mask, FilterSpec, ActionBatch
+from trello_hipchat.routing import Route
+
+
+def action(date, action_type='commentCard'):
+    return {'id': date, 'type': action_type, 'date': date,
+            'memberCreator': {'id': 'member'}, 'data': {}}
+
+
+ACTIONS = [action('2020-01-30T23:59:59.000Z'),
+           action('2020-01-31T00:00:00.500Z'),
+           action('2020-01-31T23:59:59.999Z'),
+           action('2020-02-01T00:00:00.000Z')]
+
+
+class DateFilterTest(unittest.TestCase):
+    def test_dates_without_a_time(self):
+        self.assertEqual(
+            filter_mask(ACTIONS, [{'since': '2020-01-31',
+                                   'until': '2020-02-01'}]),
+            [False, True, True, False])
+
+    def test_dates_with_milliseconds(self):
+        self.assertEqual(
+            filter_mask(ACTIONS, [{'since': '2020-01-31T00:00:00.500Z'}]),
+            [False, True, True, True])
+        self.assertEqual(
+            filter_mask(ACTIONS, [{'until': '2020-01-31T23:59:59.999Z'}]),
+            [True, True, False, False])
+
+    def test_timestamps(self):
+        self.assertEqual(
+            filter_mask(ACTIONS, [{'since': 1580428800.5,
+                                   'until': 1580515200}]),
+            [False, True, True, False])
+
+    def test_excluded_dates(self):
+        self.assertEqual(
+            filter_mask(ACTIONS, [{'since': '2020-01-31',
+                                   'action_type': ['commentCard'],
+                                   'exclude': True}]),
+            [True, False, False, False])
+
+    def test_rejects_other_dates(self):
+        self.assertRaises(ValueError, FilterSpec, {'since': '31/01/2020'})
+
+
+
+def card_action(number, action_type, creator, card_name, labels=(),
+                **data):
+    """
+    Return an action on a card with the given labels (as (id, name) pairs).
+    """
+    data['card'] = {'id': 'card%d' % number, 'name': card_name,
+                    'idLabels': [label_id for label_id, _ in labels],
+                    'labels': [{'id': label_id, 'name': name}
+                               for label_id, name in labels]}
+    return {'id': 'action%d' % number, 'type': action_type,
+            'date': '2020-01-%02dT12:00:00.000Z' % (number + 1),
+            'idMemberCreator': creator,
+            'memberCreator': {'id': creator, 'fullName': creator},
+            'data': data}
+
+
+BUG = ('label1', 'bug')
+URGENT = ('label2', 'urgent')
+
+CARD_ACTIONS = [
+    card_action(0, 'commentCard', 'alice', 'Bug: login fails', [BUG],
+                text='Seen it too'),
+    card_action(1, 'updateCard', 'bob', 'Write the docs'),
+    card_action(2, 'addMemberToCard', 'alice', 'Write the docs',
+                idMember='carol'),
+    card_action(3, 'addLabelToCard', 'carol', 'Bug: crash on start',
+                [BUG, URGENT], label={'id': 'label2', 'name': 'urgent'}),
+    card_action(4, 'createCard', 'bob', 'Bug: typo', [URGENT]),
+    card_action(5, 'commentCard', 'carol', 'Release 2.0', text='Done'),
+    card_action(6, 'updateCard', 'dave', 'Bug: slow search'),
+]
+
+
+def members(A):
+    return set([A['idMemberCreator'], A['data'].get('idMember')])
+
+
+def labels(A):
+    card_labels = A['data']['card']['labels']
+    return (set(label['id'] for label in card_labels) |
+            set(label['name'] for label in card_labels))
+
+
+class IndexedFilterTest(unittest.TestCase):
+    """
+    Each spec is checked against a function that does the same, as the
+    filter benchmark does, over actions some of which pass and some don't.
+    """
+    def assert_same(self, spec, function):
+        expected = [bool(function(A)) for A in CARD_ACTIONS]
+        self.assertIn(True, expected)
+        self.assertIn(False, expected)
+        self.assertEqual(filter_mask(CARD_ACTIONS, [spec]), expected)
+        self.assertEqual(filter_mask(CARD_ACTIONS, [function]), expected)
+
+    def test_member(self):
+        self.assert_same({'member': 'alice'},
+                         lambda A: 'alice' in members(A))
+        # Members an action is about count too.
+        self.assert_same({'member': ['carol']},
+                         lambda A: 'carol' in members(A))
+
+    def test_label_by_id_or_name(self):
+        self.assert_same({'label': 'label1'},
+                         lambda A: 'label1' in labels(A))
+        self.assert_same({'label': ['urgent', 'nothing']},
+                         lambda A: 'urgent' in labels(A))
+
+    def test_card_name(self):
+        self.assert_same({'card_name': '^Bug'},
+                         lambda A: re.search('^Bug',
+                                             A['data']['card']['name']))
+
+    def test_action_type(self):
+        self.assert_same({'action_type': ['commentCard', 'createCard']},
+                         lambda A: A['type'] in ('commentCard',
+                                                 'createCard'))
+
+    def test_conditions_in_one_spec_all_apply(self):
+        self.assert_same({'member': ['alice', 'bob'], 'card_name': 'docs'},
+                         lambda A: (members(A) & set(['alice', 'bob']) and
+                                    'docs' in A['data']['card']['name']))
+
+    def test_exclude_with_sets(self):
+        self.assert_same({'label': 'bug', 'exclude': True},
+                         lambda A: 'bug' not in labels(A))
+        self.assert_same({'member': 'carol', 'action_type': 'commentCard',
+                          'exclude': True},
+                         lambda A: not ('carol' in members(A) and
+                                        A['type'] == 'commentCard'))
+
+    def test_exclude_with_sets_and_dates(self):
+        self.assert_same({'action_type': 'commentCard',
+                          'since': '2020-01-03', 'exclude': True},
+                         lambda A: not (A['type'] == 'commentCard' and
+                                        A['date'] >= '2020-01-03'))
+
+    def test_several_specs(self):
+        filters = [{'label': 'bug'}, {'member': 'bob', 'exclude': True}]
+        self.assertEqual(filter_mask(CARD_ACTIONS, filters),
+                         [True, False, False, True, False, False, False])
+
+
+class RouteFilterTest(unittest.TestCase):
+    def test_specs_mixed_with_functions(self):
+        seen = []
+
+        def not_urgent(A):
+            seen.append(A['id'])
+            return 'urgent' not in labels(A)
+
+        route = Route('board', 'room', ['*'],
+                      filters=[{'card_name': '^Bug'}, not_urgent,
+                               {'member': 'alice', 'exclude': True}])
+        batch = ActionBatch(CARD_ACTIONS)
+        positions = list(range(len(CARD_ACTIONS)))
+        self.assertEqual(route.select(batch, positions), [6])
+        # The specs go first, so the function only sees what they let by.
+        self.assertEqual(seen, ['action3', 'action4', 'action6'])
+        # The same as with functions only, and as filter_mask() says.
+        functions = [lambda A: re.search('^Bug', A['data']['card']['name']),
+                     not_urgent, lambda A: 'alice' not in members(A)]
+        self.assertEqual(filter_mask(CARD_ACTIONS, functions),
+                         filter_mask(CARD_ACTIONS, route.filters))
+        self.assertEqual(filter_mask(CARD_ACTIONS, route.filters),
+                         [position == 6 for position in positions])
+        # Selecting from only some of the batch's positions.
+        self.assertEqual(route.select(batch, [1, 2, 6]), [6])
+        self.assertEqual(route.select(batch, [0, 1, 2]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Tests of the lookups made for checklist actions, against a fake Trello.
+"""
+import unittest
+
+from trello_hipchat import enrich_actions, lookup_cache
+from trello_hipchat.routing import Route
+
+from .support import FakeServersMixin, trello_date
+
+
+class LookupConfig(object):
+    TRELLO_API_KEY = 'key'
+    TRELLO_TOKEN = 'token'
+    MONITOR = [{'board_id': 'board', 'room_id': 'room', 'list_names': ['*']}]
+
+
+def card_action(action_type, number, data):
+    data = dict(data, board={'id': 'board', 'name': 'Board'},
+                card={'id': 'card', 'name': 'Card'})
+    return {'id': 'action%d' % number, 'type': action_type,
+            'date': trello_date(1500000000 + number),
+            'memberCreator': {'id': 'member', 'fullName': 'Some One'},
+            'data': data}
+
+
+def renamed_and_checked():
+    """
+    Return a page of actions (newest first) that renames a card and then
+    checks an item on it.
+    """
+    return [
+        card_action('updateCheckItemStateOnCard', 2, {
+            'checklist': {'id': 'checklist', 'name': 'Checklist'},
+            'checkItem': {'name': 'Item', 'state': 'complete'}}),
+        card_action('updateCard', 1, {'old': {'name': 'Old'}}),
+    ]
+
+
+class PrefetchTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        self.trello.lookups.update({
+            '/checklists/checklist': {'id': 'checklist', 'idCard': 'card'},
+            '/cards/card': {'id': 'card', 'name': 'Card',
+                            'url': 'https://trello.com/c/card/'},
+            '/cards/card/list': {'id': 'list', 'name': 'Doing'},
+        })
+
+    def test_lookups_for_the_page_are_kept(self):
+        # The rename makes cached lookups of the card out of date, but not
+        # the ones prefetched for this page after it.
+        records = enrich_actions(LookupConfig(), renamed_and_checked(),
+                                 'board', Route.from_config(LookupConfig()))
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1].list_names, ('Doing',))
+        self.assertEqual(records[1].card['name'], 'Card')
+        self.assertEqual(dict(self.trello.calls), {'/batch': 2})
+
+    def test_older_lookups_are_looked_up_again_in_the_batch(self):
+        lookup_cache.put(('card', 'card'), {'name': 'Old', 'url': ''})
+        records = enrich_actions(LookupConfig(), renamed_and_checked(),
+                                 'board', Route.from_config(LookupConfig()))
+        self.assertEqual(records[1].card['name'], 'Card')
+        self.assertEqual(dict(self.trello.calls), {'/batch': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+"""
+Golden-file test: replay a small recorded corpus through the polling path
+and check that the messages haven't changed. After an intended change to
+the messages, update the golden file with
+
+    trello-hipchat-replay tests/data/corpus.jsonl \
+        -g tests/data/golden.txt --update-golden
+"""
+import io
+import os
+import unittest
+
+from trello_hipchat.replay import read_corpus, replay, render_output
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class GoldenReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.responses, self.lookups = read_corpus(
+            os.path.join(DATA, 'corpus.jsonl'))
+        with io.open(os.path.join(DATA, 'golden.txt'), encoding='utf-8',
+                     newline='') as f:
+            self.golden = f.read()
+
+    def test_messages_match_golden_file(self):
+        report = replay(self.responses, self.lookups)
+        self.assertEqual(render_output(report['output']), self.golden)
+
+    def test_board_mirror_gives_the_same_messages(self):
+        report = replay(self.responses, self.lookups, mirror=True)
+        self.assertEqual(render_output(report['output']), self.golden)
+
+
+if __name__ == '__main__':
+    unittest.main()
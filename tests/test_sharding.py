@@ -0,0 +1,141 @@
+"""
+Tests of several trello-hipchat workers sharing the boards (with --shard),
+run as separate processes against a fake Trello and a fake HipChat.
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+import unittest
+from collections import Counter
+
+from .support import FakeServersMixin, wait_for, comment
+
+# Runs run_forever() against the fake servers, whose URLs come first on the
+# command line.
+WORKER = '''
+import sys
+import trello_hipchat
+from trello_hipchat.cli import run_forever
+trello_hipchat.TRELLO_API_URL, trello_hipchat.HIPCHAT_API_URL = sys.argv[1:3]
+sys.argv[1:3] = []
+run_forever()
+'''
+
+CONFIG = '''
+TRELLO_API_KEY = 'key'
+TRELLO_TOKEN = 'token'
+HIPCHAT_API_KEY = 'hipchat'
+HIPCHAT_COLOR = 'purple'
+MONITOR = [{'board_id': 'board%d' % number, 'room_id': 'room%d' % number,
+            'list_names': ['*']} for number in range(BOARDS)]
+'''
+
+BOARDS = 12
+WORKERS = 3
+LEASE_TTL = 3
+
+
+class ShardedWorkersTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        super(ShardedWorkersTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config_file = os.path.join(self.directory, 'config.py')
+        with open(self.config_file, 'w') as f:
+            f.write('BOARDS = %d\n' % BOARDS + CONFIG)
+        self.workers = [self.start_worker(shard) for shard in range(WORKERS)]
+        self.published = 0
+
+    def start_worker(self, shard):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment = dict(os.environ, PYTHONPATH=root)
+        with open(os.devnull, 'w') as devnull:
+            worker = subprocess.Popen(
+                [sys.executable, '-c', WORKER, self.trello.url,
+                 self.hipchat.url, self.config_file, '-d', self.directory,
+                 '-i', '1', '--lease-ttl', str(LEASE_TTL),
+                 '--shard', '%d/%d' % (shard, WORKERS)],
+                cwd=self.directory, env=environment, stdout=devnull,
+                stderr=devnull)
+        self.addCleanup(self.stop_worker, worker)
+        return worker
+
+    def stop_worker(self, worker, sig=signal.SIGTERM):
+        if worker.poll() is None:
+            worker.send_signal(sig)
+            worker.wait()
+
+    def publish(self, per_board):
+        """
+        Make `per_board` new comments on every board, and return how many
+        messages there should be in all once they're reported.
+        """
+        now = time.time()
+        for board in range(BOARDS):
+            board_id = 'board%d' % board
+            self.trello.publish(board_id, [
+                comment(self.published + number, board_id, when=now)
+                for number in range(per_board)])
+        self.published += per_board
+        return self.published * BOARDS
+
+    def delivered(self):
+        return Counter((room_id, message)
+                       for _, room_id, message in self.hipchat.messages)
+
+    def assert_delivered_once(self, expected):
+        self.assertTrue(wait_for(lambda: len(self.hipchat.messages) >=
+                                 expected, timeout=30))
+        # Give any duplicates time to show up.
+        time.sleep(2)
+        delivered = self.delivered()
+        self.assertEqual(len(delivered), expected)
+        self.assertEqual(set(delivered.values()), set([1]))
+        self.assertEqual(set(room_id for room_id, _ in delivered),
+                         set('room%d' % board for board in range(BOARDS)))
+
+    def test_each_action_is_reported_once(self):
+        self.assert_delivered_once(self.publish(3))
+        self.assert_delivered_once(self.publish(3))
+
+    def test_boards_of_a_dead_worker_are_taken_over(self):
+        self.assert_delivered_once(self.publish(2))
+        self.stop_worker(self.workers[0], signal.SIGKILL)
+        self.assert_delivered_once(self.publish(2))
+
+        # And handed back when it returns.
+        self.workers[0] = self.start_worker(0)
+        time.sleep(LEASE_TTL)
+        self.assert_delivered_once(self.publish(2))
+
+
+# Imports the command-line interface as it would be on a platform without
+# fcntl, and tries to start sharding.
+WITHOUT_FCNTL = '''
+import sys
+sys.modules['fcntl'] = None
+import trello_hipchat.cli
+from trello_hipchat.sharding import ShardCoordinator
+try:
+    ShardCoordinator('.', 0, 2)
+except NotImplementedError:
+    sys.exit(0)
+sys.exit(1)
+'''
+
+
+class WithoutFcntlTest(unittest.TestCase):
+    def test_only_sharding_needs_fcntl(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment = dict(os.environ, PYTHONPATH=root)
+        self.assertEqual(subprocess.call([sys.executable, '-c',
+                                          WITHOUT_FCNTL],
+                                         env=environment), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
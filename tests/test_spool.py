@@ -0,0 +1,187 @@
+"""
+Tests of what happens to messages while HipChat is failing: the circuit
+breaker, the dead-letter spool, and sending what's in it once HipChat is
+back, against a fake HipChat that fails on request.
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from trello_hipchat import send_hipchat_message
+from trello_hipchat.transport import default_transport
+from trello_hipchat.delivery import DeliveryQueue
+from trello_hipchat.spool import DeadLetterSpool, spooling
+from trello_hipchat.sharding import ShardCoordinator
+from trello_hipchat.cli import replay_spools
+
+from .support import FakeServersMixin
+
+
+class FlakyHipChatTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        super(FlakyHipChatTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.spool = DeadLetterSpool(os.path.join(self.directory, 'spool'))
+        saved = (default_transport.failure_threshold,
+                 default_transport.reset_timeout)
+        default_transport.configure(failure_threshold=2, reset_timeout=0.2)
+        self.addCleanup(default_transport.configure, *((None, None) + saved))
+
+    def messages(self):
+        return [message for _, _, message in self.hipchat.messages]
+
+    def test_spools_undeliverable_messages_in_order(self):
+        send = spooling(send_hipchat_message, self.spool)
+        self.hipchat.fail(503)
+        self.hipchat.fail(None)
+        for number in range(4):
+            send('room%d' % number, 'message %d' % number, 'key')
+        # Two failures open the circuit, so the rest aren't even tried.
+        self.assertEqual(self.hipchat.calls['/v1/rooms/message'], 2)
+        self.assertEqual(len(self.spool), 4)
+
+        self.assertEqual(self.spool.replay(send_hipchat_message, 'key'), 0)
+        time.sleep(0.2)
+        self.assertEqual(self.spool.replay(send_hipchat_message, 'key'), 4)
+        self.assertEqual(self.messages(),
+                         ['message %d' % number for number in range(4)])
+        self.assertEqual(len(self.spool), 0)
+
+    def test_keeps_rooms_in_order_behind_spooled_messages(self):
+        send = spooling(send_hipchat_message, self.spool)
+        self.hipchat.fail(503)
+        send('room', 'first', 'key')
+        send('room', 'second', 'key')
+        send('other', 'elsewhere', 'key')
+        self.assertEqual(self.messages(), ['elsewhere'])
+        self.spool.replay(send_hipchat_message, 'key')
+        self.assertEqual(self.messages(), ['elsewhere', 'first', 'second'])
+
+    def test_discards_rejected_messages(self):
+        send = spooling(send_hipchat_message, self.spool)
+        self.hipchat.fail(400)
+        send('room', 'bad', 'key')
+        send('room', 'good', 'key')
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.messages(), ['good'])
+
+    def test_spool_survives_a_restart(self):
+        send = spooling(send_hipchat_message, self.spool)
+        self.hipchat.fail(503)
+        for number in range(3):
+            send('room', 'message %d' % number, 'key', color='red')
+        time.sleep(0.2)
+
+        spool = DeadLetterSpool(self.spool.directory)
+        self.assertEqual(len(spool), 3)
+        self.assertTrue(spool.waiting('room'))
+        self.assertEqual(spool.replay(send_hipchat_message, 'key'), 3)
+        self.assertEqual(self.messages(),
+                         ['message %d' % number for number in range(3)])
+
+    def test_delivery_queue_spools_what_it_gives_up_on(self):
+        queue = DeliveryQueue(workers=1, room_rate=100, max_retries=1,
+                              backoff_base=0.01, spool=self.spool).start()
+        self.addCleanup(queue.close, 5)
+        self.hipchat.fail(503, count=2)
+        queue.put('room', 'first', 'key')
+        queue.put('room', 'second', 'key')
+        queue.join()
+        self.assertEqual(queue.stats()['spooled'], 2)
+        self.assertEqual(self.messages(), [])
+
+        time.sleep(0.2)
+        self.spool.replay(send_hipchat_message, 'key')
+        self.assertEqual(self.messages(), ['first', 'second'])
+
+
+class OrphanedSpoolTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        super(OrphanedSpoolTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.now = 1000.0
+        self.workers = [ShardCoordinator(self.directory, shard, 2,
+                                         lease_ttl=10,
+                                         clock=lambda: self.now)
+                        for shard in range(2)]
+        self.spools = [DeadLetterSpool(worker.spool_directory())
+                       for worker in self.workers]
+        self.spools[1].put('room', 'left behind', {})
+
+    def test_live_workers_spool_is_left_to_it(self):
+        self.workers[1].heartbeat()
+        self.now = os.path.getmtime(self.workers[1]._lease_path(1))
+        self.assertEqual(replay_spools(self.spools[0], send_hipchat_message,
+                                       'key', self.workers[0]), 0)
+        self.assertEqual(self.hipchat.messages, [])
+
+    def test_dead_workers_spool_is_taken_over(self):
+        self.assertEqual(self.workers[0].orphaned_shards(), [1])
+        self.assertEqual(replay_spools(self.spools[0], send_hipchat_message,
+                                       'key', self.workers[0]), 1)
+        self.assertEqual([message for _, _, message in self.hipchat.messages],
+                         ['left behind'])
+
+        # When the dead worker comes back, it doesn't send it again.
+        self.assertEqual(replay_spools(self.spools[1], send_hipchat_message,
+                                       'key', self.workers[1]), 0)
+        self.assertEqual(len(self.spools[1]), 0)
+        self.assertEqual(len(self.hipchat.messages), 1)
+
+    def test_spool_being_sent_is_skipped(self):
+        lock = self.workers[1].lock_spool()
+        self.addCleanup(lock.release)
+        self.assertEqual(replay_spools(self.spools[0], send_hipchat_message,
+                                       'key', self.workers[0]), 0)
+        self.assertEqual(self.hipchat.messages, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class IdleConnectionTest(FakeServersMixin, unittest.TestCase):
+    """
+    A HipChat that closes connections after they've been idle for a moment,
+    so that every message after a pause goes to a pooled connection the
+    server has already closed.
+    """
+    hipchat_options = {'idle_timeout': 0.1}
+
+    def setUp(self):
+        super(IdleConnectionTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.spool = DeadLetterSpool(os.path.join(self.directory, 'spool'))
+        saved = (default_transport.failure_threshold,
+                 default_transport.reset_timeout)
+        default_transport.configure(failure_threshold=1, reset_timeout=0.2)
+        self.addCleanup(default_transport.configure, *((None, None) + saved))
+
+    def messages(self):
+        return [message for _, _, message in self.hipchat.messages]
+
+    def test_posts_on_a_new_connection_after_a_pause(self):
+        for number in range(3):
+            send_hipchat_message('room', 'message %d' % number, 'key')
+            time.sleep(0.3)
+        self.assertEqual(self.messages(),
+                         ['message %d' % number for number in range(3)])
+        self.assertTrue(default_transport.breaker(self.hipchat.url).allow())
+
+    def test_spool_drains_after_a_pause(self):
+        send = spooling(send_hipchat_message, self.spool)
+        send('room', 'first', 'key')
+        self.hipchat.fail(503)
+        send('room', 'second', 'key')
+        send('room', 'third', 'key')
+        self.assertEqual(len(self.spool), 2)
+
+        time.sleep(0.3)
+        self.assertEqual(self.spool.replay(send_hipchat_message, 'key'), 2)
+        self.assertEqual(self.messages(), ['first', 'second', 'third'])
+        self.assertFalse(self.spool.waiting('room'))
@@ -0,0 +1,52 @@
+"""
+Tests of one worker's StateStore taking over a board from another's.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from trello_hipchat.state import StateStore
+
+
+class AdoptTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.mine = self.store('mine.sqlite')
+        self.other = self.store('other.sqlite')
+
+    def store(self, name):
+        store = StateStore(os.path.join(self.directory, name))
+        self.addCleanup(store.close)
+        return store
+
+    def test_takes_the_position_of_a_store_ahead(self):
+        self.mine.record('board', 100, 'action1', ['action1'])
+        self.other.record('board', 200, 'action2', ['action1', 'action2'])
+        self.mine.adopt('board', [self.other.path])
+        self.assertEqual(self.mine.last_time('board'), 200)
+        self.assertTrue(self.mine.is_delivered('action2'))
+
+    def test_ignores_a_store_behind(self):
+        self.mine.record('board', 200, 'action2', ['action2'])
+        self.other.record('board', 100, 'action1', ['action1'])
+        self.other.mark_sent('board', ['action3'], 'room')
+        self.mine.adopt('board', [self.other.path])
+        self.assertEqual(self.mine.last_time('board'), 200)
+        self.assertFalse(self.mine.is_sent('action3', 'room'))
+
+    def test_takes_what_was_sent_from_an_unfinished_page(self):
+        # Both stores finished the same page, and then the other one sent
+        # part of the next page before it stopped.
+        self.mine.record('board', 100, 'action1', ['action1'])
+        self.other.record('board', 100, 'action1', ['action1'])
+        self.other.mark_sent('board', ['action2'], 'room')
+        self.mine.adopt('board', [self.other.path])
+        self.assertEqual(self.mine.last_time('board'), 100)
+        self.assertTrue(self.mine.is_sent('action2', 'room'))
+        self.assertFalse(self.mine.is_sent('action2', 'other room'))
+
+
+if __name__ == '__main__':
+    unittest.main()
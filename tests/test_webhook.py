@@ -0,0 +1,150 @@
+"""
+End-to-end tests of the webhook server, with a fake Trello posting actions
+to it and a fake HipChat receiving its messages.
+"""
+import shutil
+import tempfile
+import threading
+import unittest
+
+from trello_hipchat.spool import DeadLetterSpool
+from trello_hipchat.webhook import WebhookServer, register_webhooks
+
+from .support import FakeServersMixin, start, stop, wait_for, comment
+
+SECRET = 'secret'
+
+
+class WebhookConfig(object):
+    TRELLO_API_KEY = 'key'
+    TRELLO_TOKEN = 'token'
+    TRELLO_API_SECRET = SECRET
+    HIPCHAT_API_KEY = 'hipchat'
+    HIPCHAT_COLOR = 'purple'
+    MONITOR = [
+        {'board_id': 'board', 'room_id': 'room', 'list_names': ['*']},
+        {'board_id': 'board', 'room_id': 'digest', 'list_names': ['*'],
+         'digest_window': 1},
+    ]
+
+
+class ShortLinkConfig(WebhookConfig):
+    MONITOR = [{'board_id': 'short', 'room_id': 'room', 'list_names': ['*']}]
+
+
+class WebhookServerTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        super(WebhookServerTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spool = DeadLetterSpool(directory)
+        self.server = WebhookServer(('127.0.0.1', 0), WebhookConfig(), '',
+                                    spool=self.spool)
+        self.server.callback_url = ('http://127.0.0.1:%d/webhook'
+                                    % self.server.server_port)
+        start(self.server)
+        self.addCleanup(stop, self.server)
+
+        self.stopping = threading.Event()
+        maintainer = threading.Thread(target=self.server.maintain,
+                                      args=(self.stopping, 0.05))
+        maintainer.daemon = True
+        maintainer.start()
+        self.addCleanup(maintainer.join, 5)
+        self.addCleanup(self.stopping.set)
+
+        created = register_webhooks(WebhookConfig(), self.server.callback_url,
+                                    ['board'])
+        self.assertEqual(created, ['board'])
+
+    def messages_to(self, room_id):
+        return [message for _, room, message in self.hipchat.messages
+                if room == room_id]
+
+    def test_registers_each_board_once(self):
+        self.assertEqual(register_webhooks(WebhookConfig(),
+                                           self.server.callback_url,
+                                           ['board']), [])
+        self.assertEqual(len(self.trello.webhooks), 1)
+
+    def test_reports_posted_actions(self):
+        self.assertEqual(self.trello.post_webhooks('board', comment(1),
+                                                   SECRET), [200])
+        self.assertTrue(wait_for(lambda: self.messages_to('room')))
+        self.assertIn('Comment 1', self.messages_to('room')[0])
+
+    def test_rejects_bad_signatures(self):
+        self.assertEqual(self.trello.post_webhooks('board', comment(1),
+                                                   'wrong'), [401])
+        self.stopping.set()
+        self.assertEqual(self.hipchat.messages, [])
+
+    def test_merges_webhooks_into_digests(self):
+        for number in range(5):
+            action = comment(number, when=1500000000)
+            self.trello.post_webhooks('board', action, SECRET)
+        self.assertTrue(wait_for(lambda: self.messages_to('digest')))
+        self.assertTrue(wait_for(lambda: len(self.messages_to('room')) == 5))
+        self.assertEqual(len(self.messages_to('digest')), 1)
+
+    def test_spools_messages_hipchat_fails_to_take(self):
+        self.hipchat.fail(503)
+        self.trello.post_webhooks('board', comment(1), SECRET)
+        self.assertTrue(wait_for(lambda: self.hipchat.rejected))
+        self.assertTrue(wait_for(lambda: self.messages_to('room')))
+        self.assertEqual(len(self.hipchat.rejected), 1)
+        self.assertIn('Comment 1', self.messages_to('room')[0])
+        self.assertEqual(len(self.spool), 0)
+
+    def test_keeps_later_messages_in_order_behind_spooled_ones(self):
+        self.hipchat.fail(503, count=3)
+        for number in range(3):
+            self.trello.post_webhooks('board', comment(number), SECRET)
+            wait_for(lambda: len(self.hipchat.rejected) > number or
+                     len(self.spool) > number)
+        self.assertTrue(wait_for(lambda: len(self.messages_to('room')) == 3))
+        self.assertEqual([message.count('Comment %d' % number)
+                          for number, message
+                          in enumerate(self.messages_to('room'))],
+                         [1, 1, 1])
+
+    def test_reports_a_boards_actions_in_order(self):
+        for number in range(20):
+            self.trello.post_webhooks('board', comment(number), SECRET)
+        self.server.join()
+        self.assertTrue(wait_for(lambda: len(self.messages_to('room')) == 20))
+        self.assertEqual([message.rsplit(': ', 1)[1]
+                          for message in self.messages_to('room')],
+                         ['Comment %d' % number for number in range(20)])
+
+
+class ShortLinkTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        super(ShortLinkTest, self).setUp()
+        self.trello.lookups['/boards/short'] = {'id': 'fullboardid'}
+        self.server = WebhookServer(('127.0.0.1', 0), ShortLinkConfig(), '')
+        self.server.callback_url = ('http://127.0.0.1:%d/webhook'
+                                    % self.server.server_port)
+        start(self.server)
+        self.addCleanup(stop, self.server)
+        self.addCleanup(self.server.stop_workers, 5)
+
+    def test_registers_and_routes_by_full_id(self):
+        board_ids = list(self.server.routes_by_board)
+        self.assertEqual(board_ids, ['fullboardid'])
+        self.assertEqual(register_webhooks(ShortLinkConfig(),
+                                           self.server.callback_url,
+                                           board_ids), ['fullboardid'])
+        self.assertEqual(register_webhooks(ShortLinkConfig(),
+                                           self.server.callback_url,
+                                           board_ids), [])
+
+        action = comment(1, board_id='fullboardid')
+        self.assertEqual(self.trello.post_webhooks('fullboardid', action,
+                                                   SECRET), [200])
+        self.assertTrue(wait_for(lambda: self.hipchat.messages))
+        self.assertIn('Comment 1', self.hipchat.messages[0][2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,22 +4,55 @@ import sys
 import time
 import calendar
 import json
-import fnmatch
+import re
+import threading
 
 if sys.version_info[0] > 2:
     from urllib.parse import urlencode
-    from urllib.request import urlopen
-    from html import escape
 else:
-    from urllib import urlencode, urlopen
-    from cgi import escape as cgi_escape
-    escape = lambda string: cgi_escape(string, quote=True)
-
-from .messages import MESSAGES
+    from urllib import urlencode
+
+from .messages import MESSAGES, DIGEST_MESSAGES
+from .templates import compile_templates, join_names, Links, RENDERERS
+from .cache import LookupCache
+from .ratelimit import TokenBucket
+from .mirror import BoardMirror
+from . import transport
+from .routing import Route
+from .filters import ActionBatch
+from .metrics import registry
 
 #import logging
 #logger = logging.getLogger(__name__)
-    
+
+# The most GET requests that Trello's /batch endpoint accepts at once.
+BATCH_SIZE = 10
+
+# Where the APIs live. These only change when testing against fake servers.
+TRELLO_API_URL = 'https://api.trello.com/1'
+HIPCHAT_API_URL = 'https://api.hipchat.com/v1'
+
+# Matches an object ID in an API path, after the kind of object.
+ID_SEGMENT = re.compile(r'/(boards|cards|checklists|lists|tokens|webhooks)'
+                        r'/[^/]+')
+
+# How many actions to ask Trello for at a time, and the most to catch up on
+# for one board in one go.
+PAGE_SIZE = 50
+MAX_BACKLOG = 1000
+
+# Checklist, card and list lookups made while enriching actions go through
+# this cache.
+lookup_cache = LookupCache()
+
+# The local copy of the monitored boards, used before the lookup cache when
+# it's enabled.
+board_mirror = BoardMirror()
+
+# The TokenBucket every Trello request takes a token from, once
+# limit_trello_requests() has been called.
+trello_budget = None
+
 
 def to_trello_date(timestamp):
     """
@@ -37,20 +70,53 @@ def from_trello_date(string):
     return calendar.timegm(time.strptime(string, '%Y-%m-%dT%H:%M:%S.%fZ'))
 
 
-def trello(path, api_key, token=None, **kwargs):
+def endpoint(path):
     """
-    Make a request to the Trello API.
+    Return an API path with the IDs in it replaced by ':id', for grouping
+    metrics by endpoint.
     """
+    return ID_SEGMENT.sub(r'/\1/:id', path)
+
+
+def limit_trello_requests(budget):
+    """
+    Make trello() wait when it has to, so that at most `budget` requests
+    are made in any 10 seconds (or stop limiting them, if `budget` is None
+    or 0). Return the TokenBucket that requests are charged to, or None.
+    """
+    global trello_budget
+    trello_budget = TokenBucket(budget / 10.0, budget) if budget else None
+    return trello_budget
+
+
+def trello(path, api_key, token=None, method='GET', **kwargs):
+    """
+    Make a request to the Trello API, waiting first if the request budget
+    (see limit_trello_requests()) is used up.
+    """
+    budget = trello_budget
+    if budget is not None:
+        budget.wait()
     kwargs['key'] = api_key
     if token:
         kwargs['token'] = token
 
-    url = 'https://api.trello.com/1' + path + '?' + urlencode(kwargs)
-    req = urlopen(url)
-    data = req.read().decode('utf-8')
+    url = TRELLO_API_URL + path + '?' + urlencode(kwargs)
+    with registry.timer('trello_request_seconds', endpoint=endpoint(path)):
+        data = transport.request(method, url).decode('utf-8')
     return json.loads(data)
 
 
+def trello_batch(paths, api_key, token=None):
+    """
+    Make up to BATCH_SIZE GET requests to the Trello API in one round-trip,
+    using the /batch endpoint. Return a list with the response for each path,
+    in the same order, with None for any request that failed.
+    """
+    responses = trello('/batch', api_key, token, urls=','.join(paths))
+    return [response.get('200') for response in responses]
+
+
 def send_hipchat_message(room_id, message, api_key, color='purple', 
                          mtype='html', really=True):
     """
@@ -68,11 +134,13 @@ def send_hipchat_message(room_id, message, api_key, color='purple',
     }
 
     data = urlencode(data).encode('utf-8')
-    req = urlopen(
-        'https://api.hipchat.com/v1/rooms/message?format=json&auth_token=%s'
-        % api_key, data
-    )
-    req.read()
+    with registry.timer('hipchat_request_seconds', endpoint='/rooms/message'):
+        transport.request(
+            'POST',
+            HIPCHAT_API_URL + '/rooms/message?format=json&auth_token=%s'
+            % api_key, data,
+            {'Content-Type': 'application/x-www-form-urlencoded'}
+        )
 
 
 def trunc(string, maxlen=200):
@@ -85,196 +153,720 @@ def trunc(string, maxlen=200):
     return string
 
 
-def card_in_lists(name, list_names):
+def cached_trello(config, kind, object_id, path, cache=None):
     """
-    Return True if name matches any of the list_names (which can contain
-    some regular expression syntax (the same as what can be used in the Unix
-    shell)), otherwise False.
+    Make a GET request to the Trello API for the object of the given kind
+    and ID, answering it from the board mirror or the lookup cache if
+    possible.
     """
-    for filt in list_names:
-        if name == filt or fnmatch.fnmatch(name, filt):
-            return True
-    return False
+    if board_mirror.enabled:
+        value = board_mirror.get(kind, object_id)
+        if value is not None:
+            return value
+    if cache is None:
+        cache = lookup_cache
+    return cache.get_or_fetch(
+        (kind, object_id),
+        lambda: trello(path, api_key=config.TRELLO_API_KEY,
+                       token=config.TRELLO_TOKEN)
+    )
 
 
-def get_actions(config, last_time, board_id, include_actions=['all']):
+def prefetch_lookups(config, requests, cache=None):
     """
-    Get the list of actions from the Trello API, for a particular board.
-    Return the list of actions, the highest action ID, and the most recent
-    action time.
+    Given (kind, object_id, path) triples, look up all the ones that aren't
+    already cached or mirrored using as few batch requests as possible, and
+    store the results in the lookup cache. Lookups that fail are left out of
+    the cache, so cached_trello() will make them one at a time later.
+    """
+    if cache is None:
+        cache = lookup_cache
+    missing = []
+    for kind, object_id, path in requests:
+        if (kind, object_id) not in cache and \
+           board_mirror.peek(kind, object_id) is None and \
+           (kind, object_id, path) not in missing:
+            missing.append((kind, object_id, path))
+
+    for start in range(0, len(missing), BATCH_SIZE):
+        chunk = missing[start:start + BATCH_SIZE]
+        try:
+            responses = trello_batch([path for _, _, path in chunk],
+                                     config.TRELLO_API_KEY,
+                                     config.TRELLO_TOKEN)
+        except Exception:
+            continue
+        for (kind, object_id, _), response in zip(chunk, responses):
+            if response is not None:
+                cache.put((kind, object_id), response)
+
+
+def prefetch_checklist_lookups(config, actions, routes, cache=None):
+    """
+    Before rendering messages for a list of actions, resolve the checklist,
+    card and list of every checklist action among them that any of the
+    routes include in batches, rather than one request at a time.
+    """
+    if cache is None:
+        cache = lookup_cache
+    checklist_ids = []
+    for A in actions:
+        if 'checklist' in A['data'] and \
+           A['type'] != 'removeChecklistFromCard' and \
+           any(route.includes_base_type(A['type']) for route in routes):
+            checklist_ids.append(A['data']['checklist']['id'])
+    if not checklist_ids:
+        return
+
+    prefetch_lookups(config, [('checklist', checklist_id,
+                               '/checklists/%s' % checklist_id)
+                              for checklist_id in checklist_ids], cache)
+
+    card_requests = []
+    for checklist_id in checklist_ids:
+        info = (board_mirror.peek('checklist', checklist_id) or
+                cache.peek(('checklist', checklist_id)))
+        if info is not None:
+            card_id = info['idCard']
+            card_requests.append(('card', card_id, '/cards/%s' % card_id))
+            card_requests.append(('card-list', card_id,
+                                  '/cards/%s/list' % card_id))
+    prefetch_lookups(config, card_requests, cache)
+
+
+def invalidate_lookups(action, cache=None):
+    """
+    Forget cached lookups that this action makes out of date, such as the
+    name of a card that it renames or the list of a card that it moves.
+    """
+    if cache is None:
+        cache = lookup_cache
+    action_type = action['type']
+    data = action['data']
+    if action_type in ('updateCard', 'moveCardFromBoard', 'moveCardToBoard',
+                       'deleteCard') and 'card' in data:
+        card_id = data['card']['id']
+        cache.invalidate(('card', card_id))
+        cache.invalidate(('card-list', card_id))
+    elif action_type in ('updateList', 'moveListFromBoard',
+                         'moveListToBoard') and 'list' in data:
+        list_id = data['list']['id']
+        cache.invalidate_where(
+            lambda key, value: key[0] == 'card-list' and
+            value.get('id') == list_id)
+    elif action_type == 'removeChecklistFromCard' and 'checklist' in data:
+        cache.invalidate(('checklist', data['checklist']['id']))
+
+
+def mirror_board(config, board_id, mirror=None):
+    """
+    Load a board's lists, cards and checklists into the board mirror. If
+    that fails, the mirror waits a while before trying again, and lookups
+    go to the API meanwhile.
+    """
+    if mirror is None:
+        mirror = board_mirror
+    try:
+        board = trello('/boards/%s' % board_id,
+                       api_key=config.TRELLO_API_KEY,
+                       token=config.TRELLO_TOKEN,
+                       fields='name', lists='all', list_fields='name',
+                       cards='all', card_fields='name,url,idList',
+                       checklists='all', checklist_fields='name,idCard')
+    except Exception:
+        mirror.snapshot_failed(board_id)
+        return
+    mirror.load_snapshot(board_id, board)
+
+
+def coalesce_groups(records, window, by='action_type',
+                    renderer=RENDERERS['html']):
+    """
+    Given a chronological list of ActionRecords, merge the ones that share an
+    action type (or, if `by` is 'card', the same card) and happened within
+    `window` seconds of the first one in their group into digests.
+
+    Return a list of pairs of each message, rendered by the renderer, and
+    the records it reports, in the order of the first action of each group.
+    A group of one action just gets its usual message.
+    """
+    groups = []
+    open_groups = {}
+    for record in records:
+        if by == 'card':
+            key = record.card and record.card['url']
+        else:
+            key = record.action_type
+        group = open_groups.get(key)
+        if key is None or group is None or \
+           record.timestamp - group[0] > window:
+            group = (record.timestamp, [])
+            groups.append(group)
+            if key is not None:
+                open_groups[key] = group
+        group[1].append(record)
+
+    rendered = []
+    for _, entries in groups:
+        if len(entries) == 1:
+            rendered.append((entries[0].render(renderer), entries))
+            continue
+        action_type = entries[0].action_type
+        card_links = Links((record.card['url'], record.card['name'])
+                           for record in entries if record.card)
+        card_count = len(set(url for url, _ in card_links))
+        digest_params = {
+            'action_type': action_type,
+            'count': len(entries),
+            'card_count': card_count,
+            'authors': join_names(FIELDS['author'](record.action, record)
+                                  for record in entries),
+            'cards': card_links,
+        }
+        if by == 'card':
+            template = DIGEST_TEMPLATES['card']
+        elif action_type in DIGEST_TEMPLATES and card_links:
+            template = DIGEST_TEMPLATES[action_type]
+            # Several moves of one card aren't "1 cards".
+            if card_count == 1 and 'card_count' in template.fields:
+                template = DIGEST_TEMPLATES['card']
+        else:
+            template = DIGEST_TEMPLATES['default']
+        rendered.append((renderer.render(template, digest_params), entries))
+    return rendered
+
+
+class DigestBuffer(object):
+    """
+    Holds the records selected for routes with a digest_window, so that
+    actions reported in different polls, pages or webhooks can still be
+    merged into one digest.
+
+    A route's records are held from the time the first of them is added
+    until `digest_window` seconds later, and then coalesced and sent
+    together. flush() has to be called regularly to send the ones that are
+    due. Records still held when the process stops are lost, like messages
+    in a DeliveryQueue.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entry[1]) for entry in self._pending.values())
+
+    def add(self, route, records, deliver):
+        """
+        Hold records for a route, to be passed to `deliver` (a function
+        taking the route and a chronological list of records) when the
+        route's window closes.
+        """
+        if not records:
+            return
+        with self._lock:
+            entry = self._pending.get(route)
+            if entry is None:
+                entry = self._pending[route] = [self.clock(), [], deliver]
+            entry[1].extend(records)
+            entry[2] = deliver
+
+    def next_due(self):
+        """
+        Return the time when the next held records are due, or None if
+        there are none.
+        """
+        with self._lock:
+            if not self._pending:
+                return None
+            return min(started + route.digest_window
+                       for route, (started, _, _) in self._pending.items())
+
+    def flush(self, force=False):
+        """
+        Deliver the records of every route whose window has closed (or of
+        every route, if `force` is True).
+        """
+        now = self.clock()
+        with self._lock:
+            due = [(route, entry) for route, entry in self._pending.items()
+                   if force or now - entry[0] >= route.digest_window]
+            for route, _ in due:
+                del self._pending[route]
+        for route, (_, records, deliver) in due:
+            records.sort(key=lambda record: record.timestamp)
+            deliver(route, records)
+
+
+def iter_action_pages(config, last_time, board_id, include_actions=['all'],
+                      page_size=PAGE_SIZE, max_backlog=MAX_BACKLOG,
+                      seen=None):
+    """
+    Get the actions on a board since last_time from the Trello API, a page at
+    a time. Trello returns actions newest first, so this walks back through
+    them with `before=` cursors until it reaches last_time, or until it has
+    seen max_backlog actions (None for no limit).
+
+    Trello's dates only go down to the second, so actions in the same second
+    as last_time could be new or old. If `seen` is given, it's called with
+    the ID of every action fetched to tell which ones were already reported
+    (which also catches ones after last_time that were reported by a worker
+    that stopped before recording them); otherwise actions in the same
+    second are all assumed to be old.
+
+    Yield the pages oldest first, each in Trello's newest-first order, so
+    that reporting them page by page keeps them in chronological order and
+    progress can be saved after each one.
     """
     since = to_trello_date(last_time)
-    sys.stdout.flush()
-    actions = trello(
-        '/boards/%s/actions' % board_id,
-        filter=','.join([a[:a.index('-')] if '-' in a else a
-                         for a in include_actions]),
-        since=since,
-        api_key=config.TRELLO_API_KEY,
-        token=config.TRELLO_TOKEN
-    )
+    action_filter = ','.join([a[:a.index('-')] if '-' in a else a
+                              for a in include_actions])
+    pages = []
+    collected = 0
+    before = None
+    while max_backlog is None or collected < max_backlog:
+        kwargs = {'filter': action_filter, 'since': since, 'limit': page_size}
+        if before is not None:
+            kwargs['before'] = before
+        page = trello(
+            '/boards/%s/actions' % board_id,
+            api_key=config.TRELLO_API_KEY,
+            token=config.TRELLO_TOKEN,
+            **kwargs
+        )
 
-    # Ignore actions older than last_time
-    actions = [A for A in actions if from_trello_date(A['date']) > last_time]
+        if registry.enabled:
+            for A in page:
+                registry.inc('actions_fetched_total', type=A['type'])
+
+        # Ignore actions older than last_time, and ones already reported.
+        fresh = []
+        reached = False
+        for A in page:
+            action_time = from_trello_date(A['date'])
+            if action_time < last_time or \
+               (action_time == last_time and seen is None):
+                reached = True
+                break
+            if seen is None or not seen(A['id']):
+                fresh.append(A)
+        if max_backlog is not None:
+            fresh = fresh[:max_backlog - collected]
+        if fresh:
+            pages.append(fresh)
+            collected += len(fresh)
+        if len(page) < page_size or reached:
+            break
+        before = page[-1]['id']
+
+    for page in reversed(pages):
+        yield page
+
+
+def get_actions(config, last_time, board_id, include_actions=['all'],
+                max_backlog=MAX_BACKLOG):
+    """
+    Get the list of actions from the Trello API, for a particular board.
+    Return the list of actions and the most recent action time.
+    """
+    pages = list(iter_action_pages(config, last_time, board_id,
+                                   include_actions, max_backlog=max_backlog))
+    actions = [A for page in reversed(pages) for A in page]
 
-    # Compute the most recent time and action ID
+    # Compute the most recent time
     new_last_time = max([from_trello_date(A['date']) for A in actions] +
                         [last_time])
 
     return (actions, new_last_time)
 
 
-def notify(config, actions, board_id, room_id, list_names,
-           debug=False, include_actions=['all'], filters=[]):
+def poll_board(config, board_id, routes, last_time, max_backlog=MAX_BACKLOG,
+               debug=False, send=None, seen=None, digests=None, ledger=None):
     """
-    Given a list of actions, report all of the relevant ones to the HipChat
-    room.
+    Report the actions on a board since last_time to every route that
+    subscribes to it, a page at a time. This is a generator that yields the
+    time of the most recent reported action and the page of actions itself
+    after each page, so the caller can save its progress. See
+    iter_action_pages() for what `seen` does, and fan_out() for `digests`
+    and `ledger`.
+    """
+    for page in iter_action_pages(config, last_time, board_id,
+                                  max_backlog=max_backlog, seen=seen):
+        with registry.timer('notify_seconds', board=board_id):
+            records = enrich_actions(config, page, board_id, routes)
+            fan_out(config, records, routes, debug=debug, send=send,
+                    digests=digests, ledger=ledger)
+        last_time = max([from_trello_date(A['date']) for A in page] +
+                        [last_time])
+        yield last_time, page
+
+
+# Functions that work out the subtype to render an action as, for the action
+# types that have them. Each one takes the action and the ActionRecord being
+# built, and returns the action type with its subtype.
+
+def _rename_or_archive_subtype(A, record):
+    """
+    Handle renaming and (un)archiving, which cards, lists and checklists
+    share. Return None for other kinds of updates.
+    """
+    old = A['data']['old']
+    if 'name' in old:
+        return A['type'] + '-rename'
+    if 'closed' in old and A['type'] != 'updateChecklist':
+        if old['closed']:
+            return A['type'] + '-unarchive'
+        return A['type'] + '-archive'
+    return None
+
+
+def _update_card_subtype(A, record):
+    action_type = _rename_or_archive_subtype(A, record)
+    if action_type is not None:
+        return action_type
+    old = A['data']['old']
+    if 'idList' in old:
+        # Move between lists, which is relevant to either list
+        record.list_names = (A['data']['listBefore']['name'],
+                             A['data']['listAfter']['name'])
+        return 'updateCard-move'
+    elif 'desc' in old:
+        return 'updateCard-description'
+    # Some other type of card update
+    return 'updateCard'
+
+
+def _update_list_subtype(A, record):
+    return _rename_or_archive_subtype(A, record) or 'updateList'
+
+
+def _update_checklist_subtype(A, record):
+    # There's no template for other checklist updates.
+    return _rename_or_archive_subtype(A, record) or 'default'
+
+
+def _check_item_subtype(A, record):
+    if A['data']['checkItem']['state'] == 'complete':
+        return A['type'] + '-check'
+    return A['type'] + '-uncheck'
+
+
+SUBTYPES = {
+    'updateCard': _update_card_subtype,
+    'updateList': _update_list_subtype,
+    'updateChecklist': _update_checklist_subtype,
+    'updateCheckItemStateOnCard': _check_item_subtype,
+}
+
+
+def _squeeze(text):
+    # Collapse whitespace and cut long text short.
+    return trunc(' '.join(text.split()))
+
+
+# How to produce each message template parameter, given the action and its
+# ActionRecord. Values are raw; they are escaped when the message is
+# rendered. A parameter is only produced if the action's template uses it.
+FIELDS = {
+    'author': lambda A, record: A['memberCreator']['fullName'],
+    'action_type': lambda A, record: A['type'],
+    'card_url': lambda A, record: record.card['url'],
+    'card_name': lambda A, record: record.card['name'],
+    'list_name': lambda A, record: record.list_names[0],
+    'checklist_name': lambda A, record: A['data']['checklist']['name'],
+    'board_name': lambda A, record: A['data']['board']['name'],
+    'board_url': lambda A, record: ('https://trello.com/b/%s/' %
+                                    record.board_id),
+    'text': lambda A, record: _squeeze(A['data']['text']),
+    'member': lambda A, record: A['member']['fullName'],
+    # TODO: send the attachment if it's an image?
+    'attachment_name': lambda A, record: A['data']['attachment']['name'],
+    'attachment_url': lambda A, record: A['data']['attachment']['url'],
+    'old_name': lambda A, record: A['data']['old']['name'],
+    'old_list': lambda A, record: A['data']['listBefore']['name'],
+    'new_list': lambda A, record: A['data']['listAfter']['name'],
+    'description': lambda A, record: _squeeze(A['data']['card']['desc']),
+    'attribute': lambda A, record: list(A['data']['old'])[0],
+    'to_board_url': lambda A, record: ('https://trello.com/b/%s/' %
+                                       A['data']['boardTarget']['id']),
+    'to_board_name': lambda A, record: A['data']['boardTarget']['name'],
+    'from_board_url': lambda A, record: ('https://trello.com/b/%s/' %
+                                         A['data']['boardSource']['id']),
+    'from_board_name': lambda A, record: A['data']['boardSource']['name'],
+    'item_name': lambda A, record: A['data']['checkItem']['name'],
+}
+
+# The parameters coalesce_groups() gives digest templates.
+DIGEST_FIELDS = ('action_type', 'count', 'card_count', 'authors', 'cards')
+
+# The templates, compiled (and checked against FIELDS) once at import time.
+TEMPLATES = compile_templates(MESSAGES, FIELDS)
+DIGEST_TEMPLATES = compile_templates(DIGEST_MESSAGES, DIGEST_FIELDS)
+
+
+class ActionRecord(object):
     """
+    An action, enriched once for every room that subscribes to its board.
+
+    `action` is the raw action from Trello (which filters are applied to),
+    `board_id` the board it was reported on, `action_type` the type to
+    render it as (possibly with a subtype), `card` the card it's on (with at
+    least a 'url' and a 'name'), if any, and `list_names` the names of the
+    lists it happened in; a room whose list patterns match any of them gets
+    the action.
+
+    The message parameters are only produced when the action is first
+    rendered, and only the ones its template uses.
+    """
+    __slots__ = ('action', 'board_id', 'action_type', 'card', 'list_names',
+                 'timestamp', '_params', '_rendered')
+
+    def __init__(self, action, board_id):
+        self.action = action
+        self.board_id = board_id
+        self.action_type = action['type']
+        self.card = None
+        self.list_names = ()
+        self.timestamp = from_trello_date(action['date'])
+        self._params = None
+        self._rendered = None
+
+    @property
+    def template(self):
+        return TEMPLATES[self.action_type]
+
+    @property
+    def params(self):
+        """
+        The raw values of the parameters the action's template uses.
+        """
+        if self._params is None:
+            A = self.action
+            self._params = dict((name, FIELDS[name](A, self))
+                                for name in self.template.fields)
+        return self._params
+
+    def render(self, renderer=RENDERERS['html']):
+        """
+        Return the message for the action in the renderer's format, which is
+        only rendered once no matter how many rooms it goes to.
+        """
+        if self._rendered is None:
+            self._rendered = {}
+        message = self._rendered.get(renderer.name)
+        if message is None:
+            message = renderer.render(self.template, self.params)
+            self._rendered[renderer.name] = message
+        return message
+
+
+def enrich_actions(config, actions, board_id, routes):
+    """
+    Turn a list of actions on a board (newest first, as Trello returns them)
+    into a chronological list of ActionRecords, making whatever API lookups
+    they need once no matter how many routes they go to. Actions that none
+    of the routes could include are left out.
+    """
+    # Bring the board's mirror (if it's enabled) up to date with these
+    # actions, and forget the cached lookups they make out of date. Then
+    # look up everything else the checklist actions need first, so it can be
+    # done in a few batch requests (and isn't forgotten again).
+    if board_mirror.enabled:
+        if board_mirror.needs_snapshot(board_id):
+            mirror_board(config, board_id)
+        for A in reversed(actions):
+            board_mirror.apply(A, board_id)
+    for A in reversed(actions):
+        invalidate_lookups(A)
+    prefetch_checklist_lookups(config, actions, routes)
+
+    records = []
     # Iterate over the actions, in reverse order because of chronology.
     for A in reversed(actions):
         action_type = A['type']
 
         # If we can already tell that this isn't an action type to include,
         # ignore it.
-        if not any(action_type==atype or atype.startswith(action_type+'-')
-                   for atype in include_actions):
+        if not any(route.includes_base_type(action_type) for route in routes):
             continue
 
-        # If this doesn't pass the filters, ignore it.
-        if not all(f(A) for f in filters):
-            continue
-
-        params = {'author': escape(A['memberCreator']['fullName']),
-                  'action_type': action_type}
+        record = ActionRecord(A, board_id)
 
-        # Basic info for applicable card/list/checklist/board
+        # Basic info for applicable card/list/checklist
 
         if 'card' in A['data'] and action_type != 'deleteCard':
             card_id = A['data']['card']['id']
-            params['card_url'] = ('https://trello.com/c/%s/' % card_id)
-            params['card_name'] = escape(A['data']['card']['name'])
+            record.card = {'url': 'https://trello.com/c/%s/' % card_id,
+                           'name': A['data']['card']['name']}
 
         if 'list' in A['data']:
-            params['list_name'] = escape(A['data']['list']['name'])
+            record.list_names = (A['data']['list']['name'],)
 
-        if 'checklist' in A['data']:
-            params['checklist_name'] = escape(A['data']['checklist']['name'])
-            if action_type != 'removeChecklistFromCard':
+        if 'checklist' in A['data'] and \
+           action_type != 'removeChecklistFromCard':
+            try:
                 # get card info
-                info = trello(
-                    '/checklists/%s' % A['data']['checklist']['id'],
-                    api_key=config.TRELLO_API_KEY,
-                    token=config.TRELLO_TOKEN
-                )
+                checklist_id = A['data']['checklist']['id']
+                info = cached_trello(config, 'checklist', checklist_id,
+                                     '/checklists/%s' % checklist_id)
                 card_id = info['idCard']
-                card_info = trello(
-                    '/cards/%s' % card_id,
-                    api_key=config.TRELLO_API_KEY,
-                    token=config.TRELLO_TOKEN
-                )
-                params['card_url'] = card_info['url']
-                params['card_name'] = escape(card_info['name'])
+                card = cached_trello(config, 'card', card_id,
+                                     '/cards/%s' % card_id)
                 # get list info
-                list_info = trello(
-                    '/cards/%s/list' % card_id,
-                    api_key=config.TRELLO_API_KEY,
-                    token=config.TRELLO_TOKEN
-                )
-                params['list_name'] = escape(list_info['name'])
-
-        if 'board' in A['data']:
-            params['board_name'] = escape(A['data']['board']['name'])
-            params['board_url'] = 'https://trello.com/b/%s/' % board_id
+                list_info = cached_trello(config, 'card-list', card_id,
+                                          '/cards/%s/list' % card_id)
+            except transport.HTTPError as e:
+                if e.status == 429 or e.status >= 500:
+                    raise
+                # The checklist or its card has been deleted since (or
+                # can't be seen), so make do with the card the action names,
+                # and don't filter it by list. Without a card there's
+                # nothing to report, but the rest of the page still is.
+                if record.card is None:
+                    continue
+            else:
+                record.card = card
+                record.list_names = (list_info['name'],)
 
-        # If this action is in a list that's not relevant, ignore it
-        if 'list_name' in params and \
-           not card_in_lists(params['list_name'], list_names):
-            continue
+        # Work out the subtype for action types that have them. If this is an
+        # action that we haven't written a template for yet, use the default
+        # one.
+        subtype = SUBTYPES.get(action_type)
+        if subtype is not None:
+            record.action_type = subtype(A, record)
+        elif action_type not in TEMPLATES:
+            record.action_type = 'default'
 
-        # Construct message parameters for specific action types
+        records.append(record)
+    return records
 
-        if action_type == 'commentCard':
-            params['text'] = trunc(escape(' '.join(A['data']['text'].split())))
 
-        elif action_type in ('addMemberToCard', 'removeMemberFromCard'):
-            params['member'] = A['member']['fullName']
+def route_records(records, route, batch=None):
+    """
+    Return the records, out of a chronological list of ActionRecords, that
+    should be reported to the route's room.
 
-        elif action_type == 'addAttachmentToCard':
-            params['attachment_name'] = escape(A['data']['attachment']['name'])
-            params['attachment_url'] = A['data']['attachment']['url']
-            # TODO: send the attachment if it's an image?
+    The route's filters are evaluated over all the records that get that far
+    at once. `batch` can be an ActionBatch of the records' actions to share
+    between several routes.
+    """
+    positions = []
+    for position, record in enumerate(records):
+        # If this isn't an action type to include, ignore it. Check both the
+        # Trello action type and the subtype.
+        if not route.includes_base_type(record.action['type']):
+            continue
+        if record.action_type != 'default' and \
+           not route.includes(record.action_type):
+            continue
 
-        elif action_type in ('updateCard', 'updateList', 'updateChecklist') \
-             and 'name' in A['data']['old']:
-            # Rename a card, list, or checklist
-            params['old_name'] = escape(A['data']['old']['name'])
-            action_type += '-rename'
+        # If this action is in a list that's not relevant, ignore it
+        if record.list_names and \
+           not any(route.matches_list(name) for name in record.list_names):
+            continue
 
-        elif action_type in ('updateCard', 'updateList') \
-             and 'closed' in A['data']['old']:
-            # Archive a card or list
-            if A['data']['old']['closed']:
-                action_type += '-unarchive'
-            else:
-                action_type += '-archive'
+        positions.append(position)
 
-        elif action_type == 'updateCard':
-            if 'idList' in A['data']['old']:
-                # Move between lists
-                old_list_name = A['data']['listBefore']['name']
-                new_list_name = A['data']['listAfter']['name']
+    # Ignore the ones that don't pass the filters.
+    if route.filters and positions:
+        if batch is None:
+            batch = ActionBatch([record.action for record in records])
+        positions = route.select(batch, positions)
+    return [records[position] for position in positions]
 
-                if not (card_in_lists(old_list_name, list_names) or
-                        card_in_lists(new_list_name, list_names)):
-                    continue
-                params['old_list'] = escape(old_list_name)
-                params['new_list'] = escape(new_list_name)
-                action_type += '-move'
-            elif 'desc' in A['data']['old']:
-                action_type += '-description'
-                params['description'] = trunc(escape(
-                    ' '.join(A['data']['card']['desc'].split())))
-            else:
-                # Some other type of card update
-                params['attribute'] = list(A['data']['old'])[0]
-
-        elif action_type in ('moveCardFromBoard', 'moveListFromBoard'):
-            params['to_board_url'] = ('https://trello.com/b/%s/' %
-                                      A['data']['boardTarget']['id'])
-            params['to_board_name'] = escape(A['data']['boardTarget']['name'])
-
-        elif action_type in ('moveCardToBoard', 'moveListToBoard'):
-            params['from_board_url'] = ('https://trello.com/b/%s/' %
-                                        A['data']['boardSource']['id'])
-            params['from_board_name'] = escape(A['data']['boardSource']['name'])
-
-        elif action_type == 'updateCheckItemStateOnCard':
-            params['item_name'] = escape(A['data']['checkItem']['name'])
-            if A['data']['checkItem']['state'] == 'complete':
-                action_type += '-check'
-            else:
-                action_type += '-uncheck'
 
-        elif action_type == 'updateList':
-            params['attribute'] = list(A['data']['old'])[0]
+def count_routed(records, selected):
+    """
+    Count, by action type, how many of the records a route selected to send
+    and how many it filtered out.
+    """
+    sent = set(id(record) for record in selected)
+    for record in records:
+        if id(record) in sent:
+            registry.inc('actions_sent_total', type=record.action_type)
+        else:
+            registry.inc('actions_filtered_total', type=record.action_type)
 
-        elif action_type in ('createCard', 'deleteCard', 'createList',
-                             'addChecklistToCard', 'removeChecklistFromCard'):
-            # We have a message template for this action type, but there are
-            # no additional parameters we need to get.
-            pass
 
+def fan_out(config, records, routes, debug=False, send=None, digests=None,
+            ledger=None):
+    """
+    Report a chronological list of ActionRecords from one board to the room
+    of every route that subscribes to it.
+
+    If a route has a digest_window, actions of the same type (or on the same
+    card, if its digest_by is 'card') within digest_window seconds of each
+    other are reported as one digest message. With a DigestBuffer as
+    `digests`, the records are held in it until the window closes, so that
+    they can be merged with ones from later calls; otherwise only records
+    from this call are merged.
+
+    With a `ledger` (such as a StateStore), each action is recorded as sent
+    to a room as soon as its message is sent (or queued), and actions it
+    says were already sent to a room aren't sent there again.
+
+    Messages are rendered in each route's format (see templates.RENDERERS),
+    and sent with the config's SEND_MESSAGE function if it has one, or else
+    send_hipchat_message(), unless another function that takes the same
+    arguments is given as `send` (such as the put() method of a
+    DeliveryQueue).
+    """
+    if send is None:
+        send = getattr(config, 'SEND_MESSAGE', send_hipchat_message)
+
+    def deliver(route, selected):
+        if ledger is not None:
+            selected = [record for record in selected
+                        if not ledger.is_sent(record.action['id'],
+                                              route.room_id)]
+        renderer = RENDERERS[route.format]
+        if route.digest_window:
+            rendered = coalesce_groups(selected, route.digest_window,
+                                       route.digest_by, renderer)
         else:
-            # This is an action that we haven't written a template for yet.
-            action_type = 'default'
+            rendered = [(record.render(renderer), [record])
+                        for record in selected]
+        for message, entries in rendered:
+            send(
+                route.room_id, message, config.HIPCHAT_API_KEY,
+                color=config.HIPCHAT_COLOR, mtype=renderer.mtype,
+                really=(not debug)
+            )
+            if ledger is not None and not debug:
+                ledger.mark_sent(entries[0].board_id,
+                                 [record.action['id'] for record in entries],
+                                 route.room_id)
+
+    batch = ActionBatch([record.action for record in records])
+    for route in routes:
+        selected = route_records(records, route, batch)
+        if registry.enabled:
+            count_routed(records, selected)
+        if route.digest_window and digests is not None:
+            digests.add(route, selected, deliver)
+        else:
+            deliver(route, selected)
+    if digests is not None:
+        digests.flush()
 
-        # Check the action type again (so it can check subtype)
-        if (include_actions != ['all'] and
-            action_type != 'default' and
-            action_type not in include_actions):
-            continue
 
-        send_hipchat_message(
-            room_id, MESSAGES[action_type] % params, config.HIPCHAT_API_KEY,
-            color=config.HIPCHAT_COLOR, really=(not debug)
-        )
+def notify(config, actions, board_id, room_id, list_names,
+           debug=False, include_actions=['all'], filters=[], send=None,
+           digest_window=None, digest_by='action_type', format='html'):
+    """
+    Given a list of actions, report all of the relevant ones to the HipChat
+    room. See fan_out() for what the optional arguments do.
+    """
+    route = Route(board_id, room_id, list_names, include_actions, filters,
+                  digest_window, digest_by, format)
+    notify_route(config, actions, route, debug=debug, send=send)
+
+
+def notify_route(config, actions, route, debug=False, send=None):
+    """
+    Like notify(), but for a MONITOR entry that has already been compiled
+    into a Route.
+    """
+    records = enrich_actions(config, actions, route.board_id, [route])
+    fan_out(config, records, [route], debug=debug, send=send)
@@ -0,0 +1,126 @@
+"""
+A small in-process cache for Trello lookups, so that a burst of actions on the
+same card doesn't make the same API calls over and over.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+# Marks a lookup that found nothing, since None is a valid cached value.
+_MISSING = object()
+
+
+class LookupCache(object):
+    """
+    A bounded mapping from keys (usually a kind of Trello object and its ID)
+    to values. Entries expire `ttl` seconds after they were stored, and when
+    the cache is full the least recently used entry is evicted.
+
+    The `hits` and `misses` counters record how many lookups were answered
+    from the cache, which is the number of API calls it saved.
+    """
+    def __init__(self, max_size=1000, ttl=300, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size=None, ttl=None):
+        """
+        Change the size limit and/or the TTL, evicting entries if the cache
+        is now over its limit.
+        """
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict()
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for key, or default if there is no fresh
+        entry for it.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= self.clock():
+                self.misses += 1
+                return default
+            # Re-insert it to mark it as the most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        """
+        Like get(), but without counting a hit or a miss, or marking the
+        entry as recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                return default
+            return entry[1]
+
+    def __contains__(self, key):
+        return self.peek(key, _MISSING) is not _MISSING
+
+    def put(self, key, value):
+        """
+        Store value under key.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._evict()
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Return the value stored for key, calling fetch() to get it (and
+        storing the result) if it isn't cached.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = fetch()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        """
+        Forget the entry for key, if there is one.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """
+        Forget every entry for which predicate(key, value) is true.
+        """
+        with self._lock:
+            for key in [key for key, (_, value) in self._entries.items()
+                        if predicate(key, value)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of the hit and miss counters and the current
+        number of entries.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries)}
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
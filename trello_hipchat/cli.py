@@ -2,13 +2,35 @@ from __future__ import print_function
 import os
 import sys
 import time
-import json
+import types
+import signal
 import logging
 import logging.config
-from collections import defaultdict
 from argparse import ArgumentParser
 
-from . import get_actions, notify
+from . import (poll_board, lookup_cache, board_mirror, send_hipchat_message,
+               DigestBuffer, limit_trello_requests, MAX_BACKLOG)
+from .routing import RouteTable
+from .templates import RENDERERS
+from .pool import run_isolated
+from .transport import default_transport
+from .delivery import DeliveryQueue
+from .spool import DeadLetterSpool, spooling
+from .scheduler import BoardScheduler
+from .state import StateStore
+from .sharding import ShardCoordinator, parse_shard
+from .metrics import (registry, serve as serve_metrics,
+                      dump_periodically, install_profiler)
+
+# How often, in seconds, to check whether the config file has changed.
+CONFIG_CHECK_INTERVAL = 5
+
+# How often, in seconds, to save the board mirror (when it has changed).
+MIRROR_SAVE_INTERVAL = 60
+
+# How long, in seconds, to wait on the way out for each delivery worker to
+# send the messages it has queued.
+SHUTDOWN_TIMEOUT = 10
 
 # The error you get for a nonexistent file is different on py2 vs py3.
 if sys.version_info[0] > 2:
@@ -17,10 +39,195 @@ else:
     FileNotFound = IOError
     
     
+def read_config(config_file):
+    """
+    Load the configuration from a Python file into a new module object, so
+    that loading it again doesn't change the one already in use. Raise an
+    error if it can't be loaded.
+    """
+    config = types.ModuleType('config')
+    config.__file__ = config_file
+    with open(config_file) as f:
+        source = f.read()
+    exec(compile(source, config_file, 'exec'), config.__dict__)
+    return config
+
+
+def check_config(config):
+    """
+    Raise ValueError if a MONITOR entry asks for a message format that
+    doesn't exist, or that HipChat's v1 API can't take and the config has no
+    SEND_MESSAGE function to send it with.
+    """
+    send = getattr(config, 'SEND_MESSAGE', send_hipchat_message)
+    for parameters in config.MONITOR:
+        name = parameters.get('format', 'html')
+        renderer = RENDERERS.get(name)
+        if renderer is None:
+            raise ValueError('Unknown message format: %r' % name)
+        if send is send_hipchat_message and \
+           renderer.mtype not in ('html', 'text'):
+            raise ValueError('Sending %s messages needs a SEND_MESSAGE '
+                             'function in the config.' % name)
+
+
+def load_config(config_file):
+    """
+    Load the configuration from a Python file, exiting if it can't be loaded,
+    doesn't monitor anything or asks for something impossible.
+    """
+    try:
+        config = read_config(config_file)
+    except (FileNotFound, SyntaxError):
+        sys.exit(1)
+
+    if not config.MONITOR:
+        sys.exit(2)
+    try:
+        check_config(config)
+    except ValueError as e:
+        sys.exit(str(e))
+    return config
+
+
+class StopSignal(object):
+    """
+    Stops run_forever on SIGTERM: right away if it's waiting for the next
+    round, or else once the round in progress is finished, so that no page
+    is left half sent.
+    """
+    def __init__(self):
+        self.requested = False
+        self.idle = False
+        signal.signal(signal.SIGTERM, self._request)
+
+    def _request(self, signum, frame):
+        self.requested = True
+        if self.idle:
+            sys.exit(0)
+
+    def sleep(self, seconds):
+        """
+        Wait for the next round. Return False instead if asked to stop.
+        """
+        self.idle = True
+        try:
+            if self.requested:
+                return False
+            time.sleep(seconds)
+            return True
+        finally:
+            self.idle = False
+
+
+class ConfigWatcher(object):
+    """
+    Notices when the config file needs reloading: when it's been modified,
+    or when the process gets SIGHUP.
+    """
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.mtime = self._mtime()
+        self.requested = False
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._request)
+
+    def _mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def _request(self, signum, frame):
+        self.requested = True
+
+    def changed(self):
+        """
+        Return True if the config should be reloaded.
+        """
+        return self.requested or self._mtime() != self.mtime
+
+    def load(self):
+        """
+        Load the config again, raising an error if it can't be loaded or
+        checked (in which case it isn't retried until it changes again).
+        """
+        self.requested = False
+        self.mtime = self._mtime()
+        config = read_config(self.config_file)
+        if not config.MONITOR:
+            raise ValueError('MONITOR is empty')
+        check_config(config)
+        return config
+
+
+def configure(config, spool=None):
+    """
+    Apply the optional cache, HTTP and delivery settings from the config.
+    Return the DeliveryQueue to send messages through (putting the ones it
+    can't deliver in `spool`, if given), or None to send them right away.
+    """
+    configure_http(config)
+
+    # Send messages from background threads, if the config asks for it.
+    if getattr(config, 'DELIVERY_WORKERS', 0):
+        return DeliveryQueue(
+            workers=config.DELIVERY_WORKERS,
+            max_size=getattr(config, 'DELIVERY_QUEUE_SIZE', 1000),
+            overflow=getattr(config, 'DELIVERY_OVERFLOW', 'block'),
+            room_rate=getattr(config, 'HIPCHAT_ROOM_RATE', 1.0),
+            room_burst=getattr(config, 'HIPCHAT_ROOM_BURST', 5),
+            send=getattr(config, 'SEND_MESSAGE', send_hipchat_message),
+            spool=spool
+        ).start()
+    return None
+
+
+def configure_http(config):
+    """
+    Apply the optional cache and HTTP settings from the config, which (unlike
+    the delivery settings) can be changed while running.
+    """
+    lookup_cache.configure(
+        max_size=getattr(config, 'LOOKUP_CACHE_SIZE', None),
+        ttl=getattr(config, 'LOOKUP_CACHE_TTL', None))
+    default_transport.configure(
+        pool_size=getattr(config, 'HTTP_POOL_SIZE', None),
+        timeout=getattr(config, 'HTTP_TIMEOUT', None),
+        failure_threshold=getattr(config, 'CIRCUIT_FAILURE_THRESHOLD', None),
+        reset_timeout=getattr(config, 'CIRCUIT_RESET_TIMEOUT', None))
+
+
+def replay_spools(spool, send, api_key, coordinator=None):
+    """
+    Send the messages waiting in the spool and, if sharded, in the spools of
+    workers whose leases have expired, since their boards (and so their
+    messages) now belong to the live workers. A shared spool is only sent
+    while holding its lock, so no message is sent by two workers. Return
+    the number of messages sent.
+    """
+    if coordinator is None:
+        return spool.replay(send, api_key) if len(spool) else 0
+    sent = 0
+    for shard in [coordinator.shard] + coordinator.orphaned_shards():
+        lock = coordinator.lock_spool(shard)
+        if lock is None:
+            continue
+        with lock:
+            if shard != coordinator.shard:
+                sent += DeadLetterSpool(
+                    coordinator.spool_directory(shard)).replay(send, api_key)
+            else:
+                sent += spool.replay(send, api_key)
+    return sent
+
+
 def run_forever():
     """
     Command-line interface.
-    Every minute, send all the notifications for all the boards.
+    Poll every board on its own schedule (every minute by default), and send
+    all the notifications for it. The config is reloaded when the file
+    changes or on SIGHUP.
     """
         
     # Parse command-line args
@@ -30,67 +237,257 @@ def run_forever():
     parser.add_argument('-d', type=str, dest='directory', default='.',
                         help='Directory in which to save/read state')
     parser.add_argument('-i', type=int, dest='interval', default=60,
-                        help='Number of seconds to sleep between rounds')
+                        help=('Number of seconds between polls of a board '
+                              '(see POLL_MIN_INTERVAL and POLL_MAX_INTERVAL '
+                              'in the sample config to make this adaptive)'))
+    parser.add_argument('-l', type=int, dest='lookback', default=20,
+                        help=('Number of minutes to look back for actions on '
+                              'boards with no saved state'))
+    parser.add_argument('-w', type=int, dest='workers', default=1,
+                        help=('Maximum number of boards to fetch at the same '
+                              'time (1 fetches them one after another)'))
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help=('Run as worker i out of N (given as i/N), '
+                              'sharing the boards with the other workers '
+                              'that use the same -d directory'))
+    parser.add_argument('--lease-ttl', type=int, dest='lease_ttl',
+                        default=120,
+                        help=('Number of seconds after which a silent '
+                              'worker\'s boards are taken over by the others'))
+    parser.add_argument('--metrics-port', type=int, dest='metrics_port',
+                        default=None,
+                        help='Serve Prometheus metrics on this port')
     parser.add_argument('--debug', action='store_true',
                         help=('Print actions and messages, and don\'t actually'
                               ' send to HipChat'))
     args = parser.parse_args()
 
     # Set up logging
-    # logger = logging.getLogger(__name__)
-    # logging.config.fileConfig(('logging_debug.cfg'
-    #                            if args.debug
-    #                            else 'logging.cfg'),
-    #                           disable_existing_loggers=False)
-    
-    # Load config file
-    try:
-        if sys.version_info[0] > 2:
-            import importlib
-            config = importlib.machinery.SourceFileLoader(
-                'config', args.config_file).load_module()
-        else:
-            import imp
-            with open(args.config_file) as f:
-                config = imp.load_module('config', f, args.config_file,
-                                         ('.py', 'r', imp.PY_SOURCE))
-
-    except (FileNotFound, SyntaxError):
-        sys.exit(1)
+    logging_config = 'logging_debug.cfg' if args.debug else 'logging.cfg'
+    if os.path.exists(logging_config):
+        logging.config.fileConfig(logging_config,
+                                  disable_existing_loggers=False)
 
-    if not config.MONITOR:
-        sys.exit(2)
+    config = load_config(args.config_file)
+    routes = RouteTable(config.MONITOR)
+    # Editing the config file (or sending SIGHUP) reloads it between rounds.
+    watcher = ConfigWatcher(args.config_file)
 
     interval = max(0, args.interval)
+    scheduler = BoardScheduler(
+        min_interval=getattr(config, 'POLL_MIN_INTERVAL', interval),
+        max_interval=getattr(config, 'POLL_MAX_INTERVAL', interval),
+        bucket=limit_trello_requests(
+            getattr(config, 'TRELLO_REQUEST_BUDGET', 100)))
+    max_backlog = getattr(config, 'MAX_BACKLOG', MAX_BACKLOG)
+
+    # With --shard, this worker owns a share of the boards that can change
+    # as other workers come and go, and has its own state file and spool.
+    coordinator = None
+    if args.shard is not None:
+        coordinator = ShardCoordinator(args.directory, *args.shard,
+                                       lease_ttl=args.lease_ttl)
+
+    # Messages that can't be delivered while HipChat is down wait in a spool
+    # next to the state, and are sent again once it's back.
+    if coordinator is None:
+        spool = DeadLetterSpool(os.path.join(args.directory, 'dead-letters'))
+    else:
+        spool = DeadLetterSpool(coordinator.spool_directory())
+    delivery = configure(config, spool)
+
+    # Metrics are only collected if something will report them: the
+    # Prometheus endpoint, or the trello_hipchat.metrics logger at INFO
+    # level, which logs them as JSON.
+    dump_metrics = logging.getLogger('trello_hipchat.metrics').isEnabledFor(
+        logging.INFO)
+    if args.metrics_port or dump_metrics:
+        registry.enable()
+        for name in ('hits', 'misses', 'size'):
+            registry.gauge('lookup_cache_' + name,
+                           lambda name=name: lookup_cache.stats()[name])
+        if delivery:
+            for name in ('queued', 'sent', 'dropped', 'failed', 'spooled'):
+                registry.gauge('delivery_' + name,
+                               lambda name=name: delivery.stats()[name])
+        registry.gauge('scheduled_boards', lambda: len(scheduler))
+        registry.gauge('dead_letters', lambda: len(spool))
+        if args.metrics_port:
+            serve_metrics(args.metrics_port)
+        if dump_metrics:
+            dump_periodically(
+                getattr(config, 'METRICS_DUMP_INTERVAL', 60))
+
+    # Sending SIGUSR1 starts profiling the polling loop, and sending it again
+    # writes out the stats.
+    install_profiler(os.path.join(
+        args.directory, 'profile-%d-%%d.prof' % os.getpid()))
+
+    if coordinator is not None:
+        state = StateStore(coordinator.state_path())
+    else:
+        state = StateStore(os.path.join(args.directory, 'state.sqlite'))
+    legacy_state_file = os.path.join(args.directory, 'last-actions.json')
+    if os.path.exists(legacy_state_file):
+        try:
+            state.import_json(legacy_state_file)
+        except ValueError:
+            print("Warning: could not read %s." % legacy_state_file)
+
+    # With BOARD_MIRROR, names are looked up in a copy of each board kept
+    # next to the state, and only asked of Trello when it doesn't have them.
+    if getattr(config, 'BOARD_MIRROR', False):
+        if coordinator is None:
+            mirror_file = os.path.join(args.directory, 'boards.json')
+        else:
+            mirror_file = os.path.join(args.directory, 'boards-%d-of-%d.json'
+                                       % args.shard)
+        try:
+            board_mirror.enable(mirror_file,
+                                getattr(config, 'BOARD_MIRROR_MAX_AGE', None))
+        except (ValueError, KeyError):
+            print("Warning: could not read %s." % mirror_file)
+        if registry.enabled:
+            for name in ('hits', 'misses', 'boards'):
+                registry.gauge('board_mirror_' + name,
+                               lambda name=name: board_mirror.stats()[name])
+    # Records for rooms with a digest_window wait here until their window
+    # closes, so that bursts spread over several polls make one digest.
+    digests = DigestBuffer()
 
-    state_file = os.path.join(args.directory, 'last-actions.json')
-    # Don't check back in time more than 20 minutes ago.
-    a_while_ago = time.time() - 20*60
-    last_action_times = defaultdict(lambda: a_while_ago)
+    # For boards with no saved state, don't check back in time more than a
+    # few minutes before the board was first seen.
+    start_times = {}
+    last_pruned = 0
+    last_saved = time.time()
+    stop = StopSignal()
     try:
-        last_action_times.update(json.load(open(state_file)))
-    except (FileNotFound, ValueError):
-        print "Warning: no saved state found."
-    while True:
-        # First get all the actions, to avoid doing it multiple times for the
-        # same board.
-        new_actions = {}
-        for parameters in config.MONITOR:
-            board_id = parameters['board_id']
-            if board_id not in new_actions:
-                (actions, new_last_time) = get_actions(
-                    config, last_action_times[board_id], board_id)
-                new_actions[board_id] = actions
-                last_action_times[board_id] = new_last_time
-
-        # Then send all the HipChat notifications.
-        for parameters in config.MONITOR:
-            board_id = parameters['board_id']
-            notify(config, new_actions[board_id], debug=args.debug,
-                   **parameters)
-
-        # Save state to a file.
-        with open(state_file, 'w') as f:
-            json.dump(last_action_times, f)
-
-        time.sleep(interval)
+        while True:
+            if watcher.changed():
+                try:
+                    new_config = watcher.load()
+                    added, removed = routes.update(new_config.MONITOR)
+                except Exception as e:
+                    print("Warning: could not reload %s: %s"
+                          % (args.config_file, e))
+                else:
+                    config = new_config
+                    configure_http(config)
+                    max_backlog = getattr(config, 'MAX_BACKLOG', MAX_BACKLOG)
+                    print("Reloaded %s: %d boards added, %d removed."
+                          % (args.config_file, len(added), len(removed)))
+            routes_by_board = routes.by_board
+            send = getattr(config, 'SEND_MESSAGE', send_hipchat_message)
+
+            # Send what's waiting in the spool first, along with what's in
+            # the spools of dead workers. While HipChat's circuit is open this
+            # fails right away, and once it's half-open, the first message is
+            # the one that tests it. (In debug mode nothing is sent, so the
+            # spools are left alone.)
+            if not args.debug:
+                sent = replay_spools(spool, send, config.HIPCHAT_API_KEY,
+                                     coordinator)
+                if sent:
+                    print("Sent %d spooled messages, %d left."
+                          % (sent, len(spool)))
+
+            if coordinator is None:
+                owned = set(routes_by_board)
+            else:
+                coordinator.heartbeat()
+                owned = set(coordinator.owned(routes_by_board))
+            for board_id in owned:
+                scheduler.add(board_id)
+                start_times.setdefault(board_id,
+                                       time.time() - args.lookback*60)
+            for board_id in list(scheduler.intervals):
+                if board_id not in owned:
+                    scheduler.remove(board_id)
+                    start_times.pop(board_id, None)
+
+            # Get each due board's actions once, and send the HipChat
+            # notifications for all the rooms that subscribe to it, a page at
+            # a time, recording each page as soon as it's sent (and each
+            # action as soon as it's sent to a room, in case of a crash before
+            # the page is recorded). A board whose fetch fails keeps the state
+            # of the last page it finished, so the rest is simply retried next
+            # time. Messages that can't be sent go to the spool, so they don't
+            # stop the page from being recorded.
+            def poll(board_id):
+                if coordinator is None:
+                    return poll_owned(board_id)
+                # Make sure no other worker is polling it while ownership
+                # changes hands, and pick up where its last owner left off.
+                lock = coordinator.lock_board(board_id)
+                if lock is None:
+                    return False
+                with lock:
+                    state.adopt(board_id, coordinator.other_state_paths())
+                    return poll_owned(board_id)
+
+            def poll_owned(board_id):
+                active = False
+                for new_last_time, page in poll_board(
+                        config, board_id, routes_by_board[board_id],
+                        state.last_time(board_id, start_times[board_id]),
+                        max_backlog=max_backlog, debug=args.debug,
+                        send=(delivery.put if delivery
+                              else spooling(send, spool)),
+                        seen=state.is_delivered, digests=digests,
+                        ledger=state):
+                    state.record(board_id, new_last_time, page[0]['id'],
+                                 [A['id'] for A in page])
+                    active = True
+                return active
+
+            due = scheduler.pop_due()
+            polled, _ = run_isolated(poll, due, max_workers=args.workers)
+            for board_id in due:
+                scheduler.done(board_id, polled.get(board_id, False))
+            digests.flush()
+
+            if time.time() - last_pruned > 60*60:
+                state.prune()
+                last_pruned = time.time()
+
+            if board_mirror.enabled:
+                board_mirror.retain(owned)
+                if time.time() - last_saved > MIRROR_SAVE_INTERVAL:
+                    board_mirror.save()
+                    last_saved = time.time()
+
+            if args.debug:
+                print('Lookup cache: %(hits)d hits, %(misses)d misses, '
+                      '%(size)d entries' % lookup_cache.stats())
+                if board_mirror.enabled:
+                    print('Board mirror: %(hits)d hits, %(misses)d misses, '
+                          '%(boards)d boards' % board_mirror.stats())
+                print('Dead letters: %d waiting' % len(spool))
+                if delivery:
+                    print('Delivery queue: %(queued)d queued, %(sent)d sent, '
+                          '%(dropped)d dropped, %(failed)d failed, '
+                          '%(spooled)d spooled' % delivery.stats())
+
+            # Wake up often enough to notice a changed config (and, if sharded,
+            # to renew the lease and notice changes in which boards this worker
+            # owns).
+            wake_up = CONFIG_CHECK_INTERVAL
+            if coordinator is not None:
+                wake_up = min(wake_up, args.lease_ttl / 3.0)
+            next_due = min(scheduler.next_due() or float('inf'),
+                           digests.next_due() or float('inf'),
+                           time.time() + wake_up)
+            if not stop.sleep(max(0, next_due - time.time())):
+                break
+    finally:
+        # Send the digests still waiting for their window to close, wait for
+        # the delivery queue to send them and whatever else it has (it
+        # records messages as sent when they're queued), and save the board
+        # mirror.
+        try:
+            digests.flush(force=True)
+        finally:
+            if delivery:
+                delivery.close(SHUTDOWN_TIMEOUT)
+            if board_mirror.enabled:
+                board_mirror.save()
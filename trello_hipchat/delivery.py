@@ -0,0 +1,223 @@
+"""
+Asynchronous delivery of HipChat messages, so that a slow or throttling
+HipChat doesn't hold up polling Trello.
+"""
+import sys
+import time
+import random
+import threading
+import logging
+
+if sys.version_info[0] > 2:
+    from queue import Queue, Full, Empty
+else:
+    from Queue import Queue, Full, Empty
+
+from . import send_hipchat_message
+from .ratelimit import TokenBucket
+from .transport import HTTPError, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# What put() does when a worker's queue is full: wait for room, discard the
+# new message, or discard the oldest queued message to make room.
+OVERFLOW_POLICIES = ('block', 'drop-new', 'drop-oldest')
+
+# Sentinel telling a worker thread to exit.
+_STOP = object()
+
+
+class DeliveryQueue(object):
+    """
+    Queues HipChat messages and sends them from background worker threads.
+
+    Every room is always handled by the same worker, so messages to a room
+    are sent in the order they were queued. Each room gets its own token
+    bucket allowing `room_rate` messages per second (with bursts of
+    `room_burst`). A 429 response pauses the room's bucket for as long as
+    its Retry-After header says, and 5xx responses and network errors are
+    retried with jittered exponential backoff, up to `max_retries` times.
+
+    With a DeadLetterSpool as `spool`, messages that are given up on (or
+    that can't be sent because HipChat's circuit is open) are put in it
+    instead of being lost, and so are messages to rooms that already have
+    messages waiting in it.
+
+    put() takes the same arguments as send_hipchat_message(), so it can be
+    passed to notify() in its place.
+    """
+    def __init__(self, workers=2, max_size=1000, overflow='block',
+                 room_rate=1.0, room_burst=5, max_retries=5,
+                 backoff_base=1.0, backoff_max=60.0,
+                 send=send_hipchat_message, sleep=time.sleep, spool=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %r' % overflow)
+        self.overflow = overflow
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.send = send
+        self.sleep = sleep
+        self.spool = spool
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.spooled = 0
+        self._queues = [Queue(max(1, max_size // max(1, workers)))
+                        for _ in range(max(1, workers))]
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        for queue in self._queues:
+            thread = threading.Thread(target=self._work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def put(self, room_id, message, api_key, **kwargs):
+        """
+        Queue a message to be sent to a room.
+        """
+        item = (room_id, message, api_key, kwargs)
+        queue = self._queues[hash(room_id) % len(self._queues)]
+        if self.overflow == 'block':
+            queue.put(item)
+            return
+        while True:
+            try:
+                queue.put_nowait(item)
+                return
+            except Full:
+                if self.overflow == 'drop-new':
+                    self._drop(room_id)
+                    return
+            # Make room by dropping the oldest message, then try again.
+            try:
+                queue.get_nowait()
+                queue.task_done()
+                self._drop(room_id)
+            except Empty:
+                pass
+
+    def join(self):
+        """
+        Block until every queued message has been sent or given up on.
+        """
+        for queue in self._queues:
+            queue.join()
+
+    def close(self, timeout=None):
+        """
+        Stop the workers after they send everything already queued, waiting
+        at most `timeout` seconds for each of them.
+        """
+        for queue in self._queues:
+            queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def stats(self):
+        """
+        Return a dictionary of delivery counters and the number of queued
+        messages.
+        """
+        return {'queued': sum(queue.qsize() for queue in self._queues),
+                'sent': self.sent, 'dropped': self.dropped,
+                'failed': self.failed, 'spooled': self.spooled}
+
+    def _drop(self, room_id):
+        logger.warning('Delivery queue full, dropped a message to room %s',
+                       room_id)
+        with self._lock:
+            self.dropped += 1
+
+    def _bucket(self, room_id):
+        with self._lock:
+            bucket = self._buckets.get(room_id)
+            if bucket is None:
+                bucket = TokenBucket(self.room_rate, self.room_burst)
+                self._buckets[room_id] = bucket
+            return bucket
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** attempt))
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._deliver(*item)
+            finally:
+                queue.task_done()
+
+    def _deliver(self, room_id, message, api_key, kwargs):
+        if self.spool is not None and self.spool.waiting(room_id):
+            self._spool(room_id, message, kwargs)
+            return
+        bucket = self._bucket(room_id)
+        for attempt in range(self.max_retries + 1):
+            bucket.wait(self.sleep)
+            try:
+                self.send(room_id, message, api_key, **kwargs)
+            except HTTPError as e:
+                if e.status == 429:
+                    delay = _retry_after(e.headers)
+                    if delay is None:
+                        delay = self._backoff(attempt)
+                    logger.warning('HipChat is throttling room %s, waiting '
+                                   '%.1f seconds', room_id, delay)
+                    bucket.pause(delay)
+                    continue
+                if e.status < 500:
+                    logger.error('HipChat rejected a message to room %s: %s',
+                                 room_id, e)
+                    break
+                self.sleep(self._backoff(attempt))
+            except IOError as e:
+                if isinstance(e, CircuitOpenError) and self.spool is not None:
+                    # HipChat is known to be down, so spool the message
+                    # rather than wait for it.
+                    self._spool(room_id, message, kwargs)
+                    return
+                logger.warning('Failed to reach HipChat', exc_info=True)
+                self.sleep(self._backoff(attempt))
+            else:
+                with self._lock:
+                    self.sent += 1
+                return
+        else:
+            logger.error('Giving up on a message to room %s after %d '
+                         'attempts', room_id, self.max_retries + 1)
+            if self.spool is not None:
+                self._spool(room_id, message, kwargs)
+                return
+        with self._lock:
+            self.failed += 1
+
+    def _spool(self, room_id, message, kwargs):
+        self.spool.put(room_id, message, kwargs)
+        with self._lock:
+            self.spooled += 1
+
+
+def _retry_after(headers):
+    """
+    Return the number of seconds a Retry-After header asks us to wait, or
+    None if there is no usable header.
+    """
+    try:
+        return max(0, float(headers['retry-after']))
+    except (KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,252 @@
+"""
+Declarative filters for MONITOR entries, which can be used alongside (or
+instead of) filter functions.
+
+A filter spec is a dictionary like
+
+    {"member": ["5a1b..."], "card_name": "^Bug", "exclude": True}
+
+and an action passes it if it matches every condition in it (or, with
+"exclude", if it doesn't). Specs are compiled once, and evaluated over a
+whole batch of actions at a time using indexes of the batch by member,
+label, card name and so on, so that many filters over many actions cost
+little more than looking their values up.
+"""
+import re
+import calendar
+from bisect import bisect_left
+
+# The conditions a spec can have, and what each is matched against:
+#   member       the ID of the member who did the action, or who it was
+#                about (such as the member added to a card)
+#   label        the ID or name of a label the action added or removed, or
+#                that the card had
+#   card_name    a regular expression searched for in the card's name
+#   action_type  the Trello action type
+#   since, until the time of the action, as a Unix timestamp or an ISO 8601
+#                date in UTC (such as '2020-01-31' or Trello's
+#                '2020-01-31T12:00:00.000Z'), since inclusive and until
+#                exclusive
+CONDITIONS = ('member', 'label', 'card_name', 'action_type', 'since',
+              'until')
+OPTIONS = ('exclude',)
+
+
+# An ISO 8601 date, optionally followed by a time of day (with or without
+# seconds and fractions of a second) and a Z.
+ISO_DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})'
+                      r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(\.\d+)?)?)?Z?$')
+
+
+def _timestamp(value):
+    """
+    Return a date as a Unix timestamp. Dates can be timestamps already, or
+    ISO 8601 dates in UTC with or without a time and fractions of a second.
+    Raise ValueError for anything else.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    match = ISO_DATE.match(value)
+    if match is None:
+        raise ValueError('Not an ISO 8601 date: %r' % (value,))
+    fields = match.groups()
+    fraction = fields[-1]
+    fields = [int(field or 0) for field in fields[:-1]]
+    return calendar.timegm(fields + [0, 0, 0]) + float(fraction or 0)
+
+
+def _members(A):
+    members = set()
+    creator = A.get('idMemberCreator') or A.get('memberCreator', {}).get('id')
+    if creator:
+        members.add(creator)
+    member = A['data'].get('idMember') or A.get('member', {}).get('id')
+    if member:
+        members.add(member)
+    return members
+
+
+def _labels(A):
+    data = A['data']
+    labels = set()
+    if 'label' in data:
+        labels.add(data['label'].get('id'))
+        labels.add(data['label'].get('name'))
+    card = data.get('card', {})
+    labels.update(card.get('idLabels', ()))
+    for label in card.get('labels', ()):
+        labels.add(label.get('id'))
+        labels.add(label.get('name'))
+    labels.discard(None)
+    return labels
+
+
+def _card_name(A):
+    name = A['data'].get('card', {}).get('name')
+    return () if name is None else (name,)
+
+
+# How to get the values of an action that each kind of index is keyed by.
+INDEXED_VALUES = {
+    'member': _members,
+    'label': _labels,
+    'card_name': _card_name,
+    'action_type': lambda A: (A['type'],),
+}
+
+
+class ActionBatch(object):
+    """
+    A list of actions, with indexes from values (of the kinds in
+    INDEXED_VALUES) to the positions of the actions that have them. Each
+    index is only built if a filter needs it, and then shared by every
+    filter evaluated over the batch.
+    """
+    def __init__(self, actions):
+        self.actions = actions
+        self._indexes = {}
+        self._dates = None
+        self._results = {}
+
+    def index(self, kind):
+        index = self._indexes.get(kind)
+        if index is None:
+            index = {}
+            values = INDEXED_VALUES[kind]
+            for position, A in enumerate(self.actions):
+                for value in values(A):
+                    index.setdefault(value, set()).add(position)
+            self._indexes[kind] = index
+        return index
+
+    def outside(self, since, until):
+        """
+        Return the positions of the actions before `since` or from `until`
+        on (timestamps, either of which can be None).
+        """
+        if self._dates is None:
+            self._dates = sorted((_timestamp(A['date']), position)
+                                 for position, A in enumerate(self.actions))
+        dates = self._dates
+        start = 0 if since is None else bisect_left(dates, (since,))
+        end = len(dates) if until is None else bisect_left(dates, (until,))
+        return set(position for _, position in dates[:start] + dates[end:])
+
+
+class FilterSpec(object):
+    """
+    A compiled filter spec. Raises ValueError if the spec has no conditions,
+    or conditions it doesn't know.
+    """
+    def __init__(self, spec):
+        unknown = set(spec) - set(CONDITIONS) - set(OPTIONS)
+        if unknown:
+            raise ValueError('Unknown filter conditions: %s'
+                             % ', '.join(sorted(unknown)))
+        if not set(spec) & set(CONDITIONS):
+            raise ValueError('Filter has no conditions: %r' % (spec,))
+        self.sets = []
+        for kind in ('member', 'label', 'action_type'):
+            if kind in spec:
+                values = spec[kind]
+                if not isinstance(values, (list, tuple, set, frozenset)):
+                    values = [values]
+                self.sets.append((kind, frozenset(values)))
+        self.card_name = None
+        if 'card_name' in spec:
+            self.card_name = re.compile(spec['card_name'])
+        self.since = _timestamp(spec.get('since'))
+        self.until = _timestamp(spec.get('until'))
+        self.exclude = bool(spec.get('exclude'))
+        # Specs that are the same are only evaluated once per batch.
+        self.key = (tuple(sorted(self.sets)), spec.get('card_name'),
+                    self.since, self.until, self.exclude)
+
+    def evaluate(self, batch):
+        """
+        Evaluate the spec over a batch. Return a flag and a set of positions
+        of actions in the batch: if the flag is True, the actions that pass
+        are the ones in the set, and otherwise they're the ones that aren't.
+        Whichever is usually smaller is returned, so that combining the
+        results of many specs costs little.
+        """
+        result = batch._results.get(self.key)
+        if result is not None:
+            return result
+        matches = None
+        for kind, values in self.sets:
+            index = batch.index(kind)
+            found = set()
+            for value in values:
+                found.update(index.get(value, ()))
+            matches = found if matches is None else matches & found
+        if self.card_name is not None and matches != set():
+            found = set()
+            for name, positions in batch.index('card_name').items():
+                if self.card_name.search(name):
+                    found.update(positions)
+            matches = found if matches is None else matches & found
+        if self.since is not None or self.until is not None:
+            outside = batch.outside(self.since, self.until)
+            if matches is None:
+                # Only dates: the actions that don't match are the ones
+                # outside the range.
+                result = (self.exclude, outside)
+            else:
+                result = (not self.exclude, matches - outside)
+        else:
+            result = (not self.exclude, matches)
+        batch._results[self.key] = result
+        return result
+
+
+def compile_filters(filters):
+    """
+    Split a MONITOR entry's filters into compiled FilterSpecs (from the
+    dictionaries) and functions.
+    """
+    specs = []
+    functions = []
+    for f in filters:
+        if isinstance(f, dict):
+            specs.append(FilterSpec(f))
+        else:
+            functions.append(f)
+    return specs, functions
+
+
+def select(batch, positions, specs, functions):
+    """
+    Return the positions, out of the given positions in the batch (in
+    order), of the actions that pass all of the specs and functions. The
+    specs are evaluated first, so functions only see the actions that are
+    left.
+    """
+    if specs:
+        selected = set(positions)
+        for spec in specs:
+            passing, found = spec.evaluate(batch)
+            if passing:
+                selected &= found
+            else:
+                selected -= found
+            if not selected:
+                return []
+        positions = [position for position in positions
+                     if position in selected]
+    if functions:
+        actions = batch.actions
+        positions = [position for position in positions
+                     if all(f(actions[position]) for f in functions)]
+    return positions
+
+
+def filter_mask(actions, filters):
+    """
+    Return a list with True for each action that passes all of the filters
+    (specs or functions), and False for the others.
+    """
+    specs, functions = compile_filters(filters)
+    batch = ActionBatch(actions)
+    passed = set(select(batch, range(len(actions)), specs, functions))
+    return [position in passed for position in range(len(actions))]
@@ -2,6 +2,11 @@
 # the corresponding message to be sent to HipChat.
 # Some of them are not actual Trello actions, they're subsets (delimited by a
 # hyphen).  For example, updateCheckItemStateOnCard-uncheck.
+#
+# The templates are compiled by templates.py, which renders them in other
+# formats than HTML too, so the only markup they can use is links of the form
+# <a href="%(some_url)s">...</a>. Every field they use must be one that
+# trello_hipchat.FIELDS knows how to produce.
 
 MESSAGES = {
     'addAttachmentToCard': "%(author)s added an attachment to card <a href=\"%(card_url)s\">%(card_name)s</a>: <a href=\"%(attachment_url)s\">%(attachment_name)s</a>.",
@@ -61,3 +66,34 @@ MESSAGES = {
 
     'default': "%(author)s did %(action_type)s.",
 }
+
+# Format strings for digest messages, which summarize a burst of actions in a
+# room that has digest mode turned on. Digests of actions of the same type
+# use the template for that action type, or 'default' if there isn't one;
+# digests of actions on the same card use 'card'.
+#
+# Besides action_type, every digest can use count (the number of actions),
+# card_count (the number of different cards they were on), authors (who did
+# them) and cards (links to those cards).
+
+DIGEST_MESSAGES = {
+    'addMemberToCard': "%(authors)s added members to %(card_count)d cards: %(cards)s.",
+
+    'commentCard': "%(authors)s left %(count)d comments on %(cards)s.",
+
+    'createCard': "%(authors)s created %(card_count)d cards: %(cards)s.",
+
+    'removeMemberFromCard': "%(authors)s removed members from %(card_count)d cards: %(cards)s.",
+
+    'updateCard-archive': "%(authors)s archived %(card_count)d cards: %(cards)s.",
+
+    'updateCard-move': "%(authors)s moved %(card_count)d cards: %(cards)s.",
+
+    'updateCheckItemStateOnCard-check': "%(authors)s completed %(count)d checklist items in %(cards)s.",
+
+    'updateCheckItemStateOnCard-uncheck': "%(authors)s unchecked %(count)d checklist items in %(cards)s.",
+
+    'card': "%(authors)s made %(count)d changes to %(cards)s.",
+
+    'default': "%(authors)s did %(action_type)s %(count)d times.",
+}
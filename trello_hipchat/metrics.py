@@ -0,0 +1,229 @@
+"""
+Counters, gauges and latency histograms for the polling and delivery paths,
+which can be served in Prometheus's text format or logged periodically as
+JSON.
+
+Metrics are off until enable() is called; until then, recording one is a
+single attribute check.
+"""
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+import cProfile
+from contextlib import contextmanager
+
+if sys.version_info[0] > 2:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    A registry of metrics. Each metric has a name and optional labels, given
+    as keyword arguments.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add value to a counter.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value, such as a latency in seconds, in a histogram.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time the body of a with statement into a histogram.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def gauge(self, name, func, **labels):
+        """
+        Register a gauge, whose value is found by calling func() whenever
+        the metrics are reported.
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def snapshot(self):
+        """
+        Return the current value of every metric, as a dictionary that can be
+        dumped as JSON.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = [(key, histogram.count, histogram.sum)
+                          for key, histogram in self._histograms.items()]
+            gauges = list(self._gauges.items())
+        return {
+            'counters': [_entry(key, value=value)
+                         for key, value in sorted(counters.items())],
+            'histograms': [_entry(key, count=count, sum=total)
+                           for key, count, total in sorted(histograms)],
+            'gauges': [_entry(key, value=func())
+                       for key, func in sorted(gauges, key=lambda g: g[0])],
+        }
+
+    def render_prometheus(self):
+        """
+        Return every metric in Prometheus's text exposition format.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(),
+                                key=lambda item: item[0])
+            gauges = sorted(self._gauges.items(), key=lambda item: item[0])
+        for (name, labels), value in counters:
+            lines.append('%s%s %s' % (name, _labels(labels), value))
+        for (name, labels), histogram in histograms:
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(labels + (('le', bound),)), count))
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(labels + (('le', '+Inf'),)), histogram.count))
+            lines.append('%s_count%s %d' % (name, _labels(labels),
+                                            histogram.count))
+            lines.append('%s_sum%s %f' % (name, _labels(labels),
+                                          histogram.sum))
+        for (name, labels), func in gauges:
+            lines.append('%s%s %s' % (name, _labels(labels), func()))
+        return '\n'.join(lines) + '\n'
+
+
+def _entry(key, **values):
+    name, labels = key
+    values['name'] = name
+    values['labels'] = dict(labels)
+    return values
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in labels)
+
+
+# The registry that the rest of the package records into.
+registry = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(port, host=''):
+    """
+    Serve the metrics in Prometheus's text format on a background thread.
+    """
+    server = HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def dump_periodically(interval):
+    """
+    Log a JSON snapshot of the metrics every `interval` seconds, on a
+    background thread.
+    """
+    def dump():
+        while True:
+            time.sleep(interval)
+            logger.info(json.dumps(registry.snapshot(), sort_keys=True))
+    thread = threading.Thread(target=dump)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def install_profiler(path_template, signum=getattr(signal, 'SIGUSR1', None)):
+    """
+    Make a signal (SIGUSR1 by default) toggle cProfile on the main thread.
+    When profiling is toggled off, the stats are written to
+    path_template % time.
+    """
+    if signum is None:
+        return
+    state = {'profile': None}
+
+    def toggle(signum, frame):
+        if state['profile'] is None:
+            logger.info('Profiling started')
+            state['profile'] = cProfile.Profile()
+            state['profile'].enable()
+        else:
+            state['profile'].disable()
+            path = path_template % time.time()
+            state['profile'].dump_stats(path)
+            state['profile'] = None
+            logger.info('Profiling stopped, stats written to %s', path)
+
+    signal.signal(signum, toggle)
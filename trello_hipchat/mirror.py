@@ -0,0 +1,258 @@
+"""
+A local copy of the lists, cards and checklists on each monitored board, so
+that the names and links in messages can be found without asking Trello.
+
+A board's copy is loaded from one /boards/<id> request, then kept up to date
+from the board's own actions (which say when something is created, renamed,
+moved, archived or deleted), and saved to disk so that a restart doesn't
+have to load it again.
+"""
+import os
+import json
+import time
+import threading
+
+# The kinds of objects the mirror keeps, as named in lookups and in the
+# /boards/<id> response.
+KINDS = ('lists', 'cards', 'checklists')
+
+# Action types that take a card, list or checklist off the board. Any other
+# action that names one of them says what it's called (and maybe where it
+# is) at the time, which is used to update it.
+REMOVALS = {
+    'card': frozenset(['deleteCard', 'moveCardFromBoard']),
+    'list': frozenset(['moveListFromBoard']),
+    'checklist': frozenset(['removeChecklistFromCard']),
+}
+
+
+class BoardMirror(object):
+    """
+    The lists, cards and checklists of the boards that have been loaded,
+    each indexed by ID.
+
+    get() answers the same lookups as the Trello API calls it replaces
+    ('checklist', 'card' and 'card-list', by object ID), returning None for
+    anything it doesn't know, so the caller can fall back to the API. A
+    board's copy is loaded again once it's `max_age` seconds old, in case it
+    missed something.
+
+    The mirror does nothing until enable() is called.
+    """
+    def __init__(self, max_age=24*60*60, retry_interval=5*60,
+                 clock=time.time):
+        self.enabled = False
+        self.path = None
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.loaded = {}
+        self.lists = {}
+        self.cards = {}
+        self.checklists = {}
+        self._attempted = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def enable(self, path=None, max_age=None):
+        """
+        Start mirroring, saving to (and first loading from) the JSON file at
+        `path`, if given.
+        """
+        self.enabled = True
+        self.path = path
+        if max_age is not None:
+            self.max_age = max_age
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            with self._lock:
+                self.loaded = saved['loaded']
+                for kind in KINDS:
+                    setattr(self, kind, saved[kind])
+        return self
+
+    def needs_snapshot(self, board_id):
+        """
+        Return True if the board should be loaded (again) from Trello.
+        """
+        now = self.clock()
+        loaded = self.loaded.get(board_id)
+        if loaded is not None and now - loaded < self.max_age:
+            return False
+        return now - self._attempted.get(board_id, 0) >= self.retry_interval
+
+    def snapshot_failed(self, board_id):
+        """
+        Note that loading the board failed, so it isn't retried right away.
+        """
+        self._attempted[board_id] = self.clock()
+
+    def load_snapshot(self, board_id, board):
+        """
+        Replace what the mirror knows about a board with a /boards/<id>
+        response that includes its lists, cards and checklists.
+        """
+        with self._lock:
+            self._forget(board_id)
+            for L in board.get('lists', ()):
+                self.lists[L['id']] = {'id': L['id'], 'name': L['name'],
+                                       'idBoard': board_id}
+            for card in board.get('cards', ()):
+                self.cards[card['id']] = {
+                    'id': card['id'], 'name': card['name'],
+                    'url': card['url'], 'idList': card['idList'],
+                    'idBoard': board_id
+                }
+            for checklist in board.get('checklists', ()):
+                self.checklists[checklist['id']] = {
+                    'id': checklist['id'], 'name': checklist['name'],
+                    'idCard': checklist['idCard'], 'idBoard': board_id
+                }
+            self.loaded[board_id] = self._attempted[board_id] = self.clock()
+            self._dirty = True
+
+    def _forget(self, board_id):
+        for kind in KINDS:
+            index = getattr(self, kind)
+            for object_id in [object_id for object_id, entry in index.items()
+                              if entry['idBoard'] == board_id]:
+                del index[object_id]
+        self.loaded.pop(board_id, None)
+
+    def retain(self, board_ids):
+        """
+        Forget every board that isn't in board_ids.
+        """
+        board_ids = set(board_ids)
+        with self._lock:
+            for board_id in list(self.loaded):
+                if board_id not in board_ids:
+                    self._forget(board_id)
+                    self._dirty = True
+
+    def get(self, kind, object_id):
+        """
+        Answer a 'checklist', 'card' or 'card-list' lookup by object ID, or
+        return None if the mirror can't.
+        """
+        entry = self.peek(kind, object_id)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def peek(self, kind, object_id):
+        """
+        Like get(), but without counting a hit or a miss.
+        """
+        with self._lock:
+            entry = None
+            if kind == 'checklist':
+                entry = self.checklists.get(object_id)
+                needed = ('idCard',)
+            elif kind == 'card':
+                entry = self.cards.get(object_id)
+                needed = ('name', 'url')
+            elif kind == 'card-list':
+                card = self.cards.get(object_id)
+                if card is not None and 'idList' in card:
+                    entry = self.lists.get(card['idList'])
+                needed = ('name',)
+            # Objects that were only seen in actions might not have been
+            # described fully.
+            if entry is not None and \
+               not all(key in entry for key in needed):
+                entry = None
+            return entry
+
+    def apply(self, action, board_id):
+        """
+        Update the mirror with what an action on a board changes, if the
+        board has been loaded. Actions should be applied in chronological
+        order.
+        """
+        data = action['data']
+        if board_id not in self.loaded:
+            return
+        action_type = action['type']
+        with self._lock:
+            for key in ('listBefore', 'listAfter'):
+                if key in data:
+                    self._update(self.lists, data[key], board_id)
+            if 'list' in data:
+                if action_type in REMOVALS['list']:
+                    self.lists.pop(data['list'].get('id'), None)
+                else:
+                    self._update(self.lists, data['list'], board_id)
+
+            if 'card' in data:
+                if action_type in REMOVALS['card']:
+                    self.cards.pop(data['card'].get('id'), None)
+                else:
+                    self._update_card(data, board_id)
+
+            if 'checklist' in data:
+                checklist = data['checklist']
+                if action_type in REMOVALS['checklist']:
+                    self.checklists.pop(checklist.get('id'), None)
+                else:
+                    entry = self._update(self.checklists, checklist, board_id)
+                    if entry is not None and 'id' in data.get('card', {}):
+                        entry['idCard'] = data['card']['id']
+
+    def _update_card(self, data, board_id):
+        card = data['card']
+        entry = self._update(self.cards, card, board_id)
+        if entry is None:
+            return
+        if 'url' not in entry:
+            entry['url'] = ('https://trello.com/c/%s/' %
+                            card.get('shortLink', card['id']))
+        new_list = data.get('listAfter') or data.get('list')
+        if new_list is not None and 'id' in new_list:
+            entry['idList'] = new_list['id']
+        elif 'idList' in card:
+            entry['idList'] = card['idList']
+
+    def _update(self, index, obj, board_id):
+        # Add or update an entry from the (partial) object in an action,
+        # returning None if it doesn't even have an ID.
+        if 'id' not in obj:
+            return None
+        entry = index.get(obj['id'])
+        if entry is None:
+            entry = index[obj['id']] = {'id': obj['id'], 'idBoard': board_id}
+        if 'name' in obj:
+            entry['name'] = obj['name']
+        entry['idBoard'] = board_id
+        self._dirty = True
+        return entry
+
+    def save(self):
+        """
+        Write the mirror to its file, if it has one and anything changed.
+        The file is replaced in one step, so a crash never leaves half of
+        it.
+        """
+        if not self.enabled or self.path is None or not self._dirty:
+            return
+        with self._lock:
+            saved = {'loaded': self.loaded}
+            for kind in KINDS:
+                saved[kind] = getattr(self, kind)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(saved, f)
+            self._dirty = False
+        os.rename(temp_path, self.path)
+
+    def stats(self):
+        """
+        Return the hit and miss counts and the number of boards loaded.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'boards': len(self.loaded)}
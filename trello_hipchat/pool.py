@@ -0,0 +1,67 @@
+"""
+A small bounded pool of worker threads, used to fan out blocking calls to the
+Trello and HipChat APIs.
+"""
+import sys
+import threading
+import logging
+
+if sys.version_info[0] > 2:
+    from queue import Queue
+else:
+    from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+# Sentinel telling a worker thread to exit.
+_STOP = object()
+
+
+def run_isolated(func, items, max_workers=1):
+    """
+    Call func(item) for every item, running at most max_workers calls at a
+    time.
+
+    Return a pair of dictionaries (results, errors): results maps each item
+    whose call succeeded to its return value, and errors maps each item whose
+    call raised to the exception. One failing item never affects the others.
+    With max_workers of 1 or less, the calls are simply made in order on the
+    current thread.
+    """
+    results = {}
+    errors = {}
+
+    def call(item):
+        try:
+            results[item] = func(item)
+        except Exception as e:
+            logger.exception('Call for %r failed', item)
+            errors[item] = e
+
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            call(item)
+        return results, errors
+
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            call(item)
+
+    threads = []
+    for _ in range(min(max_workers, len(items))):
+        queue.put(_STOP)
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results, errors
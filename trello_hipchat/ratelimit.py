@@ -0,0 +1,83 @@
+"""
+Rate limiting for outgoing API requests.
+"""
+import time
+import threading
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` operations per second on average, with bursts of up to
+    `capacity` operations. The bucket can also be paused outright, for when a
+    server tells us how long to back off.
+    """
+    def __init__(self, rate, capacity=None, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0, now - self._updated)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def take(self):
+        """
+        Try to take a token. Return 0 if one was taken, otherwise the number
+        of seconds to wait before trying again.
+        """
+        with self._lock:
+            now = self.clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def delay(self):
+        """
+        Return the number of seconds until a token can be taken, without
+        taking it.
+        """
+        with self._lock:
+            now = self.clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def available(self):
+        """
+        Return the number of tokens that could be taken right now.
+        """
+        with self._lock:
+            now = self.clock()
+            if now < self._paused_until:
+                return 0
+            self._refill(now)
+            return int(self._tokens)
+
+    def wait(self, sleep=time.sleep):
+        """
+        Block until a token can be taken, and take it.
+        """
+        delay = self.take()
+        while delay > 0:
+            sleep(delay)
+            delay = self.take()
+
+    def pause(self, seconds):
+        """
+        Don't hand out any tokens for the next `seconds` seconds.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     self.clock() + seconds)
@@ -0,0 +1,545 @@
+"""
+Replay recorded Trello activity through the polling path, against fake
+Trello and HipChat servers running in this process, to measure performance
+and to check that the messages it produces haven't changed.
+
+The corpus is a JSON Lines file. Each line is either a recorded response to
+/boards/<id>/actions:
+
+    {"board_id": "...", "actions": [...]}
+
+or a recorded response to any other GET request, such as a checklist lookup:
+
+    {"path": "/checklists/...", "response": {...}}
+
+Board lines are replayed in order: each one makes its actions visible on the
+fake Trello, and then that board is polled the way run_forever polls it.
+Lookups that weren't recorded are answered from what the actions say about
+their cards, lists and checklists.
+"""
+from __future__ import print_function
+import io
+import sys
+import json
+import time
+import threading
+from collections import defaultdict, Counter
+from argparse import ArgumentParser
+
+if sys.version_info[0] > 2:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError as URLHTTPError
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+    from urllib2 import Request, urlopen, HTTPError as URLHTTPError
+
+import trello_hipchat
+from . import poll_board, from_trello_date, lookup_cache
+from .routing import Route
+from .mirror import BoardMirror
+from .state import StateStore
+
+
+def read_corpus(path):
+    """
+    Read a corpus file, returning the list of (board_id, actions) pairs and
+    a dictionary of recorded lookups by path.
+    """
+    responses = []
+    lookups = {}
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'board_id' in entry:
+                responses.append((entry['board_id'], entry['actions']))
+            else:
+                lookups[entry['path']] = entry['response']
+    return responses, lookups
+
+
+def repeat_responses(responses, repeat):
+    """
+    Yield the board responses `repeat` times over, changing the actions' IDs
+    and dates in each copy so they count as new. The copies are made as
+    they're needed, so a large repeat doesn't take a lot of memory.
+    """
+    times = [from_trello_date(A['date'])
+             for _, actions in responses for A in actions]
+    span = (max(times) - min(times) + 1) if times else 1
+    for copy in range(repeat):
+        for board_id, actions in responses:
+            yield board_id, [_shifted(A, copy, copy * span) for A in actions]
+
+
+def _shifted(action, copy, seconds):
+    if copy == 0:
+        return action
+    action = dict(action)
+    action['id'] = '%s-%d' % (action['id'], copy)
+    timestamp = from_trello_date(action['date']) + seconds
+    action['date'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                   time.gmtime(timestamp))
+    return action
+
+
+def _action_order(action):
+    return (action['date'], action['id'])
+
+
+class _QuietServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Concurrent polling opens many connections at once; with the default
+    # backlog of 5, the rest wait a second to retry.
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and body go out in separate writes, which Nagle's
+    # algorithm would otherwise delay.
+    disable_nagle_algorithm = True
+
+    def respond(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTrello(object):
+    """
+    An in-process stand-in for the parts of the Trello API that polling
+    uses: paged board actions, board snapshots for the board mirror, lookups
+    of checklists, cards and card lists, and /batch. It also keeps the
+    webhooks registered with it, and can post actions to them.
+
+    `latency` is the number of seconds to wait before answering a GET, to
+    stand in for the round trip to the real Trello.
+    """
+    def __init__(self, lookups=None, latency=0):
+        self.lookups = dict(lookups or {})
+        self.latency = latency
+        self.actions = defaultdict(list)
+        self.action_ids = defaultdict(set)
+        self.cards = {}
+        self.card_lists = {}
+        self.checklists = {}
+        self.webhooks = []
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(_Handler):
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                query = dict((key, values[0]) for key, values
+                             in parse_qs(parts.query).items())
+                path = parts.path[len('/1'):]
+                fake.calls[trello_hipchat.endpoint(path)] += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, data = fake.get(path, query)
+                self.respond(status, data)
+
+            def do_POST(self):
+                parts = urlsplit(self.path)
+                query = dict((key, values[0]) for key, values
+                             in parse_qs(parts.query).items())
+                path = parts.path[len('/1'):]
+                fake.calls['POST ' + trello_hipchat.endpoint(path)] += 1
+                if path != '/webhooks':
+                    self.respond(404, {'message': 'not found'})
+                    return
+                with fake._lock:
+                    hook = {'id': 'webhook%d' % len(fake.webhooks),
+                            'idModel': query['idModel'],
+                            'callbackURL': query['callbackURL'],
+                            'description': query.get('description', ''),
+                            'active': True}
+                    fake.webhooks.append(hook)
+                self.respond(200, hook)
+
+        self.server = _QuietServer(('127.0.0.1', 0), Handler)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/1' % self.server.server_port
+
+    def publish(self, board_id, actions):
+        """
+        Make actions visible on a board, and learn what they say about its
+        cards, lists and checklists.
+        """
+        with self._lock:
+            known = self.action_ids[board_id]
+            new = sorted((A for A in actions if A['id'] not in known),
+                         key=_action_order)
+            if not new:
+                return
+            # Keep each board's actions oldest first, so that new ones can
+            # usually just be appended.
+            board_actions = self.actions[board_id]
+            if board_actions and \
+               _action_order(new[0]) < _action_order(board_actions[-1]):
+                board_actions.extend(new)
+                board_actions.sort(key=_action_order)
+            else:
+                board_actions.extend(new)
+            known.update(A['id'] for A in new)
+            for A in new:
+                self._learn(A['data'])
+
+    def _learn(self, data):
+        card = data.get('card')
+        if card is not None:
+            known = self.cards.get(card['id'], {})
+            self.cards[card['id']] = {
+                'id': card['id'],
+                'name': card.get('name', known.get('name', '')),
+                'url': 'https://trello.com/c/%s/' % card['id']
+            }
+            the_list = data.get('list') or data.get('listAfter')
+            if the_list is not None:
+                self.card_lists[card['id']] = the_list
+        checklist = data.get('checklist')
+        if checklist is not None and card is not None:
+            self.checklists[checklist['id']] = {'id': checklist['id'],
+                                                'idCard': card['id']}
+
+    def get(self, path, query):
+        """
+        Answer a GET request, returning a status and a JSON-able response.
+        """
+        if path == '/batch':
+            responses = []
+            for url in query.get('urls', '').split(','):
+                status, data = self.get(url, {})
+                if status == 200:
+                    responses.append({'200': data})
+                else:
+                    responses.append({'statusCode': status})
+            return 200, responses
+        if path in self.lookups:
+            return 200, self.lookups[path]
+        if path.startswith('/tokens/') and path.endswith('/webhooks'):
+            with self._lock:
+                return 200, list(self.webhooks)
+
+        parts = path.strip('/').split('/')
+        with self._lock:
+            if parts[0] == 'boards' and parts[2:] == ['actions']:
+                return 200, self._actions_page(parts[1], query)
+            if parts[0] == 'boards' and len(parts) == 2:
+                return 200, self._board(parts[1])
+            if parts[0] == 'checklists' and parts[1] in self.checklists:
+                return 200, self.checklists[parts[1]]
+            if parts[0] == 'cards' and parts[2:] == ['list'] and \
+               parts[1] in self.cards:
+                # The recording might never say which list a card is in.
+                return 200, self.card_lists.get(parts[1],
+                                                {'id': '', 'name': ''})
+            if parts[0] == 'cards' and len(parts) == 2 and \
+               parts[1] in self.cards:
+                return 200, self.cards[parts[1]]
+        return 404, {'message': 'not found'}
+
+    def post_webhooks(self, board_id, action, secret):
+        """
+        Post an action on a board to every webhook registered for it, signed
+        with the API secret the way Trello signs them. Return the response
+        status for each webhook.
+        """
+        from .webhook import signature
+        body = json.dumps({'action': action,
+                           'model': {'id': board_id}}).encode('utf-8')
+        statuses = []
+        with self._lock:
+            hooks = [hook for hook in self.webhooks
+                     if hook['idModel'] == board_id]
+        for hook in hooks:
+            request = Request(hook['callbackURL'], body, {
+                'Content-Type': 'application/json',
+                'X-Trello-Webhook': signature(body, hook['callbackURL'],
+                                              secret)})
+            try:
+                response = urlopen(request)
+                statuses.append(response.getcode())
+                response.close()
+            except URLHTTPError as e:
+                statuses.append(e.code)
+        return statuses
+
+    def _board(self, board_id):
+        """
+        Return a board with all the lists, cards and checklists learned so
+        far (from any board, since recordings don't always say).
+        """
+        lists = dict((L['id'], {'id': L['id'], 'name': L['name']})
+                     for L in self.card_lists.values())
+        cards = [dict(card, idList=self.card_lists.get(card_id,
+                                                       {'id': ''})['id'])
+                 for card_id, card in self.cards.items()]
+        checklists = [dict(checklist, name='')
+                      for checklist in self.checklists.values()]
+        return {'id': board_id, 'name': board_id,
+                'lists': list(lists.values()), 'cards': cards,
+                'checklists': checklists}
+
+    def _actions_page(self, board_id, query):
+        """
+        Return a page of a board's actions, newest first, as Trello would.
+        """
+        actions = self.actions[board_id]
+        end = len(actions)
+        if 'before' in query:
+            for index in range(len(actions) - 1, -1, -1):
+                if actions[index]['id'] == query['before']:
+                    end = index
+                    break
+        since = query.get('since', '')[:19]
+        limit = int(query.get('limit', 50))
+        page = []
+        for index in range(end - 1, -1, -1):
+            if len(page) >= limit or actions[index]['date'][:19] < since:
+                break
+            page.append(actions[index])
+        return page
+
+
+class FakeHipChat(object):
+    """
+    An in-process stand-in for HipChat's message API, which records each
+    message it receives and when. It can be told to fail (see fail()), and
+    to close connections that sit idle for more than `idle_timeout` seconds,
+    as servers behind load balancers do.
+    """
+    def __init__(self, idle_timeout=None):
+        self.messages = []
+        self.rejected = []
+        self.failures = []
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(_Handler):
+            timeout = idle_timeout
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                form = parse_qs(self.rfile.read(length).decode('utf-8'))
+                fake.calls[urlsplit(self.path).path] += 1
+                with fake._lock:
+                    failure = fake.failures.pop(0) if fake.failures else None
+                    if failure is not None:
+                        fake.rejected.append((time.time(),
+                                              form['room_id'][0],
+                                              form['message'][0]))
+                    else:
+                        fake.messages.append((time.time(),
+                                              form['room_id'][0],
+                                              form['message'][0]))
+                if failure is not None:
+                    status, headers = failure
+                    if status is None:
+                        self.close_connection = True
+                        return
+                    self.respond(status, {'error': status}, headers)
+                else:
+                    self.respond(200, {'status': 'sent'})
+
+        self.server = _QuietServer(('127.0.0.1', 0), Handler)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/v1' % self.server.server_port
+
+    def fail(self, status, count=1, headers=None):
+        """
+        Answer the next `count` messages with an error status (and response
+        headers, such as Retry-After) instead of taking them. A status of None
+        drops the connection without answering.
+        """
+        with self._lock:
+            self.failures.extend([(status, headers or {})] * count)
+
+
+class ReplayConfig(object):
+    """
+    The configuration a replay runs with, unless it's given a config file.
+    """
+    TRELLO_API_KEY = 'replay'
+    TRELLO_TOKEN = 'replay'
+    HIPCHAT_API_KEY = 'replay'
+    HIPCHAT_COLOR = 'purple'
+
+    def __init__(self, board_ids):
+        self.MONITOR = [{'board_id': board_id, 'room_id': 'replay',
+                         'list_names': ['*']}
+                        for board_id in sorted(board_ids)]
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _peak_memory():
+    """
+    Return the peak memory use in bytes, using tracemalloc if it's running
+    and the process's maximum resident set size otherwise.
+    """
+    try:
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[1]
+    except ImportError:
+        pass
+    import resource
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def replay(responses, lookups, config=None, repeat=1, mirror=False):
+    """
+    Replay recorded board responses (`repeat` times over) against fake
+    servers, and return a report of what happened, including the messages
+    HipChat received. If `mirror` is True, lookups go through a (fresh)
+    board mirror first.
+    """
+    trello_server = FakeTrello(lookups)
+    hipchat_server = FakeHipChat()
+    for server in (trello_server.server, hipchat_server.server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    if config is None:
+        config = ReplayConfig(set(board_id for board_id, _ in responses))
+    routes_by_board = defaultdict(list)
+    for route in Route.from_config(config):
+        routes_by_board[route.board_id].append(route)
+
+    saved = (trello_hipchat.TRELLO_API_URL, trello_hipchat.HIPCHAT_API_URL,
+             trello_hipchat.board_mirror)
+    trello_hipchat.TRELLO_API_URL = trello_server.url
+    trello_hipchat.HIPCHAT_API_URL = hipchat_server.url
+    trello_hipchat.board_mirror = BoardMirror()
+    if mirror:
+        trello_hipchat.board_mirror.enable()
+    lookup_cache.clear()
+    state = StateStore(':memory:')
+    latencies = []
+    total_actions = 0
+    try:
+        start = time.time()
+        for board_id, actions in repeat_responses(responses, repeat):
+            trello_server.publish(board_id, actions)
+            total_actions += len(actions)
+            published = time.time()
+            received = len(hipchat_server.messages)
+            for new_last_time, page in poll_board(
+                    config, board_id, routes_by_board[board_id],
+                    state.last_time(board_id, 0), max_backlog=None,
+                    seen=state.is_delivered, ledger=state):
+                state.record(board_id, new_last_time, page[0]['id'],
+                             [A['id'] for A in page])
+            latencies.extend(sent - published for sent, _, _
+                             in hipchat_server.messages[received:])
+        elapsed = time.time() - start
+    finally:
+        (trello_hipchat.TRELLO_API_URL, trello_hipchat.HIPCHAT_API_URL,
+         trello_hipchat.board_mirror) = saved
+        trello_server.server.shutdown()
+        hipchat_server.server.shutdown()
+        state.close()
+
+    calls = Counter(trello_server.calls)
+    calls.update(dict(('hipchat ' + path, count)
+                      for path, count in hipchat_server.calls.items()))
+    return {
+        'actions': total_actions,
+        'messages': len(hipchat_server.messages),
+        'seconds': elapsed,
+        'actions_per_second': total_actions / elapsed if elapsed else 0.0,
+        'p50_latency': _percentile(latencies, 0.5),
+        'p99_latency': _percentile(latencies, 0.99),
+        'http_calls': dict(calls),
+        'peak_memory': _peak_memory(),
+        'output': [(room_id, message)
+                   for _, room_id, message in hipchat_server.messages],
+    }
+
+
+def render_output(output):
+    """
+    Render the messages a replay produced as text, one message per line,
+    for comparing with a golden file.
+    """
+    return u''.join(u'%s\t%s\n' % (room_id, message)
+                    for room_id, message in output)
+
+
+def main():
+    """
+    Command-line interface.
+    Replay a corpus and print a report, optionally checking the messages
+    against a golden file.
+    """
+    parser = ArgumentParser()
+    parser.add_argument('corpus', type=str,
+                        help='JSON Lines file of recorded Trello responses')
+    parser.add_argument('-c', type=str, dest='config_file', default=None,
+                        help=('Python config file whose MONITOR to use '
+                              '(by default, every board goes to one room)'))
+    parser.add_argument('-r', type=int, dest='repeat', default=1,
+                        help='Number of times to replay the corpus')
+    parser.add_argument('-g', type=str, dest='golden', default=None,
+                        help='Golden file to compare the messages with')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='Write the messages to the golden file instead')
+    parser.add_argument('--mirror', action='store_true',
+                        help='Look up names in a board mirror first')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help=('Measure peak memory with tracemalloc, which '
+                              'is more precise but slower'))
+    args = parser.parse_args()
+
+    config = None
+    if args.config_file:
+        from .cli import load_config
+        config = load_config(args.config_file)
+    if args.trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+
+    responses, lookups = read_corpus(args.corpus)
+    report = replay(responses, lookups, config, args.repeat, args.mirror)
+    output = render_output(report.pop('output'))
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.golden and args.update_golden:
+        with io.open(args.golden, 'w', encoding='utf-8', newline='') as f:
+            f.write(output)
+    elif args.golden:
+        with io.open(args.golden, encoding='utf-8', newline='') as f:
+            expected = f.read()
+        if output != expected:
+            print('Messages differ from %s' % args.golden)
+            sys.exit(1)
+        print('Messages match %s' % args.golden)
@@ -0,0 +1,193 @@
+"""
+Precompiled routing rules for MONITOR entries, so that deciding whether an
+action goes to a room doesn't re-parse the entry's settings for every action.
+"""
+import re
+import fnmatch
+
+from .templates import RENDERERS
+from .filters import compile_filters, select
+
+
+def base_type(action_type):
+    """
+    Return the Trello action type of a (possibly) subtyped action type, such
+    as 'updateCard' for 'updateCard-move'.
+    """
+    return action_type.split('-', 1)[0]
+
+
+class Route(object):
+    """
+    The compiled form of one MONITOR entry.
+
+    The list name patterns are combined into a single regular expression,
+    and include_actions is indexed into a set of Trello action types (for
+    checking an action before any work is done on it) and a set of the
+    action types and subtypes it names (for checking it once its subtype is
+    known). 'all' includes everything; naming an action type also includes
+    all of its subtypes. `format` names the renderer (in
+    templates.RENDERERS) to write the room's messages with. Filters can be
+    functions or filter specs (see filters.py), which are compiled here.
+    """
+    def __init__(self, board_id, room_id, list_names, include_actions=['all'],
+                 filters=[], digest_window=None, digest_by='action_type',
+                 format='html'):
+        if format not in RENDERERS:
+            raise ValueError('Unknown message format: %r' % format)
+        self.board_id = board_id
+        self.room_id = room_id
+        self.list_names = list(list_names)
+        self.include_actions = list(include_actions)
+        self.filters = list(filters)
+        self.filter_specs, self.filter_functions = compile_filters(filters)
+        self.digest_window = digest_window
+        self.digest_by = digest_by
+        self.format = format
+
+        self._exact_names = frozenset(self.list_names)
+        if self.list_names:
+            self._list_regex = re.compile('|'.join(
+                '(?:%s)' % fnmatch.translate(pattern)
+                for pattern in self.list_names
+            ))
+        else:
+            self._list_regex = None
+
+        self.includes_all = 'all' in self.include_actions
+        self.included_types = frozenset(self.include_actions)
+        self.included_base_types = frozenset(
+            base_type(atype) for atype in self.include_actions)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the routes for every entry in config.MONITOR.
+        """
+        return [cls(**parameters) for parameters in config.MONITOR]
+
+    def includes_base_type(self, action_type):
+        """
+        Return True if this route might include actions of this Trello
+        action type, depending on their subtype.
+        """
+        return self.includes_all or action_type in self.included_base_types
+
+    def includes(self, action_type):
+        """
+        Return True if this route includes an action of this type, which may
+        have a subtype.
+        """
+        return (self.includes_all or action_type in self.included_types or
+                base_type(action_type) in self.included_types)
+
+    def matches_list(self, name):
+        """
+        Return True if the list name matches one of the route's list name
+        patterns (which use Unix shell wildcards).
+        """
+        if name in self._exact_names:
+            return True
+        return (self._list_regex is not None and
+                self._list_regex.match(name) is not None)
+
+    def select(self, batch, positions):
+        """
+        Return the positions, out of the given positions of actions in an
+        ActionBatch, of the ones that pass all of the route's filters.
+        """
+        return select(batch, positions, self.filter_specs,
+                      self.filter_functions)
+
+
+def _global_names(code):
+    """
+    Return the names a code object (or any function defined in it) might
+    read as globals.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names |= _global_names(const)
+    return names
+
+
+def _comparable(value, seen=()):
+    """
+    Turn a MONITOR setting into something that compares equal to the same
+    setting loaded again. Functions (such as filters) are compared by their
+    code, defaults and closure, and the values of the config's globals they
+    read, rather than their identity, which changes every time the config
+    is loaded.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_comparable(item, seen) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_comparable(item, seen) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _comparable(item, seen))
+                            for key, item in value.items()))
+    code = getattr(value, '__code__', None)
+    if code is not None:
+        if id(value) in seen:
+            # A function that (indirectly) calls itself.
+            return code
+        seen += (id(value),)
+        closure = tuple(_comparable(cell.cell_contents, seen)
+                        for cell in value.__closure__ or ())
+        module = getattr(value, '__globals__', {})
+        used = tuple((name, _comparable(module[name], seen))
+                     for name in sorted(_global_names(code))
+                     if name in module)
+        return (code, _comparable(value.__defaults__ or (), seen), closure,
+                used)
+    return value
+
+
+class RouteTable(object):
+    """
+    The routes for the MONITOR entries, grouped by board, which can be
+    updated in place from a changed MONITOR.
+
+    An update only compiles Routes for the entries that changed, and keeps
+    the same list of routes for boards whose entries didn't; `by_board` is
+    replaced in one step, so a reader always sees either the old or the new
+    routes.
+    """
+    def __init__(self, monitor=()):
+        self.by_board = {}
+        self._routes = {}
+        self.update(monitor)
+
+    def update(self, monitor):
+        """
+        Switch to the routes for a new list of MONITOR entries. Return the
+        sets of board IDs that were added and removed.
+        """
+        routes = {}
+        keys_by_board = {}
+        for parameters in monitor:
+            key = _comparable(parameters)
+            route = self._routes.get(key) or routes.get(key)
+            if route is None:
+                route = Route(**parameters)
+            routes[key] = route
+            keys_by_board.setdefault(route.board_id, []).append(key)
+
+        by_board = {}
+        for board_id, keys in keys_by_board.items():
+            old = self.by_board.get(board_id)
+            new = [routes[key] for key in keys]
+            if old is not None and len(old) == len(new) and \
+               all(a is b for a, b in zip(old, new)):
+                new = old
+            by_board[board_id] = new
+
+        added = set(by_board) - set(self.by_board)
+        removed = set(self.by_board) - set(by_board)
+        self._routes = routes
+        self.by_board = by_board
+        return added, removed
+
+    def __iter__(self):
+        return iter(self.by_board)
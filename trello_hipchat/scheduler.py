@@ -0,0 +1,101 @@
+"""
+Scheduling of board polls, so that busy boards are polled often and quiet
+ones rarely, without going over Trello's rate limit.
+"""
+import time
+import heapq
+
+
+class BoardScheduler(object):
+    """
+    Keeps track of when each board is next due to be polled, in a priority
+    queue keyed by that time.
+
+    Each board has its own polling interval. A poll that finds new actions
+    brings the board's interval down to min_interval; a poll that finds none
+    multiplies it by `backoff`, up to max_interval. If `bucket` is given
+    (the TokenBucket that Trello requests are charged to; see
+    limit_trello_requests()), polls are only started while it has a token
+    left, and boards that are due beyond that simply wait their turn. The
+    polls' requests take the tokens.
+    """
+    def __init__(self, board_ids=(), min_interval=60, max_interval=60,
+                 backoff=2.0, bucket=None, clock=time.time):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.clock = clock
+        self.bucket = bucket
+        self.intervals = {}
+        self._heap = []
+        for board_id in board_ids:
+            self.add(board_id)
+
+    def add(self, board_id, due=None):
+        """
+        Start scheduling a board, due right away unless `due` is given.
+        """
+        if board_id in self.intervals:
+            return
+        self.intervals[board_id] = self.min_interval
+        heapq.heappush(self._heap, (self.clock() if due is None else due,
+                                    board_id))
+
+    def remove(self, board_id):
+        """
+        Stop scheduling a board.
+        """
+        self.intervals.pop(board_id, None)
+        self._heap = [(due, other) for due, other in self._heap
+                      if other != board_id]
+        heapq.heapify(self._heap)
+
+    def __contains__(self, board_id):
+        return board_id in self.intervals
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def pop_due(self):
+        """
+        Remove and return the boards that are due now, most overdue first,
+        as far as the budget allows. The caller should hand each of them
+        back to done() once it has been polled.
+        """
+        now = self.clock()
+        # Each poll makes at least one request, so don't start more polls
+        # than there are tokens left.
+        allowed = None if self.bucket is None else self.bucket.available()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            if allowed is not None and len(due) >= allowed:
+                break
+            due.append(heapq.heappop(self._heap)[1])
+        return due
+
+    def done(self, board_id, active):
+        """
+        Schedule a board's next poll, given whether its last poll found
+        anything.
+        """
+        if board_id not in self.intervals:
+            return
+        if active:
+            interval = self.min_interval
+        else:
+            interval = min(self.max_interval,
+                           self.intervals[board_id] * self.backoff)
+        self.intervals[board_id] = interval
+        heapq.heappush(self._heap, (self.clock() + interval, board_id))
+
+    def next_due(self):
+        """
+        Return the time when the next poll should start, taking the budget
+        into account, or None if nothing is scheduled.
+        """
+        if not self._heap:
+            return None
+        due = self._heap[0][0]
+        if self.bucket is not None:
+            due = max(due, self.clock() + self.bucket.delay())
+        return due
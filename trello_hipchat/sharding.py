@@ -0,0 +1,213 @@
+"""
+Splitting the monitored boards between several worker processes.
+
+Each worker is started with a shard number i out of N, and owns the boards
+that a consistent hash ring assigns to it. Workers announce that they're
+alive by refreshing a lease file in the shared state directory; when a
+worker's lease expires, the ring is rebuilt from the live shards so its
+boards move to the others, and move back when it returns. A lock file per
+board makes sure that two workers never poll the same board at once while
+ownership is changing hands. The messages waiting in a dead worker's
+dead-letter spool are sent by the workers that took over its boards, under a
+lock file per spool.
+
+The locks are POSIX file locks, so sharding isn't available on platforms
+without fcntl, such as Windows.
+"""
+import os
+import time
+import errno
+import bisect
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows; run_forever still works there, just without --shard.
+    fcntl = None
+
+
+def parse_shard(value):
+    """
+    Parse a shard specification like '2/4' into a (shard, count) pair,
+    raising ValueError if it doesn't make sense.
+    """
+    shard, count = [int(part) for part in value.split('/')]
+    if count < 1 or not 0 <= shard < count:
+        raise ValueError('Shard must be between 0 and %d' % (count - 1))
+    return shard, count
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    A consistent hash ring, which assigns keys to shards so that adding or
+    removing a shard only moves the keys that it owns.
+    """
+    def __init__(self, shards, replicas=100):
+        points = sorted((_hash('%s-%d' % (shard, replica)), shard)
+                        for shard in shards for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def owner(self, key):
+        """
+        Return the shard that owns a key.
+        """
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+class ShardCoordinator(object):
+    """
+    Coordinates one worker's share of the boards with the other workers
+    that use the same state directory.
+    """
+    def __init__(self, directory, shard, count, lease_ttl=120,
+                 clock=time.time):
+        if fcntl is None:
+            raise NotImplementedError('Sharding needs fcntl file locks, '
+                                      'which this platform does not have')
+        self.directory = directory
+        self.shard = shard
+        self.count = count
+        self.lease_ttl = lease_ttl
+        self.clock = clock
+        self.lock_directory = os.path.join(directory, 'locks')
+        try:
+            os.makedirs(self.lock_directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def state_path(self, shard=None):
+        """
+        Return the path of a shard's state database (this worker's, unless
+        another shard is given).
+        """
+        if shard is None:
+            shard = self.shard
+        return os.path.join(self.directory, 'state-%d-of-%d.sqlite'
+                            % (shard, self.count))
+
+    def other_state_paths(self):
+        """
+        Return the paths of the other shards' state databases that exist.
+        """
+        paths = [self.state_path(shard) for shard in range(self.count)
+                 if shard != self.shard]
+        return [path for path in paths if os.path.exists(path)]
+
+    def spool_directory(self, shard=None):
+        """
+        Return the directory of a shard's dead-letter spool (this worker's,
+        unless another shard is given).
+        """
+        if shard is None:
+            shard = self.shard
+        return os.path.join(self.directory, 'dead-letters-%d-of-%d'
+                            % (shard, self.count))
+
+    def orphaned_shards(self):
+        """
+        Return the other shards whose leases have expired and that have left
+        a spool directory behind. Nobody else sends the messages in them
+        until those workers come back.
+        """
+        live = set(self.live_shards())
+        return [shard for shard in range(self.count)
+                if shard not in live and
+                os.path.isdir(self.spool_directory(shard))]
+
+    def _lease_path(self, shard):
+        return os.path.join(self.directory, 'shard-%d-of-%d.lease'
+                            % (shard, self.count))
+
+    def heartbeat(self):
+        """
+        Renew this worker's lease. It has to be called more often than every
+        lease_ttl seconds.
+        """
+        path = self._lease_path(self.shard)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write('%d %f\n' % (os.getpid(), self.clock()))
+        os.rename(temp_path, path)
+
+    def live_shards(self):
+        """
+        Return the shards whose leases haven't expired. This worker always
+        counts as live.
+        """
+        now = self.clock()
+        live = []
+        for shard in range(self.count):
+            if shard == self.shard:
+                live.append(shard)
+                continue
+            try:
+                renewed = os.path.getmtime(self._lease_path(shard))
+            except OSError:
+                continue
+            if now - renewed < self.lease_ttl:
+                live.append(shard)
+        return live
+
+    def owned(self, board_ids):
+        """
+        Return the boards, out of board_ids, that this worker owns now.
+        """
+        ring = HashRing(self.live_shards())
+        return [board_id for board_id in board_ids
+                if ring.owner(board_id) == self.shard]
+
+    def lock_board(self, board_id):
+        """
+        Try to take the lock on a board. Return a BoardLock to release
+        later, or None if another worker holds it.
+        """
+        return self._lock('%s.lock' % board_id)
+
+    def lock_spool(self, shard=None):
+        """
+        Try to take the lock on a shard's spool (this worker's, unless
+        another shard is given), which has to be held while sending its
+        messages. Return a BoardLock to release later, or None if another
+        worker holds it.
+        """
+        if shard is None:
+            shard = self.shard
+        return self._lock('dead-letters-%d-of-%d.lock' % (shard, self.count))
+
+    def _lock(self, name):
+        f = open(os.path.join(self.lock_directory, name), 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return BoardLock(f)
+
+
+class BoardLock(object):
+    """
+    A held lock on a board (or a spool), which is released when the worker
+    exits even if it crashes.
+    """
+    def __init__(self, f):
+        self._file = f
+
+    def release(self):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,154 @@
+"""
+A dead-letter spool for messages that couldn't be delivered because HipChat
+(or whatever SEND_MESSAGE sends to) was down, so that they aren't lost even
+though the actions they're about have been recorded as done. They're kept on
+disk, one file per message, and sent again in order once it's back.
+"""
+import os
+import json
+import logging
+import threading
+from collections import Counter
+
+from .transport import HTTPError
+
+logger = logging.getLogger(__name__)
+
+
+def undeliverable(error):
+    """
+    Return True if an error from sending a message means the message might
+    still be delivered later (a network error, an open circuit, throttling
+    or a 5xx response), rather than that it was rejected.
+    """
+    if isinstance(error, HTTPError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, IOError)
+
+
+class DeadLetterSpool(object):
+    """
+    Messages waiting to be sent again, kept as numbered JSON files in a
+    directory so that they survive a restart and are replayed in the order
+    they were spooled. The API key isn't saved; the current one is used when
+    they're replayed.
+
+    When workers share a state directory, another worker may send (and
+    remove) the messages in this one's spool while it's away, so before each
+    replay the spool is read again if its files don't match its count.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._rooms = Counter()
+        self._next = 0
+        self._scan()
+
+    def _scan(self):
+        with self._lock:
+            names = self._names()
+            if len(names) == sum(self._rooms.values()):
+                return
+            self._rooms = Counter(self._read(name)['room_id']
+                                  for name in names)
+            if names:
+                self._next = max(self._next,
+                                 int(names[-1].split('.')[0]) + 1)
+
+    def _names(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.json'))
+
+    def _read(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return json.load(f)
+
+    def __len__(self):
+        with self._lock:
+            return sum(self._rooms.values())
+
+    def waiting(self, room_id):
+        """
+        Return True if messages to the room are waiting in the spool, in
+        which case new ones should go after them.
+        """
+        with self._lock:
+            return self._rooms[room_id] > 0
+
+    def put(self, room_id, message, kwargs):
+        """
+        Add a message, with the keyword arguments it was sent with, to the
+        end of the spool.
+        """
+        kwargs = dict((key, value) for key, value in kwargs.items()
+                      if key != 'really')
+        with self._lock:
+            name = '%012d.json' % self._next
+            self._next += 1
+            path = os.path.join(self.directory, name)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'room_id': room_id, 'message': message,
+                           'kwargs': kwargs}, f)
+            os.rename(path + '.tmp', path)
+            self._rooms[room_id] += 1
+
+    def _remove(self, name, room_id):
+        with self._lock:
+            os.remove(os.path.join(self.directory, name))
+            self._rooms[room_id] -= 1
+
+    def replay(self, send, api_key):
+        """
+        Send the spooled messages with `send` (which takes the same
+        arguments as send_hipchat_message()), oldest first, stopping at the
+        first one that still can't be delivered. Messages that are rejected
+        are logged and discarded. Return the number sent.
+        """
+        self._scan()
+        sent = 0
+        while True:
+            names = self._names()
+            if not names:
+                return sent
+            for name in names:
+                item = self._read(name)
+                try:
+                    send(item['room_id'], item['message'], api_key,
+                         **item['kwargs'])
+                except (HTTPError, IOError) as e:
+                    if undeliverable(e):
+                        logger.info('Still unable to send spooled messages: '
+                                    '%s', e)
+                        return sent
+                    logger.error('Discarding a spooled message to room %s: '
+                                 '%s', item['room_id'], e)
+                else:
+                    sent += 1
+                self._remove(name, item['room_id'])
+
+
+def spooling(send, spool):
+    """
+    Return a function like `send` that, instead of raising an error when a
+    message can't be delivered now, puts it in the spool; and that spools
+    messages to rooms that already have messages waiting, so they stay in
+    order. Messages that are rejected are logged and discarded, so that one
+    bad message doesn't hold up the rest.
+    """
+    def send_or_spool(room_id, message, api_key, **kwargs):
+        if spool.waiting(room_id):
+            spool.put(room_id, message, kwargs)
+            return
+        try:
+            send(room_id, message, api_key, **kwargs)
+        except (HTTPError, IOError) as e:
+            if not undeliverable(e):
+                logger.error('Message to room %s was rejected: %s',
+                             room_id, e)
+                return
+            logger.warning('Could not send a message to room %s, spooling '
+                           'it: %s', room_id, e)
+            spool.put(room_id, message, kwargs)
+    return send_or_spool
@@ -0,0 +1,208 @@
+"""
+Crash-safe storage of how far each board has been reported, in a SQLite
+database.
+"""
+import json
+import time
+import sqlite3
+import threading
+
+# How long to remember the IDs of delivered actions, which is how far back a
+# restart can be sure not to post anything twice.
+DEDUPE_RETENTION = 2 * 24 * 60 * 60
+
+
+class StateStore(object):
+    """
+    Records, for each board, the time and ID of the last action that was
+    reported, an index of recently delivered action IDs, and which rooms
+    each recent action has been sent (or queued) to, for the actions whose
+    page hasn't been recorded yet.
+
+    Every update for a board is committed in a single transaction, so a
+    crash leaves either the old state or the new one. Boards that haven't
+    changed are never written.
+    """
+    def __init__(self, path, retention=DEDUPE_RETENTION, clock=time.time):
+        self.path = path
+        self.retention = retention
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30,
+                                   check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS boards ('
+                ' board_id TEXT PRIMARY KEY,'
+                ' last_time REAL NOT NULL,'
+                ' last_action_id TEXT)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS delivered ('
+                ' action_id TEXT PRIMARY KEY,'
+                ' board_id TEXT NOT NULL,'
+                ' delivered_at REAL NOT NULL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS delivered_at_index'
+                ' ON delivered (delivered_at)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS sent ('
+                ' action_id TEXT NOT NULL,'
+                ' room_id TEXT NOT NULL,'
+                ' board_id TEXT NOT NULL,'
+                ' sent_at REAL NOT NULL,'
+                ' PRIMARY KEY (action_id, room_id))')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS sent_at_index ON sent (sent_at)')
+        self._boards = dict(
+            (board_id, (last_time, last_action_id))
+            for board_id, last_time, last_action_id in self._db.execute(
+                'SELECT board_id, last_time, last_action_id FROM boards'))
+
+    def __contains__(self, board_id):
+        return board_id in self._boards
+
+    def last_time(self, board_id, default=None):
+        """
+        Return the time of the last action reported on a board, or default
+        if nothing has been recorded for it.
+        """
+        if board_id in self._boards:
+            return self._boards[board_id][0]
+        return default
+
+    def is_delivered(self, action_id):
+        """
+        Return True if the action has already been reported.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT 1 FROM delivered WHERE action_id = ?',
+                (action_id,)).fetchone()
+        return row is not None
+
+    def is_sent(self, action_id, room_id):
+        """
+        Return True if the action has already been sent (or queued) to the
+        room.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT 1 FROM sent WHERE action_id = ? AND room_id = ?',
+                (action_id, str(room_id))).fetchone()
+        return row is not None
+
+    def mark_sent(self, board_id, action_ids, room_id):
+        """
+        Record that the actions on a board have been sent (or queued) to a
+        room, as soon as that's done, so that a crash before their page is
+        recorded doesn't send them to the room again.
+        """
+        now = self.clock()
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO sent'
+                    ' (action_id, room_id, board_id, sent_at)'
+                    ' VALUES (?, ?, ?, ?)',
+                    [(action_id, str(room_id), board_id, now)
+                     for action_id in action_ids])
+
+    def record(self, board_id, last_time, last_action_id, action_ids=()):
+        """
+        Record that the actions with the given IDs on a board have been
+        reported, and that the board is now reported up to last_time and
+        last_action_id. Nothing is written if none of this is new.
+        """
+        action_ids = list(action_ids)
+        if not action_ids and \
+           self._boards.get(board_id) == (last_time, last_action_id):
+            return
+        now = self.clock()
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO boards'
+                    ' (board_id, last_time, last_action_id) VALUES (?, ?, ?)',
+                    (board_id, last_time, last_action_id))
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO delivered'
+                    ' (action_id, board_id, delivered_at) VALUES (?, ?, ?)',
+                    [(action_id, board_id, now) for action_id in action_ids])
+            self._boards[board_id] = (last_time, last_action_id)
+
+    def prune(self):
+        """
+        Forget delivered and sent action IDs older than the retention period.
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'DELETE FROM delivered WHERE delivered_at < ?',
+                    (self.clock() - self.retention,))
+                self._db.execute(
+                    'DELETE FROM sent WHERE sent_at < ?',
+                    (self.clock() - self.retention,))
+
+    def adopt(self, board_id, paths):
+        """
+        Bring the state of a board up to date with the state databases at
+        `paths`, for when another process has been reporting it. If one of
+        them is ahead of this store, take its position on the board; if it
+        isn't behind, take the IDs of the actions it delivered (or sent to
+        rooms) there, which it may have recorded without finishing the page.
+        """
+        for path in paths:
+            other = sqlite3.connect(path, timeout=30)
+            try:
+                row = other.execute(
+                    'SELECT last_time, last_action_id FROM boards'
+                    ' WHERE board_id = ?', (board_id,)).fetchone()
+                mine = self._boards.get(board_id)
+                if row is None or (mine is not None and row[0] < mine[0]):
+                    continue
+                delivered = other.execute(
+                    'SELECT action_id, delivered_at FROM delivered'
+                    ' WHERE board_id = ?', (board_id,)).fetchall()
+                try:
+                    sent = other.execute(
+                        'SELECT action_id, room_id, sent_at FROM sent'
+                        ' WHERE board_id = ?', (board_id,)).fetchall()
+                except sqlite3.OperationalError:
+                    # Written by a version that didn't record rooms.
+                    sent = []
+            finally:
+                other.close()
+            with self._lock:
+                with self._db:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO boards'
+                        ' (board_id, last_time, last_action_id)'
+                        ' VALUES (?, ?, ?)', (board_id, row[0], row[1]))
+                    self._db.executemany(
+                        'INSERT OR IGNORE INTO delivered'
+                        ' (action_id, board_id, delivered_at)'
+                        ' VALUES (?, ?, ?)',
+                        [(action_id, board_id, delivered_at)
+                         for action_id, delivered_at in delivered])
+                    self._db.executemany(
+                        'INSERT OR IGNORE INTO sent'
+                        ' (action_id, room_id, board_id, sent_at)'
+                        ' VALUES (?, ?, ?, ?)',
+                        [(action_id, room_id, board_id, sent_at)
+                         for action_id, room_id, sent_at in sent])
+                self._boards[board_id] = (row[0], row[1])
+
+    def import_json(self, path):
+        """
+        Import the board times from a last-actions.json file written by older
+        versions, for boards that have no state yet.
+        """
+        with open(path) as f:
+            last_times = json.load(f)
+        for board_id, last_time in last_times.items():
+            if board_id not in self._boards:
+                self.record(board_id, last_time, None)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
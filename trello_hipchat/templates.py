@@ -0,0 +1,227 @@
+"""
+Message templates parsed once into their literal text, fields and links, so
+that an action's parameters are only computed if its template uses them,
+and the same template can be rendered in any of several output formats.
+
+The templates in messages.py are written as HTML for HipChat. Parameter
+values are kept raw; each renderer escapes them (and writes links) its own
+way.
+"""
+import re
+import sys
+import hashlib
+
+if sys.version_info[0] > 2:
+    from html import escape as html_escape
+else:
+    from cgi import escape as cgi_escape
+    html_escape = lambda string: cgi_escape(string, quote=True)
+
+# A template field, like %(card_name)s or %(count)d.
+FIELD = re.compile(r'%\((\w+)\)[sd]')
+
+# A link whose URL is a template field, like
+# <a href="%(card_url)s">%(card_name)s</a>.
+LINK = re.compile(r'<a href="%\((\w+)\)s">(.*?)</a>')
+
+# The kinds of template parts.
+TEXT, VALUE, LINK_TO = 'text', 'value', 'link'
+
+
+def join_names(names, maxnames=5):
+    """
+    Join names into a comma-separated list, dropping repeated names and
+    summarizing any beyond the first maxnames.
+    """
+    unique = []
+    for name in names:
+        if name not in unique:
+            unique.append(name)
+    if len(unique) > maxnames:
+        return '%s and %d more' % (', '.join(unique[:maxnames]),
+                                   len(unique) - maxnames)
+    return ', '.join(unique)
+
+
+class Links(tuple):
+    """
+    A parameter value that is a list of (url, label) pairs, rendered as a
+    list of links joined by join_names().
+    """
+
+
+def _parse_fields(source, parts):
+    position = 0
+    for match in FIELD.finditer(source):
+        if match.start() > position:
+            parts.append((TEXT, source[position:match.start()], None))
+        parts.append((VALUE, match.group(1), None))
+        position = match.end()
+    if position < len(source):
+        parts.append((TEXT, source[position:], None))
+    return parts
+
+
+class Template(object):
+    """
+    A compiled message template.
+
+    `fields` is the set of parameters it uses. `parts` is the template split
+    into literal text, fields and links (each with its URL field and the
+    parts of its label), in order.
+    """
+    __slots__ = ('source', 'parts', 'fields')
+
+    def __init__(self, source):
+        self.source = source
+        self.parts = []
+        position = 0
+        for match in LINK.finditer(source):
+            _parse_fields(source[position:match.start()], self.parts)
+            self.parts.append((LINK_TO, match.group(1),
+                               _parse_fields(match.group(2), [])))
+            position = match.end()
+        _parse_fields(source[position:], self.parts)
+
+        fields = set()
+        for kind, value, label in self.parts:
+            if kind == TEXT and '%' in value:
+                raise ValueError('Unparseable template: %r' % source)
+            if kind != TEXT:
+                fields.add(value)
+            for label_kind, label_value, _ in label or ():
+                if label_kind != TEXT:
+                    fields.add(label_value)
+        self.fields = frozenset(fields)
+
+    def format(self, params, renderer):
+        """
+        Return the template filled in with the parameters, escaped and with
+        links written for the renderer.
+        """
+        return _format(self.parts, params, renderer)
+
+
+def _format(parts, params, renderer):
+    out = []
+    for kind, value, label in parts:
+        if kind == TEXT:
+            out.append(value)
+        elif kind == VALUE:
+            out.append(renderer.value(params[value]))
+        else:
+            out.append(renderer.link(params[value],
+                                     _format(label, params, renderer)))
+    return ''.join(out)
+
+
+def compile_templates(sources, producible=None):
+    """
+    Compile a mapping from names to template strings. If `producible` (a set
+    of parameter names) is given, raise ValueError if any template uses a
+    parameter not in it, so that a template that can't be filled in is found
+    when the program starts rather than when it's first used.
+    """
+    templates = dict((name, Template(source))
+                     for name, source in sources.items())
+    if producible is not None:
+        missing = sorted('%s: %s' % (name, field)
+                         for name, template in templates.items()
+                         for field in template.fields - set(producible))
+        if missing:
+            raise ValueError('No way to produce template fields (%s)'
+                             % ', '.join(missing))
+    return templates
+
+
+class Renderer(object):
+    """
+    Renders templates as HTML messages for HipChat's v1 API. Subclasses
+    render other formats by overriding escape(), link() and render().
+
+    `mtype` is the message format passed along with the message to the
+    function that sends it.
+    """
+    name = 'html'
+    mtype = 'html'
+
+    def escape(self, string):
+        return html_escape(string)
+
+    def link(self, url, label):
+        return '<a href="%s">%s</a>' % (html_escape(url), label)
+
+    def value(self, value):
+        if isinstance(value, Links):
+            return join_names([self.link(url, self.escape(label))
+                               for url, label in value])
+        if isinstance(value, int):
+            return str(value)
+        return self.escape(value)
+
+    def render(self, template, params):
+        """
+        Return the message to send for the template and parameters.
+        """
+        return template.format(params, self)
+
+
+class TextRenderer(Renderer):
+    """
+    Renders templates as plain text, with link URLs in parentheses.
+    """
+    name = 'text'
+    mtype = 'text'
+
+    def escape(self, string):
+        return string
+
+    def link(self, url, label):
+        return '%s (%s)' % (label, url)
+
+
+class SlackRenderer(Renderer):
+    """
+    Renders templates as Slack message payloads, in Slack's markup.
+    """
+    name = 'slack'
+    mtype = 'slack'
+
+    def escape(self, string):
+        return (string.replace('&', '&amp;').replace('<', '&lt;')
+                .replace('>', '&gt;'))
+
+    def link(self, url, label):
+        return '<%s|%s>' % (url, label)
+
+    def render(self, template, params):
+        return {'text': template.format(params, self)}
+
+
+class HipChatCardRenderer(Renderer):
+    """
+    Renders templates as HipChat v2 notifications with a card: the HTML
+    message as its description, a plain text version as its title and as
+    the fallback message, and the card's URL as its link.
+    """
+    name = 'hipchat-card'
+    mtype = 'card'
+
+    def render(self, template, params):
+        html = template.format(params, RENDERERS['html'])
+        text = template.format(params, RENDERERS['text'])
+        title = params.get('card_name') or text
+        card = {
+            'style': 'application',
+            'format': 'compact',
+            'id': hashlib.sha1(html.encode('utf-8')).hexdigest(),
+            'title': title,
+            'description': {'format': 'html', 'value': html},
+        }
+        if params.get('card_url'):
+            card['url'] = params['card_url']
+        return {'message': text, 'message_format': 'text', 'card': card}
+
+
+RENDERERS = dict((renderer.name, renderer) for renderer in (
+    Renderer(), TextRenderer(), SlackRenderer(), HipChatCardRenderer()))
@@ -0,0 +1,358 @@
+"""
+A shared HTTP transport that keeps connections to each host alive between
+requests, so that talking to the Trello and HipChat APIs doesn't pay for a
+new TCP and TLS handshake on every call, and that fails fast when a host is
+down instead of waiting for every request to time out.
+"""
+import sys
+import time
+import errno
+import zlib
+import select
+import threading
+import logging
+
+if sys.version_info[0] > 2:
+    from urllib.parse import urlsplit
+    import http.client as httplib
+else:
+    from urlparse import urlsplit
+    import httplib
+
+logger = logging.getLogger(__name__)
+
+# Requests that can safely be sent again if a kept-alive connection turns
+# out to have been closed by the other end while it sat in the pool, after
+# the request went out. Others (such as posting a HipChat message) might have
+# been acted on, so they're only retried if the request couldn't be sent at
+# all.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+# The errors that sending a request on such a connection fails with.
+CLOSED_ERRNOS = frozenset([errno.EPIPE, errno.ECONNRESET])
+
+
+def without_query(url):
+    """
+    Return a URL without its query string, which is where the Trello and
+    HipChat APIs take their keys and tokens, so that it can be logged.
+    """
+    parts = urlsplit(url)
+    return '%s://%s%s' % (parts.scheme, parts.netloc, parts.path)
+
+
+class HTTPError(Exception):
+    """
+    Raised when a request gets a response with a 4xx or 5xx status. The
+    response headers are kept in a dictionary with lowercased names. The URL
+    is kept (and shown) without its query string, so that logging the error
+    doesn't leak credentials.
+    """
+    def __init__(self, url, status, reason, headers, body):
+        url = without_query(url)
+        Exception.__init__(self, '%s %s for %s' % (status, reason, url))
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class CircuitOpenError(IOError):
+    """
+    Raised instead of making a request to a host whose circuit is open.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Keeps track of failed requests to one host. After `threshold` failures
+    in a row (network errors or 5xx responses) the circuit opens, and
+    requests fail right away for `reset_timeout` seconds. Then it's
+    half-open: one request at a time is let through to test the host, and
+    the circuit closes again as soon as one succeeds.
+    """
+    def __init__(self, threshold=5, reset_timeout=30, clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._testing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """
+        Return True if a request may be made now.
+        """
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._testing:
+                self._testing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info('Circuit closed again')
+            self.failures = 0
+            self.opened_at = None
+            self._testing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._testing = False
+            if self.opened_at is not None or \
+               self.failures >= self.threshold:
+                self.opened_at = self.clock()
+
+
+def closed_by_peer(conn):
+    """
+    Return True if the other end has closed an idle connection (or sent
+    something unasked, which leaves it just as unusable): its socket is
+    readable while no response is expected.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (ValueError, select.error):
+        return True
+    return bool(readable)
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections to a single host. At most max_size idle
+    connections are kept; connections returned beyond that are closed.
+    """
+    def __init__(self, scheme, host, max_size=4, timeout=30):
+        self.scheme = scheme
+        self.host = host
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return an idle connection and True, or a new connection and False if
+        there are no idle ones.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if not closed_by_peer(conn):
+                return conn, True
+            conn.close()
+        return self.new(), False
+
+    def new(self):
+        """
+        Return a new connection to the host.
+        """
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def put(self, conn):
+        """
+        Return a connection to the pool once its response has been read.
+        """
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class Transport(object):
+    """
+    Makes HTTP requests over a pool of connections per host, through a
+    CircuitBreaker per host.
+    """
+    def __init__(self, pool_size=4, timeout=30, failure_threshold=5,
+                 reset_timeout=30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._pools = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, pool_size=None, timeout=None, failure_threshold=None,
+                  reset_timeout=None):
+        """
+        Change the pool size, the timeout and/or the circuit breaker
+        settings. Existing connections are closed, and new ones are made
+        with the new settings.
+        """
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if timeout is not None:
+            self.timeout = timeout
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if reset_timeout is not None:
+            self.reset_timeout = reset_timeout
+        with self._lock:
+            for breaker in self._breakers.values():
+                breaker.threshold = self.failure_threshold
+                breaker.reset_timeout = self.reset_timeout
+        self.close()
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.close()
+
+    def _pool(self, scheme, host):
+        with self._lock:
+            pool = self._pools.get((scheme, host))
+            if pool is None:
+                pool = ConnectionPool(scheme, host, self.pool_size,
+                                      self.timeout)
+                self._pools[(scheme, host)] = pool
+            return pool
+
+    def breaker(self, url):
+        """
+        Return the CircuitBreaker for the host of a URL.
+        """
+        parts = urlsplit(url)
+        with self._lock:
+            breaker = self._breakers.get((parts.scheme, parts.netloc))
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold,
+                                         self.reset_timeout)
+                self._breakers[(parts.scheme, parts.netloc)] = breaker
+            return breaker
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Make an HTTP request and return the response body as bytes, decoding
+        it if it was gzipped. Raise HTTPError if the response has an error
+        status, and CircuitOpenError without trying if the host's circuit is
+        open.
+        """
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError('Circuit open for %s'
+                                   % urlsplit(url).netloc)
+        try:
+            data = self._request(method, url, body, headers)
+        except HTTPError as e:
+            if e.status >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            raise
+        except Exception:
+            breaker.failure()
+            raise
+        breaker.success()
+        return data
+
+    def _request(self, method, url, body, headers):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        all_headers = {'Accept-Encoding': 'gzip'}
+        if headers:
+            all_headers.update(headers)
+
+        pool = self._pool(parts.scheme, parts.netloc)
+        conn, reused = pool.get()
+        try:
+            response = self._send(conn, method, path, body, all_headers,
+                                  reused)
+            if response is None:
+                # The server closed this connection while it was idle; try
+                # once more on a new one.
+                logger.debug('Stale connection to %s, reconnecting',
+                             parts.netloc)
+                conn.close()
+                conn = pool.new()
+                response = self._send(conn, method, path, body, all_headers,
+                                      False)
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            pool.put(conn)
+
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            dict((name.lower(), value)
+                                 for name, value in response.getheaders()),
+                            data)
+        return data
+
+    def _send(self, conn, method, path, body, headers, reused):
+        """
+        Send a request on a connection and return the response. If the
+        connection was `reused` and turns out to have been closed, return
+        None instead, so the request can be sent again on a new one: always
+        if the request couldn't be sent, and only for IDEMPOTENT_METHODS if
+        it went out but the server closed the connection without answering.
+        Timeouts are never retried.
+        """
+        try:
+            conn.request(method, path, body, headers)
+        except (httplib.CannotSendRequest, IOError) as e:
+            if reused and (isinstance(e, httplib.CannotSendRequest) or
+                           getattr(e, 'errno', None) in CLOSED_ERRNOS):
+                return None
+            raise
+        try:
+            return conn.getresponse()
+        except httplib.BadStatusLine:
+            # This includes RemoteDisconnected: the server closed the
+            # connection without sending anything back.
+            if reused and method in IDEMPOTENT_METHODS:
+                return None
+            raise
+
+
+# The transport used by trello() and send_hipchat_message().
+default_transport = Transport()
+
+
+def request(method, url, body=None, headers=None):
+    """
+    Make an HTTP request with the default transport.
+    """
+    return default_transport.request(method, url, body, headers)
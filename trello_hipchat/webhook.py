@@ -0,0 +1,350 @@
+"""
+Receive Trello activity through webhooks instead of polling for it.
+
+Trello POSTs every action on a board to a webhook's callback URL as it
+happens. This runs an HTTP server at that URL that checks each POST's
+signature and reports its action the same way run_forever would, and makes
+sure every board in the config has a webhook pointing at it.
+"""
+from __future__ import print_function
+import os
+import sys
+import hmac
+import json
+import base64
+import hashlib
+import threading
+import logging
+from collections import defaultdict
+from argparse import ArgumentParser
+
+if sys.version_info[0] > 2:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from queue import Queue
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue
+
+from . import (trello, enrich_actions, fan_out, send_hipchat_message,
+               DigestBuffer)
+from .routing import Route
+from .spool import DeadLetterSpool, spooling
+from .cli import load_config, configure
+
+logger = logging.getLogger(__name__)
+
+# How often to check that every board still has its webhook. Trello deletes
+# webhooks whose callbacks keep failing.
+REFRESH_INTERVAL = 60 * 60
+
+# How often to send the digests whose window has closed, and try sending
+# the messages in the spool.
+MAINTENANCE_INTERVAL = 1
+
+# Sentinel telling a board's worker thread to exit.
+_STOP = object()
+
+
+def signature(body, callback_url, secret):
+    """
+    Compute the signature Trello sends with a webhook POST: a base64 HMAC-SHA1
+    of the request body followed by the callback URL, keyed with the API
+    secret.
+    """
+    digest = hmac.new(secret.encode('utf-8'),
+                      body + callback_url.encode('utf-8'),
+                      hashlib.sha1).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def verify_signature(body, callback_url, secret, received):
+    """
+    Return True if `received` is the right signature for this webhook POST.
+    """
+    if not received:
+        return False
+    return hmac.compare_digest(signature(body, callback_url, secret),
+                               received)
+
+
+def resolve_board_ids(config, board_ids):
+    """
+    Return a dict mapping each of the board IDs to the board's full ID.
+    The config may name a board by its short link (as in its URL), but
+    webhooks always give the full ID.
+    """
+    return dict((board_id,
+                 trello('/boards/%s' % board_id,
+                        api_key=config.TRELLO_API_KEY,
+                        token=config.TRELLO_TOKEN, fields='id')['id'])
+                for board_id in board_ids)
+
+
+def register_webhooks(config, callback_url, board_ids):
+    """
+    Make sure each of the boards has a webhook that posts to callback_url,
+    creating the ones that are missing. Return the IDs of the boards that
+    needed a new webhook. The IDs must be full IDs (see resolve_board_ids()),
+    which is what Trello lists webhooks by.
+    """
+    existing = trello('/tokens/%s/webhooks' % config.TRELLO_TOKEN,
+                      api_key=config.TRELLO_API_KEY,
+                      token=config.TRELLO_TOKEN)
+    registered = set(hook['idModel'] for hook in existing
+                     if hook['callbackURL'] == callback_url and
+                     hook.get('active', True))
+    created = []
+    for board_id in sorted(set(board_ids) - registered):
+        trello('/webhooks', api_key=config.TRELLO_API_KEY,
+               token=config.TRELLO_TOKEN, method='POST',
+               idModel=board_id, callbackURL=callback_url,
+               description='trello-hipchat')
+        created.append(board_id)
+    return created
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server that receives Trello webhook POSTs and reports their
+    actions to the rooms that subscribe to the board.
+
+    Each POST is answered before its action is reported, so Trello never
+    sends it again. Each board's actions are then reported one at a time, in
+    the order they arrived, by a thread of its own.
+
+    With a DeadLetterSpool as `spool`, messages that can't be delivered are
+    kept in it (as run_forever does) rather than lost; `send` should then be
+    a DeliveryQueue's put() that spools to it, or None to send right away
+    through spooling().
+    """
+    daemon_threads = True
+
+    def __init__(self, address, config, callback_url, debug=False,
+                 send=None, spool=None):
+        HTTPServer.__init__(self, address, WebhookHandler)
+        self.config = config
+        self.callback_url = callback_url
+        self.debug = debug
+        self.spool = spool
+        if send is None and spool is not None:
+            send = spooling(self.raw_send, spool)
+        self.send = send
+        # Actions arrive one at a time, so rooms with a digest_window need
+        # them held until the window closes to merge them.
+        self.digests = DigestBuffer()
+        # Routes by the full ID of their board, which is what webhooks give.
+        routes = Route.from_config(config)
+        full_ids = resolve_board_ids(config,
+                                     set(route.board_id for route in routes))
+        self.routes_by_board = defaultdict(list)
+        for route in routes:
+            self.routes_by_board[full_ids[route.board_id]].append(route)
+        self._board_queues = {}
+        self._board_threads = []
+        self._board_lock = threading.Lock()
+
+    def receive(self, board_id, action):
+        """
+        Queue an action received from a webhook, to be reported by its
+        board's thread.
+        """
+        if board_id not in self.routes_by_board:
+            return
+        with self._board_lock:
+            queue = self._board_queues.get(board_id)
+            if queue is None:
+                queue = self._board_queues[board_id] = Queue()
+                thread = threading.Thread(target=self._work, args=(queue,))
+                thread.daemon = True
+                thread.start()
+                self._board_threads.append(thread)
+        queue.put((board_id, action))
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self.handle_action(*item)
+            except Exception:
+                logger.exception('Failed to report action %s',
+                                 item[1].get('id'))
+            finally:
+                queue.task_done()
+
+    def handle_action(self, board_id, action):
+        """
+        Report one action on a board, given by its full ID.
+        """
+        # The config might name the board more than one way.
+        by_config_id = defaultdict(list)
+        for route in self.routes_by_board.get(board_id, []):
+            by_config_id[route.board_id].append(route)
+        for config_id, routes in by_config_id.items():
+            records = enrich_actions(self.config, [action], config_id,
+                                     routes)
+            fan_out(self.config, records, routes, debug=self.debug,
+                    send=self.send, digests=self.digests)
+
+    def join(self):
+        """
+        Wait until every action received so far has been reported.
+        """
+        with self._board_lock:
+            queues = list(self._board_queues.values())
+        for queue in queues:
+            queue.join()
+
+    def stop_workers(self, timeout=None):
+        """
+        Stop the boards' threads after they report everything already
+        received, waiting at most `timeout` seconds for each of them.
+        """
+        with self._board_lock:
+            queues = list(self._board_queues.values())
+            self._board_queues = {}
+            threads, self._board_threads = self._board_threads, []
+        for queue in queues:
+            queue.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    @property
+    def raw_send(self):
+        """
+        The function that actually sends messages: the config's
+        SEND_MESSAGE, or send_hipchat_message().
+        """
+        return getattr(self.config, 'SEND_MESSAGE', send_hipchat_message)
+
+    def maintain(self, stop, interval=MAINTENANCE_INTERVAL):
+        """
+        Every `interval` seconds until the `stop` event is set, send the
+        digests that are due and whatever is waiting in the spool; then send
+        the rest of the digests, once the boards' threads have reported
+        what they have.
+        """
+        while not stop.wait(interval):
+            try:
+                self.digests.flush()
+                if self.spool is not None and len(self.spool) and \
+                   not self.debug:
+                    self.spool.replay(self.raw_send,
+                                      self.config.HIPCHAT_API_KEY)
+            except Exception:
+                logger.exception('Failed to send digests or spooled '
+                                 'messages')
+        self.stop_workers(10)
+        self.digests.flush(force=True)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        # Trello checks that the callback URL exists with a HEAD request
+        # before it creates a webhook.
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        server = self.server
+        if not verify_signature(body, server.callback_url,
+                                server.config.TRELLO_API_SECRET,
+                                self.headers.get('X-Trello-Webhook')):
+            self.send_response(401)
+            self.end_headers()
+            return
+        try:
+            payload = json.loads(body.decode('utf-8'))
+            action = payload['action']
+            board_id = payload['model']['id']
+        except (ValueError, KeyError, TypeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        # Queue the action before answering, so that the next POST can't
+        # overtake it, but don't make Trello wait for messages to be sent.
+        server.receive(board_id, action)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def refresh_webhooks(config, callback_url, board_ids, interval, stop):
+    """
+    Register the boards' webhooks every `interval` seconds until the
+    `stop` event is set.
+    """
+    while True:
+        try:
+            created = register_webhooks(config, callback_url, board_ids)
+            if created:
+                logger.info('Registered webhooks for %s',
+                            ', '.join(created))
+        except Exception:
+            logger.exception('Failed to register webhooks')
+        if stop.wait(interval):
+            return
+
+
+def run_webhook_server():
+    """
+    Command-line interface.
+    Receive Trello webhooks and send notifications for them as they arrive.
+    """
+    parser = ArgumentParser()
+    parser.add_argument('config_file', type=str,
+                        help='Python file to load configuration from')
+    parser.add_argument('-H', type=str, dest='host', default='',
+                        help='Address to listen on')
+    parser.add_argument('-p', type=int, dest='port', default=8080,
+                        help='Port to listen on')
+    parser.add_argument('-d', type=str, dest='directory', default='.',
+                        help=('Directory in which to keep messages that '
+                              'could not be sent yet'))
+    parser.add_argument('-u', type=str, dest='callback_url', default=None,
+                        help=('Public URL Trello should post to (defaults to '
+                              'WEBHOOK_CALLBACK_URL in the config)'))
+    parser.add_argument('--no-register', action='store_true',
+                        help="Don't register webhooks with Trello")
+    parser.add_argument('--debug', action='store_true',
+                        help=('Print actions and messages, and don\'t actually'
+                              ' send to HipChat'))
+    args = parser.parse_args()
+
+    config = load_config(args.config_file)
+    callback_url = args.callback_url or config.WEBHOOK_CALLBACK_URL
+    # Kept apart from run_forever's spool, in case both run on one
+    # directory.
+    spool = DeadLetterSpool(os.path.join(args.directory,
+                                         'dead-letters-webhook'))
+    delivery = configure(config, spool)
+
+    server = WebhookServer((args.host, args.port), config, callback_url,
+                           debug=args.debug, send=delivery and delivery.put,
+                           spool=spool)
+    stop = threading.Event()
+    maintainer = threading.Thread(target=server.maintain, args=(stop,))
+    maintainer.daemon = True
+    maintainer.start()
+    if not args.no_register:
+        refresher = threading.Thread(
+            target=refresh_webhooks,
+            args=(config, callback_url, list(server.routes_by_board),
+                  getattr(config, 'WEBHOOK_REFRESH_INTERVAL',
+                          REFRESH_INTERVAL), stop))
+        refresher.daemon = True
+        refresher.start()
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        maintainer.join(10)
+        server.server_close()
@@ -17,6 +17,13 @@ TRELLO_API_KEY = "fill-in-as-explained-above"
 # If you don't need access to private boards, set this to None.
 TRELLO_TOKEN = "fill-in-as-explained-above"
 
+# To receive activity through webhooks (the trello-hipchat-webhook command)
+# instead of polling, you also need the API secret shown on the same page as
+# your API key, and the public URL that Trello should post webhooks to.
+# Polling with trello-hipchat doesn't need these.
+TRELLO_API_SECRET = "fill-in-as-explained-above"
+WEBHOOK_CALLBACK_URL = "https://example.com/trello-webhook"
+
 # You need a HipChat API token. Go here to generate one:
 # https://[YOUR_GROUP].hipchat.com/admin/api
 #
@@ -37,14 +44,93 @@ ROOM_DESIGNERS = "55555"
 # What color do you want Trello notifications to be in HipChat?
 HIPCHAT_COLOR = "purple"
 
+# Checklist notifications need to look up the checklist's card and list. These
+# lookups are cached for LOOKUP_CACHE_TTL seconds, keeping at most
+# LOOKUP_CACHE_SIZE of them. Both settings are optional.
+LOOKUP_CACHE_SIZE = 1000
+LOOKUP_CACHE_TTL = 300
+
+# With BOARD_MIRROR set, the lists, cards and checklists of each board are
+# loaded once and kept up to date from its actions, so that these lookups
+# rarely need an API call. The copy is saved in the state directory so it
+# survives a restart, and loaded again from Trello every BOARD_MIRROR_MAX_AGE
+# seconds in case it missed something. Both settings are optional, and only
+# take effect on a restart.
+BOARD_MIRROR = False
+BOARD_MIRROR_MAX_AGE = 24*60*60
+
+# Connections to Trello and HipChat are kept alive and reused. HTTP_POOL_SIZE
+# is the number of idle connections kept per host, and HTTP_TIMEOUT is the
+# number of seconds to wait on a connection. Both settings are optional.
+HTTP_POOL_SIZE = 4
+HTTP_TIMEOUT = 30
+
+# When CIRCUIT_FAILURE_THRESHOLD requests in a row to Trello or HipChat fail,
+# requests to it fail right away for CIRCUIT_RESET_TIMEOUT seconds instead of
+# waiting to time out, and then one is let through to see if it's back.
+# Messages that can't be sent meanwhile are kept in the dead-letters directory
+# under the state directory, and sent in order once HipChat is back. Both
+# settings are optional.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+# To keep a slow or throttling HipChat from holding up polling, messages can be
+# queued and sent by DELIVERY_WORKERS background threads (0 sends them right
+# away instead). At most DELIVERY_QUEUE_SIZE messages are queued; when the
+# queue is full, DELIVERY_OVERFLOW says whether to 'block', 'drop-new' or
+# 'drop-oldest'. Each room is sent at most HIPCHAT_ROOM_RATE messages per
+# second, with bursts of up to HIPCHAT_ROOM_BURST. All settings are optional.
+DELIVERY_WORKERS = 0
+DELIVERY_QUEUE_SIZE = 1000
+DELIVERY_OVERFLOW = 'block'
+HIPCHAT_ROOM_RATE = 1.0
+HIPCHAT_ROOM_BURST = 5
+
+# Each board is polled every -i seconds (60 by default). To poll busy boards
+# more often and quiet ones less, set POLL_MIN_INTERVAL and POLL_MAX_INTERVAL:
+# a board with new activity is polled every POLL_MIN_INTERVAL seconds, and
+# each poll that finds nothing doubles its interval, up to POLL_MAX_INTERVAL.
+# At most TRELLO_REQUEST_BUDGET requests (for actions, lookups and board
+# snapshots alike) are made to Trello in any 10 seconds, to stay under its
+# rate limit; polls wait their turn beyond that. All settings are optional.
+POLL_MIN_INTERVAL = 15
+POLL_MAX_INTERVAL = 600
+TRELLO_REQUEST_BUDGET = 100
+
+# After downtime, catch up on at most MAX_BACKLOG actions per board. This
+# setting is optional.
+MAX_BACKLOG = 1000
+
+# When the trello_hipchat.metrics logger is enabled at INFO level (as it is
+# in logging_debug.cfg), a JSON snapshot of the metrics is logged every
+# METRICS_DUMP_INTERVAL seconds. This setting is optional.
+METRICS_DUMP_INTERVAL = 60
+
 # This is the main configuration section. For each board, specify which lists
 # you want to monitor, and which HipChat room send notifications to.
 # List names are specified with wildcards, so just use "*" to monitor all the lists.
 # Filters are functions that take an action dictionary and return True or False;
 # HipChat notifications will be sent only for cards that pass all filters.
+# A filter can also be a dictionary of conditions on the action's "member"
+# (who did it, or who it was about), "label", "card_name" (a regular
+# expression), "action_type", and date ("since" and "until"), optionally with
+# "exclude": True to turn it around. These are much faster than functions
+# when there are many of them; see trello_hipchat/filters.py. For example:
+#     "filters": [{"label": ["Bug", "Urgent"]},
+#                 {"member": [MEMBER_BOT], "exclude": True}]
 # For a list of possible actions to include, see
 # https://trello.com/docs/api/board/index.html#get-1-boards-board-id-actions;
 # to include all actions, leave out the include_actions list.
+# To avoid flooding a room when someone moves a lot of cards at once, set
+# digest_window to a number of seconds: actions of the same type within that
+# window are then sent as one summary message. Set digest_by to "card" to
+# summarize actions on the same card instead. The room's messages are held
+# back until the window closes, so that actions found in later polls (or
+# received by later webhooks) can still join the summary.
+# Messages are sent as HTML; set format to "text" to send plain text instead.
+# The "hipchat-card" (HipChat v2 notifications with a card) and "slack"
+# formats produce dictionaries that HipChat's v1 API can't take, so they need
+# a SEND_MESSAGE function (see below).
 MONITOR = [
     {
         "board_id": BOARD_MAIN,
@@ -59,6 +145,15 @@ MONITOR = [
         "board_id": BOARD_BRAINSTORMING,
         "list_names": [ "*" ],
         "room_id": ROOM_DESIGNERS,
-        "include_actions": ["createCard"]
+        "include_actions": ["createCard"],
+        "digest_window": 60
     }
 ]
+
+# Optionally, a function to send messages with instead of HipChat's v1 API.
+# It's called with the room ID, the message, HIPCHAT_API_KEY and the keyword
+# arguments color, mtype (the message format) and really (False in debug
+# mode, when nothing should be sent).
+#def SEND_MESSAGE(room_id, message, api_key, color='purple', mtype='html',
+#                 really=True):
+#    ...